@@ -0,0 +1,103 @@
+"""
+Benchmark: lookups under overload with and without admission control
+
+Runs --clients threads that each GET --requests product lookups, while
+--writers threads POST products, through the Flask test client, first with
+every request admitted and then with admission control, and reports the
+lookups served per second, their p50/p99 latency and the requests shed.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_admission --clients 32
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+
+from service import app
+from service.admission import admission_control
+from service.models import db
+from service.routes import init_db
+from tests.factories import ProductFactory
+
+
+def run(clients: int, writers: int, requests: int) -> tuple:
+    """Returns the lookups served per second, their p50/p99 milliseconds and the shed"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    ids = []
+    for _ in range(200):
+        product = ProductFactory()
+        product.create()
+        ids.append(product.id)
+    timings = [[] for _ in range(clients)]
+    shed = [0]
+    start = threading.Barrier(clients + writers + 1)
+
+    def reader(i):
+        test_client = app.test_client()
+        start.wait()
+        for _ in range(requests):
+            began = time.perf_counter()
+            resp = test_client.get("/recommendations/{}".format(random.choice(ids)))
+            if resp.status_code == 503:
+                shed[0] += 1
+            else:
+                timings[i].append(time.perf_counter() - began)
+
+    def writer():
+        test_client = app.test_client()
+        start.wait()
+        for _ in range(requests):
+            resp = test_client.post("/recommendations", json=ProductFactory().serialize())
+            if resp.status_code == 503:
+                shed[0] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(clients)]
+    threads += [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    served = np.concatenate(timings) * 1000
+    p50, p99 = np.percentile(served, [50, 99])
+    return len(served) / elapsed, p50, p99, shed[0]
+
+
+def main():
+    """Runs the overload in both modes and prints the comparison"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=8)
+    parser.add_argument("--max-wait", type=float, default=0.05)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["CACHE_ENABLED"] = False
+    app.config["ADMISSION_MAX_CONCURRENCY"] = args.max_concurrency
+    app.config["ADMISSION_QUEUE_SIZE"] = args.queue_size
+    app.config["ADMISSION_MAX_WAIT"] = args.max_wait
+    for enabled in (False, True):
+        app.config["ADMISSION_ENABLED"] = enabled
+        init_db()
+        throughput, p50, p99, shed = run(args.clients, args.writers, args.requests)
+        label = "admission" if enabled else "open     "
+        print(
+            f"{label}  {throughput:7.0f} lookups/s  p50 {p50:6.2f} ms  p99 {p99:6.2f} ms"
+            f"  {shed} shed  {admission_control.stats()['admitted']}"
+        )
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,155 @@
+"""
+Benchmark: sync workers vs the async serving mode
+
+Seeds a catalog, then sends the same batch and single lookups at several
+concurrency levels, once through the Flask app with one thread per
+request in flight (the sync worker model) and once through the ASGI
+application with one task per request in flight on a single event loop.
+Reports the throughput, the p50/p99 latency and the Python memory
+allocated per request in flight (the tracemalloc peak over the
+concurrency, from a second run since tracing slows the first) of each.
+The cache is switched off so that every request queries the database.
+
+SQLite answers from local disk on the calling thread, and aiosqlite adds a
+thread hop per query, so the async mode only pays off against a database
+with network round trips such as PostgreSQL.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_async
+  DATABASE_URI=postgresql://... python -m benchmarks.bench_async --products 100000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.run import seed
+from service import app
+from service.asgi import AsyncService
+from service.cache import recommendation_cache
+
+
+def requests_for(scenario: str, ids: list, count: int, batch_size: int, rng) -> list:
+    """Returns (method, path, body) of count requests"""
+    if scenario == "lookup":
+        return [("GET", "/recommendations/{}".format(rng.choice(ids)), b"") for _ in range(count)]
+    return [
+        (
+            "POST",
+            "/recommendations/batch",
+            json.dumps({"product_ids": rng.sample(ids, batch_size), "limit": 10}).encode(),
+        )
+        for _ in range(count)
+    ]
+
+
+def run_sync(requests: list, concurrency: int) -> list:
+    """Sends the requests from concurrency threads through the Flask app"""
+    client = app.test_client()
+
+    def send(spec):
+        method, path, body = spec
+        start = time.perf_counter()
+        resp = client.open(path, method=method, data=body, content_type="application/json")
+        assert resp.status_code == 200, resp.status_code
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(send, requests))
+
+
+def run_async(application, requests: list, concurrency: int) -> list:
+    """Sends the requests as concurrency tasks through the ASGI application"""
+
+    async def send(spec, semaphore):
+        method, path, body = spec
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"content-type", b"application/json")],
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        codes = []
+
+        async def receive():
+            return messages.pop()
+
+        async def respond(message):
+            if message["type"] == "http.response.start":
+                codes.append(message["status"])
+
+        async with semaphore:
+            start = time.perf_counter()
+            await application(scope, receive, respond)
+            assert codes == [200], codes
+            return time.perf_counter() - start
+
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        try:
+            return await asyncio.gather(*(send(spec, semaphore) for spec in requests))
+        finally:
+            await application.dispose()
+
+    return asyncio.run(main())
+
+
+def measure(name: str, run, requests: list, concurrency: int):
+    """Runs one mode twice, timed and then traced, and prints its report line"""
+    start = time.perf_counter()
+    latencies = run(requests, concurrency)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    run(requests, concurrency)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    print(
+        f"  {name:5} x{concurrency:<4} {len(requests) / elapsed:8.0f} req/s  "
+        f"p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  "
+        f"{peak / concurrency / 1024:7.1f} KiB per request in flight"
+    )
+
+
+def main():
+    """Seeds the catalog and compares both modes"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=20000)
+    parser.add_argument("--links", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["CACHE_ENABLED"] = False
+    recommendation_cache.init_app(app)
+    rng = random.Random(args.seed)
+    ids = seed(args.products, args.links, rng)
+    application = AsyncService(app)
+    for scenario in ("lookup", "batch"):
+        requests = requests_for(scenario, ids, args.requests, args.batch_size, rng)
+        print(f"{scenario}:")
+        for concurrency in args.concurrency:
+            measure("sync", run_sync, requests, concurrency)
+            measure(
+                "async",
+                lambda specs, level: run_async(application, specs, level),
+                requests,
+                concurrency,
+            )
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,72 @@
+"""
+Benchmark: one-at-a-time vs bulk Product creation
+
+Posts the same catalog to POST /recommendations once per product and then
+as a single NDJSON body, and reports the throughput of both paths.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_bulk_create --rows 5000
+"""
+import argparse
+import json
+import logging
+import time
+
+from service import app
+from service.models import db
+from tests.factories import ProductFactory
+
+
+def reset_tables():
+    """Drops and recreates the tables so both runs start empty"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def bench_single(client, rows):
+    """Creates every row with its own request and commit"""
+    reset_tables()
+    start = time.perf_counter()
+    for row in rows:
+        resp = client.post("/recommendations", json=row)
+        assert resp.status_code == 201, resp.get_data(as_text=True)
+    return time.perf_counter() - start
+
+
+def bench_bulk(client, rows):
+    """Creates every row with one NDJSON request"""
+    reset_tables()
+    body = "\n".join(json.dumps(row) for row in rows)
+    start = time.perf_counter()
+    resp = client.post(
+        "/recommendations", data=body, content_type="application/x-ndjson"
+    )
+    elapsed = time.perf_counter() - start
+    assert resp.get_json()["created"] == len(rows), resp.get_data(as_text=True)
+    return elapsed
+
+
+def main():
+    """Runs both paths and prints the comparison"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    client = app.test_client()
+    rows = [ProductFactory().serialize() for _ in range(args.rows)]
+    for row in rows:
+        del row["id"]
+
+    single = bench_single(client, rows)
+    bulk = bench_bulk(client, rows)
+    print(f"rows: {args.rows}  batch size: {app.config['BULK_BATCH_SIZE']}")
+    print(f"one at a time: {single:8.3f}s  {args.rows / single:10.0f} rows/s")
+    print(f"bulk:          {bulk:8.3f}s  {args.rows / bulk:10.0f} rows/s")
+    print(f"speedup:       {single / bulk:8.1f}x")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
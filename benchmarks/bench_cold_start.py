@@ -0,0 +1,94 @@
+"""
+Benchmark: cold start of the service
+
+Measures how long a fresh interpreter takes to import the app and how long
+gunicorn takes from launch until a worker answers --path, with and
+without --preload. Nothing of the service is imported by this script, so
+each measurement starts from a cold process.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_cold_start --workers 4
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = (
+    "import time; start = time.perf_counter(); import service; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def import_time() -> float:
+    """Returns the seconds a new interpreter spends importing the app"""
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.split()[-1])
+
+
+def boot_time(port: int, workers: int, path: str, preload: bool) -> float:
+    """Returns the seconds from launching gunicorn until path answers 200"""
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", "127.0.0.1:{}".format(port),
+        "--workers", str(workers),
+        "--log-level", "warning",
+    ]
+    if preload:
+        command.append("--preload")
+    url = "http://127.0.0.1:{}{}".format(port, path)
+    start = time.perf_counter()
+    server = subprocess.Popen(command + ["service:app"], cwd=ROOT)
+    try:
+        while time.perf_counter() - start < 60:
+            try:
+                with urllib.request.urlopen(url, timeout=1) as resp:
+                    if resp.status == 200:
+                        return time.perf_counter() - start
+            except (OSError, urllib.error.HTTPError):
+                if server.poll() is not None:
+                    raise RuntimeError("gunicorn exited with status {}".format(server.returncode))
+            time.sleep(0.01)
+        raise RuntimeError("gunicorn did not answer within 60 seconds")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    """Measures the cold start and prints the medians"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--path", default="/health/ready")
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.repeat)]
+    print("import service         {:8.1f} ms".format(statistics.median(imports) * 1000))
+    for preload in (False, True):
+        boots = [
+            boot_time(args.port, args.workers, args.path, preload)
+            for _ in range(args.repeat)
+        ]
+        print(
+            "gunicorn {:13} {:8.1f} ms to the first 200 from {}".format(
+                "--preload" if preload else "", statistics.median(boots) * 1000, args.path
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark: conditional GETs answered with 304 Not Modified
+
+Seeds --products products with --links recommendations each and requests
+random lookups, batches of --batch-size products and product pages twice:
+once as a client without a copy, and once revalidating the copy it holds
+with If-None-Match. Reports the bytes of the bodies sent, the SQL
+statements run and the p50 latency of each, with the recommendation cache
+off so that the database work of each path shows.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_conditional
+"""
+import argparse
+import logging
+import random
+import time
+
+import numpy as np
+from sqlalchemy import event
+
+from service import app
+from service.cache import recommendation_cache
+from service.models import Product, Recommendation, RecommendationType, db
+from tests.factories import ProductFactory
+
+
+def seed(products, links, rng):
+    """Recreates the tables with products that have links recommendations each"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    rows = [ProductFactory().serialize() for _ in range(products)]
+    Product.create_bulk(enumerate(rows), batch_size=10000)
+    ids = [product_id for (product_id,) in db.session.query(Product.id)]
+    batch = [
+        {
+            "source_product_id": source,
+            "target_product_id": target,
+            "type": RecommendationType.CROSS_SELL,
+            "rank": rank,
+        }
+        for source in ids
+        for rank, target in enumerate(rng.sample(ids, links), start=1)
+        if target != source
+    ]
+    db.session.execute(Recommendation.__table__.insert(), batch)
+    db.session.commit()
+    return ids
+
+
+def measure(client, urls, statements, revalidate):
+    """Returns the body bytes, statements and p50 milliseconds per request"""
+    etags = {url: client.get(url).headers["ETag"] for url in urls} if revalidate else {}
+    sent, timings = 0, []
+    before = statements[0]
+    for url in urls:
+        headers = {"If-None-Match": etags[url]} if revalidate else {}
+        start = time.perf_counter()
+        resp = client.get(url, headers=headers)
+        timings.append(time.perf_counter() - start)
+        assert resp.status_code == (304 if revalidate else 200), resp.status_code
+        sent += len(resp.data)
+    count = len(urls)
+    return sent / count, (statements[0] - before) / count, np.percentile(timings, 50) * 1000
+
+
+def main():
+    """Requests each kind of GET with and without a copy and prints the savings"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--links", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["CACHE_ENABLED"] = False
+    recommendation_cache.init_app(app)
+    rng = random.Random(args.seed)
+    ids = seed(args.products, args.links, rng)
+    statements = [0]
+
+    def count(*_):
+        statements[0] += 1
+
+    event.listen(db.engine, "after_cursor_execute", count)
+    kinds = {
+        "lookup": ["/recommendations/{}".format(rng.choice(ids)) for _ in range(args.requests)],
+        "batch": [
+            "/recommendations/batch?"
+            + "&".join("product_id={}".format(i) for i in rng.sample(ids, args.batch_size))
+            for _ in range(args.requests)
+        ],
+        "page": [
+            "/recommendations?limit=100&after={}".format(rng.choice(ids))
+            for _ in range(args.requests)
+        ],
+    }
+    client = app.test_client()
+    for kind, urls in kinds.items():
+        full = measure(client, urls, statements, False)
+        revalidated = measure(client, urls, statements, True)
+        print(
+            f"{kind:6}  200: {full[0]:8.0f} B {full[1]:4.1f} statements {full[2]:6.2f} ms"
+            f"  304: {revalidated[0]:4.0f} B {revalidated[1]:4.1f} statements"
+            f" {revalidated[2]:6.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,59 @@
+"""
+Benchmark: multi-hop traversal of the recommendation graph
+
+Builds adjacency arrays for a synthetic catalog of --products products with
+--links random links each, then times breadth-first traversals from random
+products at every depth up to 3. No database is needed.
+
+Run it with:
+  python -m benchmarks.bench_graph --products 2000000 --links 10
+"""
+import argparse
+import time
+
+import numpy as np
+
+from service.graph import Adjacency, traverse
+from service.snapshot import RECORD, TYPES
+
+
+def synthetic(products: int, links: int, rng) -> Adjacency:
+    """Returns the adjacency arrays of a random catalog"""
+    ids = np.arange(1, products + 1, dtype=np.int64)
+    records = np.zeros(products * links, dtype=RECORD)
+    records["target"] = rng.integers(1, products + 1, len(records))
+    records["score"] = rng.random(len(records))
+    records["type"] = rng.integers(0, len(TYPES), len(records))
+    offsets = np.arange(0, len(records) + 1, links, dtype=np.int64)
+    return Adjacency(ids, offsets, records)
+
+
+def main():
+    """Times traversals at each depth and prints the percentiles"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=2000000)
+    parser.add_argument("--links", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    start = time.perf_counter()
+    adjacency = synthetic(args.products, args.links, rng)
+    print(
+        f"{args.products} products, {args.products * args.links} links "
+        f"built in {time.perf_counter() - start:.1f}s"
+    )
+    starts = rng.integers(1, args.products + 1, args.repeat).tolist()
+    for depth in (1, 2, 3):
+        timings = []
+        for product_id in starts:
+            begin = time.perf_counter()
+            traverse(adjacency.edges, product_id, [[]] * depth, 0.5, 20)
+            timings.append(time.perf_counter() - begin)
+        p50, p99 = np.percentile(np.array(timings) * 1000, [50, 99])
+        print(f"depth {depth}: p50 {p50:6.2f} ms  p99 {p99:6.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark: single product creates with and without group commit
+
+Runs --clients threads that each POST --requests products one at a time
+to /recommendations through the Flask test client, first with every
+create committing alone and then with group commit, and reports the
+creates per second, the p50/p99 latency of a create and, with group
+commit, the number of commits the creates shared.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_group_commit --clients 16
+"""
+import argparse
+import logging
+import threading
+import time
+
+import numpy as np
+
+from service import app
+from service.group_commit import group_commit
+from service.models import db
+from service.routes import init_db
+from tests.factories import ProductFactory
+
+
+def run(clients: int, requests: int) -> tuple:
+    """Returns the creates per second and the p50/p99 milliseconds of a create"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    bodies = [[ProductFactory().serialize() for _ in range(requests)] for _ in range(clients)]
+    timings = [[] for _ in range(clients)]
+    start = threading.Barrier(clients + 1)
+
+    def client(i):
+        test_client = app.test_client()
+        start.wait()
+        for body in bodies[i]:
+            began = time.perf_counter()
+            resp = test_client.post("/recommendations", json=body)
+            timings[i].append(time.perf_counter() - began)
+            assert resp.status_code == 201, resp.status_code
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    p50, p99 = np.percentile(np.concatenate(timings) * 1000, [50, 99])
+    return clients * requests / elapsed, p50, p99
+
+
+def main():
+    """Runs the creates in both modes and prints the comparison"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=0.002)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    app.config["GROUP_COMMIT_MAX_BATCH"] = args.max_batch
+    app.config["GROUP_COMMIT_MAX_WAIT"] = args.max_wait
+    for enabled in (False, True):
+        app.config["GROUP_COMMIT_ENABLED"] = enabled
+        init_db()
+        throughput, p50, p99 = run(args.clients, args.requests)
+        label = "group" if enabled else "alone"
+        commits = args.clients * args.requests if not enabled else group_commit.groups
+        print(
+            f"{label}  {throughput:7.0f} creates/s  p50 {p50:6.2f} ms  p99 {p99:6.2f} ms"
+            f"  {commits} commits"
+        )
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
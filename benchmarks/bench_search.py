@@ -0,0 +1,100 @@
+"""
+Benchmark: trigram product search
+
+Loads a synthetic catalog of --products products into the trigram index
+and times --queries searches of each kind against it: the prefixes an
+admin typeahead sends while a product name is typed, with and without the
+cache of recent results, and fuzzy searches of whole names with one typo. Reports the build time, the index size and
+the p50/p99 latency of each kind, with the recall of the fuzzy searches
+(the share that find the product whose name was misspelt). No database is
+needed.
+
+Run it with:
+  python -m benchmarks.bench_search --products 1000000
+"""
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+from service import app
+from service.search import TrigramIndex
+
+# letters weighted by their frequency in English text, per mille
+LETTERS = dict(zip(
+    "etaoinshrdlcumwfgypbvkjxqz",
+    (127, 91, 82, 75, 70, 67, 63, 61, 60, 43, 40, 28, 28, 24, 24, 22, 20, 20, 19, 15, 10, 8, 2, 2, 1, 1),
+))
+CATEGORIES = ["phone", "laptop", "tablet", "audio", "accessory", "wearable", "camera", "tv"]
+
+
+def vocabulary(size: int, rng: random.Random) -> list:
+    """Returns about size made up words of 3 to 9 letters"""
+    letters, weights = list(LETTERS), list(LETTERS.values())
+    return sorted({"".join(rng.choices(letters, weights, k=rng.randint(3, 9))) for _ in range(size)})
+
+
+def synthetic(products: int, words: list, rng: random.Random):
+    """Yields (id, name, category) rows of a random catalog"""
+    for product_id in range(1, products + 1):
+        name = " ".join(rng.choice(words) for _ in range(rng.randint(2, 3)))
+        yield product_id, "{} {}".format(name, rng.randint(1, 99)), rng.choice(CATEGORIES)
+
+
+def typo(text: str, rng: random.Random) -> str:
+    """Swaps two neighbouring letters of text"""
+    i = rng.randrange(len(text) - 1)
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+def timed(index, queries, cached=True, **kwargs):
+    """Returns the answers and the p50/p99 latency in milliseconds"""
+    found, timings = [], []
+    for query in queries:
+        if not cached:
+            index._results.clear()
+        start = time.perf_counter()
+        found.append(index.search(query, 10, **kwargs))
+        timings.append(time.perf_counter() - start)
+    p50, p99 = np.percentile(np.array(timings) * 1000, [50, 99])
+    return found, p50, p99
+
+
+def main():
+    """Builds the index and prints the latency of each kind of search"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--words", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = list(synthetic(args.products, vocabulary(args.words, rng), rng))
+    index = TrigramIndex()
+    start = time.perf_counter()
+    index.load(rows)
+    postings = sum(len(ids) for ids in index._postings.values())
+    print(
+        f"{args.products} products indexed in {time.perf_counter() - start:.1f}s: "
+        f"{len(index._postings)} trigrams, {postings} postings, "
+        f"{sum(sys.getsizeof(ids) for ids in index._postings.values()) / 2**20:.0f} MiB"
+    )
+
+    sample = rng.sample(rows, args.queries)
+    prefixes = [name[:rng.randint(1, len(name))] for _, name, _ in sample]
+    for cached in (False, True):
+        _, p50, p99 = timed(index, prefixes, cached, prefix=True)
+        label = "cached" if cached else "cold"
+        print(f"prefix {label:6}  p50 {p50:6.3f} ms  p99 {p99:6.3f} ms")
+
+    found, p50, p99 = timed(index, [typo(name, rng) for _, name, _ in sample])
+    hits = sum(row[0] in {pid for pid, _ in results} for row, results in zip(sample, found))
+    print(f"fuzzy          p50 {p50:6.3f} ms  p99 {p99:6.3f} ms  recall@10 {hits / len(sample):.3f}")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
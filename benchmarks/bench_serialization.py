@@ -0,0 +1,77 @@
+"""
+Benchmark: ORM serialize() + jsonify vs column tuples + fast JSON
+
+Reads the same page of products through both read paths and reports how
+long each takes to produce the response body.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.bench_serialization --rows 1000
+"""
+import argparse
+import logging
+import time
+
+from flask import jsonify
+
+from service import app, fastjson
+from service.models import Product, db
+from tests.factories import ProductFactory
+
+
+def seed(rows):
+    """Recreates the tables with rows products"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    data = [ProductFactory().serialize() for _ in range(rows)]
+    Product.create_bulk(enumerate(data), batch_size=10000)
+
+
+def orm_path(limit):
+    """Hydrates ORM objects, serializes them and encodes with jsonify"""
+    products = Product.page(limit=limit)
+    body = jsonify([product.serialize() for product in products]).get_data()
+    db.session.expunge_all()
+    return body
+
+
+def fast_path(limit):
+    """Selects column tuples and encodes them straight to bytes"""
+    return fastjson.json_response(Product.page_rows(limit=limit)).get_data()
+
+
+def best_of(func, limit, repeat):
+    """Returns the fastest of repeat runs in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(limit)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    """Runs both paths and prints the comparison"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    app.logger.setLevel(logging.CRITICAL)
+    seed(args.rows)
+    with app.test_request_context():
+        assert fastjson.json_response(Product.page_rows(limit=5)).get_json() == [
+            product.serialize() for product in Product.page(limit=5)
+        ]
+        orm = best_of(orm_path, args.rows, args.repeat)
+        fast = best_of(fast_path, args.rows, args.repeat)
+    encoder = "orjson" if fastjson.orjson else "json"
+    print(f"rows per response: {args.rows}  encoder: {encoder}")
+    print(f"serialize() + jsonify: {orm * 1000:8.2f} ms")
+    print(f"columns + fast JSON:   {fast * 1000:8.2f} ms")
+    print(f"speedup:               {orm / fast:8.1f}x")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
@@ -0,0 +1,75 @@
+"""
+Benchmark: exact vs LSH similar product search
+
+Loads a synthetic catalog of --products products into the similarity index
+and times top-10 queries of random products by exact batched dot products
+and through the LSH tables at every number of probes, with the recall of
+each against the exact answer. No database is needed.
+
+Run it with:
+  python -m benchmarks.bench_similarity --products 200000
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from service import app
+from service.similarity import SimilarityIndex
+
+WORDS = (
+    "galaxy pixel phone pro max mini ultra lite book air pad watch band case "
+    "charger cable dock stand speaker buds pods headset mouse keyboard"
+).split()
+CATEGORIES = ["phone", "laptop", "tablet", "audio", "accessory", "wearable", "camera", "tv"]
+
+
+def synthetic(products: int, rng: random.Random):
+    """Yields (id, name, category, price) rows of a random catalog"""
+    for product_id in range(1, products + 1):
+        name = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+        yield product_id, name, rng.choice(CATEGORIES), rng.randint(1, 999999)
+
+
+def timed(index, sample, count, **kwargs):
+    """Returns the answers and the median latency in milliseconds"""
+    found, timings = {}, []
+    for product_id in sample:
+        start = time.perf_counter()
+        found.update(index.similar([product_id], count, **kwargs))
+        timings.append(time.perf_counter() - start)
+    return found, float(np.median(timings)) * 1000
+
+
+def main():
+    """Compares exact and LSH search and prints latency and recall"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--tables", type=int, default=8)
+    parser.add_argument("--bits", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = SimilarityIndex(tables=args.tables, bits=args.bits)
+    start = time.perf_counter()
+    index.load(synthetic(args.products, rng))
+    print(f"{args.products} products indexed in {time.perf_counter() - start:.1f}s")
+    sample = rng.sample(range(1, args.products + 1), args.queries)
+
+    exact, latency = timed(index, sample, 10, exact=True)
+    print(f"exact           p50 {latency:7.2f} ms  recall@10 1.000")
+    for probes in range(1, args.tables + 1):
+        found, latency = timed(index, sample, 10, probes=probes, exact=False)
+        hits = sum(
+            len({t for t, _ in found[p]} & {t for t, _ in exact[p]}) for p in sample
+        )
+        recall = hits / sum(len(exact[p]) for p in sample)
+        print(f"lsh probes={probes}    p50 {latency:7.2f} ms  recall@10 {recall:.3f}")
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
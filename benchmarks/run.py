@@ -0,0 +1,323 @@
+"""
+Benchmark and load-test suite
+
+Seeds a catalog of --products products (built with ProductFactory) and
+--links recommendations per product, then measures the throughput and the
+p50/p95/p99 latency of each scenario:
+
+  create        POST /recommendations with one product
+  bulk_create   POST /recommendations with an NDJSON body of --bulk-size rows
+  list          GET /recommendations?limit=100 from a random cursor
+  lookup        GET /recommendations/<id> of a random product
+  batch_lookup  POST /recommendations/batch of --batch-size random products
+
+Each scenario runs through the Flask test client, which measures the
+application alone, and against a real gunicorn process with --workers
+workers driven by --concurrency client threads, which adds HTTP and the
+worker model. The seed makes the catalog and the request mix repeatable.
+
+Results are written as JSON. With --baseline the run is compared with an
+earlier results file, and the command exits with status 1 when a scenario
+got slower (p95) or lost throughput by more than --threshold.
+
+Run it with:
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.run --out results.json
+  DATABASE_URI=sqlite:////tmp/bench.db python -m benchmarks.run --baseline results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import factory.random
+import numpy as np
+
+from service import app
+from service.models import Product, Recommendation, RecommendationType, db
+from tests.factories import ProductFactory
+
+SCENARIOS = ("create", "bulk_create", "list", "lookup", "batch_lookup")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+######################################################################
+# CATALOG
+######################################################################
+def product_row():
+    """Returns the JSON body of a new fake product"""
+    row = ProductFactory().serialize()
+    del row["id"]
+    return row
+
+
+def seed(products: int, links: int, rng: random.Random) -> list:
+    """Recreates the tables with a fake catalog and returns its ids"""
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    Product.create_bulk(
+        ((i, product_row()) for i in range(products)), batch_size=10000
+    )
+    ids = [product_id for (product_id,) in db.session.query(Product.id)]
+    table = Recommendation.__table__
+    batch = []
+    for source in ids:
+        targets = rng.sample(ids, min(links + 1, len(ids)))
+        targets = [target for target in targets if target != source][:links]
+        for rank, target in enumerate(targets, start=1):
+            batch.append(
+                {
+                    "source_product_id": source,
+                    "target_product_id": target,
+                    "type": RecommendationType.CROSS_SELL,
+                    "rank": rank,
+                }
+            )
+        if len(batch) >= 10000:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+    return ids
+
+
+######################################################################
+# REQUESTS
+######################################################################
+def make_request(scenario: str, ids: list, rng: random.Random, args) -> tuple:
+    """Returns (method, path, body, content type) for one request"""
+    if scenario == "create":
+        return "POST", "/recommendations", json.dumps(product_row()), "application/json"
+    if scenario == "bulk_create":
+        body = "\n".join(json.dumps(product_row()) for _ in range(args.bulk_size))
+        return "POST", "/recommendations", body, "application/x-ndjson"
+    if scenario == "list":
+        after = rng.choice(ids)
+        return "GET", "/recommendations?limit=100&after={}".format(after), None, None
+    if scenario == "lookup":
+        return "GET", "/recommendations/{}".format(rng.choice(ids)), None, None
+    if scenario == "batch_lookup":
+        body = json.dumps({"product_ids": rng.sample(ids, args.batch_size), "limit": 10})
+        return "POST", "/recommendations/batch", body, "application/json"
+    raise ValueError("Unknown scenario: " + scenario)
+
+
+class TestClientDriver:
+    """Sends requests through the Flask test client"""
+
+    name = "test_client"
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def send(self, method, path, body, content_type):
+        """Sends a request and returns its status code"""
+        resp = self.client.open(path, method=method, data=body, content_type=content_type)
+        return resp.status_code
+
+
+class HttpDriver:
+    """Sends requests over HTTP to a running server"""
+
+    name = "gunicorn"
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    def send(self, method, path, body, content_type):
+        """Sends a request and returns its status code"""
+        headers = {"Content-Type": content_type} if content_type else {}
+        data = body.encode("utf-8") if body is not None else None
+        request = urllib.request.Request(
+            self.base_url + path, data=data, headers=headers, method=method
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+######################################################################
+# MEASUREMENT
+######################################################################
+def measure(driver, requests: list, concurrency: int) -> dict:
+    """Sends the requests and returns throughput and latency percentiles"""
+
+    def timed(spec):
+        start = time.perf_counter()
+        code = driver.send(*spec)
+        return time.perf_counter() - start, code
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            outcomes = list(pool.map(timed, requests))
+    else:
+        outcomes = [timed(spec) for spec in requests]
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, _ in outcomes]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(requests),
+        "errors": sum(1 for _, code in outcomes if code >= 400),
+        "throughput_rps": round(len(requests) / elapsed, 2),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+    }
+
+
+def run_scenarios(driver, ids: list, args, concurrency: int) -> dict:
+    """Runs every selected scenario with one driver"""
+    results = {}
+    for scenario in args.scenarios:
+        rng = random.Random("{}-{}".format(args.seed, scenario))
+        count = args.bulk_requests if scenario == "bulk_create" else args.requests
+        requests = [make_request(scenario, ids, rng, args) for _ in range(count)]
+        # a short warm-up so connection pools and caches are not measured cold
+        for spec in requests[: max(1, count // 20)]:
+            driver.send(*spec)
+        results[scenario] = measure(driver, requests, concurrency)
+        print(
+            "{:12} {:13} {:>10.1f} req/s  p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms".format(
+                driver.name,
+                scenario,
+                results[scenario]["throughput_rps"],
+                results[scenario]["p50_ms"],
+                results[scenario]["p95_ms"],
+                results[scenario]["p99_ms"],
+            )
+        )
+    return results
+
+
+def start_gunicorn(port: int, workers: int):
+    """Starts gunicorn on the benchmark database and waits until it answers"""
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn",
+            "--bind", "127.0.0.1:{}".format(port),
+            "--workers", str(workers),
+            "--log-level", "warning",
+            "service:app",
+        ],
+        cwd=ROOT,
+        env=dict(os.environ, CACHE_BACKEND=os.getenv("CACHE_BACKEND", "memory")),
+    )
+    base_url = "http://127.0.0.1:{}".format(port)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/recommendations?limit=1", timeout=1).read()
+            return server, base_url
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("gunicorn exited with status {}".format(server.returncode))
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 30 seconds")
+
+
+######################################################################
+# BASELINE COMPARISON
+######################################################################
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Prints the change from the baseline and returns the regressions"""
+    regressions = []
+    for mode, scenarios in results["results"].items():
+        for scenario, current in scenarios.items():
+            previous = baseline.get("results", {}).get(mode, {}).get(scenario)
+            if previous is None:
+                continue
+            p95 = current["p95_ms"] / previous["p95_ms"] - 1
+            rps = current["throughput_rps"] / previous["throughput_rps"] - 1
+            flag = ""
+            if p95 > threshold or rps < -threshold:
+                flag = "  REGRESSION"
+                regressions.append((mode, scenario))
+            print(
+                "{:12} {:13} p95 {:+7.1%}  throughput {:+7.1%}{}".format(
+                    mode, scenario, p95, rps, flag
+                )
+            )
+    return regressions
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Benchmark the recommendation service")
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--links", type=int, default=5, help="recommendations per product")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--bulk-requests", type=int, default=10)
+    parser.add_argument("--bulk-size", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-test-client", action="store_true")
+    parser.add_argument("--no-gunicorn", action="store_true")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--out", default="benchmark-results.json")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as previous:
+            baseline = json.load(previous)
+
+    app.logger.setLevel(logging.CRITICAL)
+    factory.random.reseed_random(args.seed)
+    rng = random.Random(args.seed)
+    ids = seed(args.products, args.links, rng)
+    db.session.remove()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": db.engine.url.drivername,
+            "arguments": {key: value for key, value in vars(args).items() if key != "baseline"},
+        },
+        "results": {},
+    }
+    if not args.no_test_client:
+        results["results"]["test_client"] = run_scenarios(TestClientDriver(), ids, args, 1)
+    if not args.no_gunicorn:
+        db.engine.dispose()
+        server, base_url = start_gunicorn(args.port, args.workers)
+        try:
+            results["results"]["gunicorn"] = run_scenarios(
+                HttpDriver(base_url), ids, args, args.concurrency
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+    with open(args.out, "w") as out:
+        json.dump(results, out, indent=2)
+    print("Results written to {}".format(args.out))
+
+    if baseline is not None and compare(results, baseline, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        main()
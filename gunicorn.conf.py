@@ -0,0 +1,38 @@
+"""
+Gunicorn configuration
+
+Loaded automatically by gunicorn from the working directory. It points the
+Prometheus client at a directory shared by every worker so that /metrics
+can add up the samples of all of them.
+
+Each worker runs GUNICORN_THREADS threads, more than the requests its
+admission control lets run at once (ADMISSION_MAX_CONCURRENCY), so that
+requests beyond those wait in its queue, where they can be ordered and
+shed, rather than in the listen backlog where it cannot see them.
+"""
+import os
+import shutil
+import tempfile
+
+# must be set before prometheus_client is imported anywhere
+os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "recommendations-metrics")
+)
+
+# imported here rather than while a worker exits, which can see it half imported,
+# and after the directory is set, which prometheus_client reads on import
+from prometheus_client import multiprocess  # noqa: E402  # pylint: disable=wrong-import-position
+
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+
+def on_starting(server):
+    """Starts every server with an empty metrics directory"""
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that exited"""
+    multiprocess.mark_process_dead(worker.pid)
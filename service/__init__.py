@@ -14,7 +14,7 @@ app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes, models, error_handlers
+from service import routes, models, error_handlers, metrics, commands, logs
 
 # Set up logging for production
 if __name__ != "__main__":
@@ -28,14 +28,17 @@ if __name__ != "__main__":
     )
     for handler in app.logger.handlers:
         handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
+
+# Queue the records of the app behind a listener thread
+logs.async_logging.init_app(app)
+app.logger.info("Logging handler established")
 
 app.logger.info(70 * "*")
 app.logger.info("  R E C O M M E N D A T I O N   S E R V I C E   R U N N I N G  ".center(70, "*"))
 app.logger.info(70 * "*")
 
 try:
-    routes.init_db()  # make our sqlalchemy tables
+    routes.init_db()  # set up our extensions, the database is not touched
 except Exception as error:
     app.logger.critical("%s: Cannot continue", error)
     # gunicorn requires exit code 4 to stop spawning workers when they die
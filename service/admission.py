@@ -0,0 +1,342 @@
+"""
+Admission Control
+
+A WSGI middleware in front of the Flask app that decides, before a request
+runs, whether the worker can answer it in time. When traffic spikes it
+answers the requests it cannot serve with a fast 503 Service Unavailable
+and a Retry-After header, instead of letting every request slow down
+together:
+
+  - at most ADMISSION_MAX_CONCURRENCY requests of a worker run at once,
+    and the endpoints in ADMISSION_ROUTE_LIMITS at most that many each
+  - the others wait in a queue of at most ADMISSION_QUEUE_SIZE requests,
+    in order of priority: reads first, then writes, then the admin routes
+    of the jobs. A request that finds the queue full takes the place of
+    the last waiting request of a lower priority, or is turned away
+  - a request is dropped once it has waited ADMISSION_MAX_WAIT seconds,
+    counted from its X-Request-Start header when the router sets one, so
+    time spent in the router and in gunicorn's backlog counts too and a
+    request whose client has likely given up is not served late
+
+The health checks and /metrics are never limited, nor are requests that
+match no route. The middleware needs the requests to reach it, so the
+worker runs threads (see gunicorn.conf.py) beyond the ones it admits. In
+the async mode the lookups answered on the event loop are not limited;
+the requests it hands to Flask are.
+
+The requests running and waiting and the ones shed by class and reason
+are exported by /metrics.
+"""
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import RequestRedirect
+
+from service import status
+
+logger = logging.getLogger("flask.app")
+
+# Classes of requests, in order of priority
+READ, WRITE, ADMIN = "read", "write", "admin"
+PRIORITIES = {READ: 0, WRITE: 1, ADMIN: 2}
+
+WRITE_ENDPOINTS = {"create_products", "create_recommendations", "record_events"}
+ADMIN_ENDPOINTS = {"create_job", "list_jobs", "get_job", "cancel_job", "resume_job"}
+EXEMPT_ENDPOINTS = {"health", "ready", "metrics", "static"}
+
+SHED_REASONS = ("queue_full", "evicted", "deadline")
+
+# Callbacks run when a request is admitted, called as callback(class,
+# seconds) with the class of the request and the time it waited
+admission_listeners = []
+
+
+def request_class(endpoint: str) -> str:
+    """Returns the class of the requests of an endpoint"""
+    if endpoint in WRITE_ENDPOINTS:
+        return WRITE
+    if endpoint in ADMIN_ENDPOINTS:
+        return ADMIN
+    return READ
+
+
+def queued_for(environ) -> float:
+    """
+    Returns the seconds a request spent before the worker, from the
+    X-Request-Start header in seconds, milliseconds or microseconds since
+    the epoch, with or without a "t=" prefix, or 0 without one
+    """
+    value = environ.get("HTTP_X_REQUEST_START", "").strip()
+    if value.startswith("t="):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return 0.0
+    while started > 1e11:
+        started /= 1000
+    return max(0.0, time.time() - started)
+
+
+class AdmissionControl:
+    """
+    Admits, queues or sheds the requests of this worker
+    """
+
+    class Waiter:  # pylint: disable=too-few-public-methods
+        """A request waiting to run"""
+
+        def __init__(self, endpoint: str, rec_class: str, deadline: float):
+            self.endpoint = endpoint
+            self.rec_class = rec_class
+            self.deadline = deadline
+            self.event = threading.Event()
+            self.admitted = False
+            self.shed = None
+
+    class Body:
+        """
+        The streamed body of an admitted request, which holds its slot until
+        it is sent, closed or dropped, as not every server closes it
+        """
+
+        def __init__(self, body, release):
+            self._body = body
+            self._iter = iter(body)
+            self._release = release
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            try:
+                return next(self._iter)
+            except StopIteration:
+                self.close()
+                raise
+
+        def close(self):
+            """Closes the body and frees its slot once"""
+            release, self._release = self._release, None
+            if release is None:
+                return
+            try:
+                if hasattr(self._body, "close"):
+                    self._body.close()
+            finally:
+                release()
+
+        def __del__(self):
+            self.close()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiting = []  # heap of (priority, arrival, Waiter)
+        self._arrivals = itertools.count()
+        self._running = 0
+        self._route_running = {}
+        self.app = None
+        self.wsgi_app = None
+        self.enabled = True
+        self.max_concurrency = 8
+        self.route_limits = {}
+        self.queue_size = 8
+        self.max_wait = 1.0
+        self.retry_after = 1
+        self.admitted = dict.fromkeys(PRIORITIES, 0)
+        self.shed = {(rec_class, reason): 0 for rec_class in PRIORITIES for reason in SHED_REASONS}
+
+    def init_app(self, app):
+        """Reads the limits from the app configuration and wraps its WSGI app once"""
+        config = app.config
+        self.app = app
+        self.enabled = config["ADMISSION_ENABLED"]
+        self.max_concurrency = config["ADMISSION_MAX_CONCURRENCY"]
+        self.route_limits = dict(config["ADMISSION_ROUTE_LIMITS"])
+        self.queue_size = config["ADMISSION_QUEUE_SIZE"]
+        self.max_wait = config["ADMISSION_MAX_WAIT"]
+        self.retry_after = config["ADMISSION_RETRY_AFTER"]
+        if app.wsgi_app is not self:
+            self.wsgi_app = app.wsgi_app
+            app.wsgi_app = self
+
+    def __call__(self, environ, start_response):
+        endpoint = self.endpoint(environ) if self.enabled else None
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS:
+            return self.wsgi_app(environ, start_response)
+        rec_class = request_class(endpoint)
+        reason = self.acquire(endpoint, rec_class, queued_for(environ))
+        if reason is not None:
+            return self.unavailable(environ, start_response, endpoint, reason)
+        streamed = []
+
+        def start(status_line, headers, exc_info=None):
+            streamed.append(not any(name.lower() == "content-length" for name, _ in headers))
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, start)
+        except BaseException:
+            self.release(endpoint)
+            raise
+        if streamed and not streamed[-1]:
+            # the answer was computed, sending its bytes needs no slot
+            self.release(endpoint)
+            return body
+        return self.Body(body, lambda: self.release(endpoint))
+
+    def endpoint(self, environ) -> str:
+        """Returns the endpoint a request is routed to, or None"""
+        try:
+            rule, _ = self.app.url_map.bind_to_environ(environ).match(return_rule=True)
+        except (HTTPException, RequestRedirect):
+            return None
+        return rule.endpoint
+
+    def acquire(self, endpoint: str, rec_class: str, queued: float = 0.0) -> str:
+        """
+        Waits for a request to be admitted, returning None once it may run
+        or the reason it was shed
+        """
+        start = time.monotonic()
+        deadline = start - queued + self.max_wait
+        with self._lock:
+            if deadline <= start:
+                return self._count_shed(rec_class, "deadline")
+            if not self._waiting and self._can_run(endpoint):
+                self._start(endpoint, rec_class)
+                waited = 0.0
+                waiter = None
+            else:
+                waiter = self.Waiter(endpoint, rec_class, deadline)
+                if len(self._waiting) >= self.queue_size and not self._evict(rec_class):
+                    return self._count_shed(rec_class, "queue_full")
+                entry = (PRIORITIES[rec_class], next(self._arrivals), waiter)
+                heapq.heappush(self._waiting, entry)
+                self._dispatch()
+        if waiter is not None:
+            waiter.event.wait(max(0.0, deadline - time.monotonic()))
+            with self._lock:
+                if not waiter.admitted and waiter.shed is None:
+                    self._waiting = [entry for entry in self._waiting if entry[2] is not waiter]
+                    heapq.heapify(self._waiting)
+                    waiter.shed = self._count_shed(rec_class, "deadline")
+            if not waiter.admitted:
+                return waiter.shed
+            waited = time.monotonic() - start
+        for callback in admission_listeners:
+            callback(rec_class, waited)
+        return None
+
+    def release(self, endpoint: str):
+        """Frees the slot of a request that ended and admits the next ones"""
+        with self._lock:
+            self._running -= 1
+            self._route_running[endpoint] -= 1
+            self._dispatch()
+
+    def _can_run(self, endpoint: str) -> bool:
+        """True if a request of an endpoint may start now, the lock must be held"""
+        if self._running >= self.max_concurrency:
+            return False
+        limit = self.route_limits.get(endpoint)
+        return limit is None or self._route_running.get(endpoint, 0) < limit
+
+    def _start(self, endpoint: str, rec_class: str):
+        """Counts a request as running, the lock must be held"""
+        self._running += 1
+        self._route_running[endpoint] = self._route_running.get(endpoint, 0) + 1
+        self.admitted[rec_class] += 1
+
+    def _dispatch(self):
+        """
+        Admits the waiting requests that may run, highest priority first,
+        and drops the ones past their deadline, the lock must be held
+        """
+        if self._running >= self.max_concurrency or not self._waiting:
+            return
+        now = time.monotonic()
+        kept = []
+        for entry in sorted(self._waiting):
+            waiter = entry[2]
+            if waiter.deadline <= now:
+                waiter.shed = self._count_shed(waiter.rec_class, "deadline")
+                waiter.event.set()
+            elif self._can_run(waiter.endpoint):
+                self._start(waiter.endpoint, waiter.rec_class)
+                waiter.admitted = True
+                waiter.event.set()
+            else:
+                kept.append(entry)
+        heapq.heapify(kept)
+        self._waiting = kept
+
+    def _evict(self, rec_class: str) -> bool:
+        """
+        Sheds the last waiting request of a lower priority than rec_class
+        to make room, returning False if there is none, the lock must be held
+        """
+        if not self._waiting:
+            return False
+        lowest = max(self._waiting)
+        if lowest[0] <= PRIORITIES[rec_class]:
+            return False
+        self._waiting.remove(lowest)
+        heapq.heapify(self._waiting)
+        waiter = lowest[2]
+        waiter.shed = self._count_shed(waiter.rec_class, "evicted")
+        waiter.event.set()
+        return True
+
+    def _count_shed(self, rec_class: str, reason: str) -> str:
+        """Counts a request shed and returns the reason"""
+        self.shed[(rec_class, reason)] += 1
+        return reason
+
+    def unavailable(self, environ, start_response, endpoint: str, reason: str):
+        """Answers a request that was shed with 503_SERVICE_UNAVAILABLE"""
+        logger.debug(
+            "Shed %s %s (%s): %s",
+            environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"), endpoint, reason,
+        )
+        body = json.dumps(
+            {
+                "status": status.HTTP_503_SERVICE_UNAVAILABLE,
+                "error": "Service Unavailable",
+                "message": "The server is overloaded ({}), retry later".format(reason),
+            }
+        ).encode("utf-8")
+        start_response(
+            "503 SERVICE UNAVAILABLE",
+            [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(body))),
+                ("Retry-After", str(self.retry_after)),
+            ],
+        )
+        return [body]
+
+    def stats(self) -> dict:
+        """
+        Returns the requests running and waiting, the ones admitted by class
+        and the ones shed by class and reason
+        """
+        with self._lock:
+            waiting = dict.fromkeys(PRIORITIES, 0)
+            for _, _, waiter in self._waiting:
+                waiting[waiter.rec_class] += 1
+            return {
+                "running": self._running,
+                "waiting": waiting,
+                "admitted": dict(self.admitted),
+                "shed": dict(self.shed),
+            }
+
+
+# The admission control of this worker
+admission_control = AdmissionControl()
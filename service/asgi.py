@@ -0,0 +1,335 @@
+"""
+Asynchronous Serving Mode
+
+An ASGI entry point for serving the same API from an event loop:
+
+  uvicorn --workers 4 service.asgi:application
+
+The single and batch recommendation lookups, which are most of the
+traffic, are answered on the event loop. Their queries run through an
+async SQLAlchemy engine, asyncpg for PostgreSQL and aiosqlite for SQLite,
+each on a pooled connection. A lookup reads the product row, with the
+version its ETag is made of, and only then its links, as the Flask route
+does, so a write landing between the two reads makes the ETag older than
+the links rather than newer. A batch reads the versions first as well,
+then splits the products the snapshot cannot answer into chunks of
+ASYNC_BATCH_CHUNK ids and queries them side by side, at most
+ASYNC_CONCURRENCY at once per request. The cache, with coalescing of
+identical lookups, and the snapshot are consulted first as in the sync
+routes. Their calls that block on I/O, a Redis round trip or a read of the
+snapshot file, run on threads of the default executor.
+
+Responses carry the same ETag and Cache-Control as the Flask ones.
+Every other request, and every request the async path cannot answer such
+as a bad parameter, an unknown product, an ?order=ctr or a conditional
+lookup with If-None-Match, is handed to the Flask app on a thread of the
+default executor. So the routes, the errors
+and the responses are the same in both modes.
+"""
+import asyncio
+import json
+import re
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import g
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException, NotFound
+
+from service import app, fastjson, status
+from service.cache import recommendation_cache
+from service.metrics import REQUEST_COUNT, REQUEST_LATENCY, REQUEST_QUERIES, update_gauges
+from service.models import (
+    QUEUE_POOL_OPTIONS,
+    DataValidationError,
+    Product,
+    Recommendation,
+    RecommendationType,
+)
+from service.routes import batch_etag, lookup_etag, validate_batch
+from service.snapshot import recommendation_snapshot
+
+LOOKUP_PATH = re.compile(r"^/recommendations/(\d+)$")
+LOOKUP_ROUTE = "/recommendations/<int:item_id>"
+BATCH_PATH = "/recommendations/batch"
+
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(config):
+    """
+    Returns the URL the async engine connects to: ASYNC_DATABASE_URI, or
+    else the replica or the primary database with its async driver
+    """
+    if config.get("ASYNC_DATABASE_URI"):
+        return make_url(config["ASYNC_DATABASE_URI"])
+    uri = (config.get("SQLALCHEMY_BINDS") or {}).get("replica")
+    url = make_url(uri or config["SQLALCHEMY_DATABASE_URI"])
+    backend = url.drivername.split("+")[0]
+    return url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+
+
+class ThreadedWsgiInstance(WsgiToAsgiInstance):
+    """Runs each WSGI request on an executor thread rather than one shared thread"""
+
+    run_wsgi_app = sync_to_async(
+        WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False
+    )
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """Serves a WSGI app from ASGI with requests running in parallel"""
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(
+            scope, receive, send
+        )
+
+
+class AsyncService:
+    """
+    The ASGI application: lookups on the event loop, the rest through Flask
+    """
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+        self.wsgi = ThreadedWsgiToAsgi(flask_app)
+        self.engine = None
+        self._loop = None
+
+    def get_engine(self):
+        """Returns the async engine, created on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self.engine is None or self._loop is not loop:
+            url = async_url(self.app.config)
+            options = dict(self.app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+            if url.drivername.startswith("sqlite"):
+                for option in QUEUE_POOL_OPTIONS:
+                    options.pop(option, None)
+            # connections belong to the loop that opened them
+            self.engine = create_async_engine(url, **options)
+            self._loop = loop
+        return self.engine
+
+    async def dispose(self):
+        """Closes the connections of the async engine"""
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        handler = self.route(scope) if scope["type"] == "http" else None
+        if handler is not None:
+            body = await read_body(receive)
+            if await self.serve(handler, scope, body, send):
+                return
+            receive = replay(body, receive)
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Answers the startup and shutdown events of the server"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def route(self, scope):
+        """Returns the coroutine function that answers a request, or None"""
+        method, path = scope["method"], scope["path"]
+        if path == BATCH_PATH and method in ("GET", "POST"):
+            return self.get_recommendations_batch
+        if method == "GET" and LOOKUP_PATH.match(path):
+            return self.get_products
+        return None
+
+    async def serve(self, handler, scope, body: bytes, send) -> bool:
+        """
+        Runs a handler and sends its JSON response, returning False when it
+        cannot answer and the request goes to Flask
+        """
+        start = time.perf_counter()
+        with self.app.app_context():
+            g.queries = 0
+            try:
+                args = parse_qs(scope["query_string"].decode("latin1"), keep_blank_values=True)
+                result = await handler(scope, args, body)
+            except (HTTPException, DataValidationError, ValueError):
+                result = None
+            if result is None:
+                return False
+            route, data, tag = result
+            payload = fastjson.dumps(data)
+            headers = [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(payload)).encode("latin1")),
+            ]
+            if tag is not None:
+                headers.append((b"etag", '"{}"'.format(tag).encode("latin1")))
+            cache_control = self.app.config["HTTP_CACHE_CONTROL"].get(handler.__name__)
+            if cache_control and scope["method"] == "GET":
+                headers.append((b"cache-control", cache_control.encode("latin1")))
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status.HTTP_200_OK,
+                    "headers": headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": payload})
+            REQUEST_LATENCY.labels(scope["method"], route).observe(time.perf_counter() - start)
+            REQUEST_COUNT.labels(scope["method"], route, status.HTTP_200_OK).inc()
+            REQUEST_QUERIES.labels(scope["method"], route).observe(g.queries)
+            update_gauges()
+        return True
+
+    async def get_products(self, scope, args: dict, body: bytes):
+        """Answers GET /recommendations/<id> without ?depth= or ?path="""
+        if "depth" in args or "path" in args or "order" in args:
+            return None
+        if header(scope, b"if-none-match") is not None:
+            return None
+        item_id = int(LOOKUP_PATH.match(scope["path"]).group(1))
+        rec_type = args.get("type", [None])[0]
+        if rec_type is not None:
+            rec_type = RecommendationType.parse(rec_type)
+        engine = self.get_engine()
+
+        async def lookup():
+            message = await snapshot_call(recommendation_snapshot.lookup, item_id, rec_type)
+            if message is not None:
+                return message
+            # the version before the links, for the ETag
+            row = await fetch(engine, Product.find_row_statement(item_id))
+            message = Product.row_dict(row[0] if row else None)
+            if message is None:
+                raise NotFound("Product with id '{}' was not found.".format(item_id))
+            links = await fetch(engine, Recommendation.lookup_statement(item_id, rec_type))
+            message["recommendations"] = Recommendation.link_dicts(links)
+            return message
+
+        message = await recommendation_cache.get_or_compute_async(item_id, rec_type, lookup)
+        return LOOKUP_ROUTE, message, lookup_etag(item_id, message["version"], rec_type)
+
+    async def get_recommendations_batch(self, scope, args: dict, body: bytes):
+        """
+        Answers GET and POST /recommendations/batch
+
+        A GET reads the versions of the products the snapshot cannot answer
+        before their links, for its ETag.
+        """
+        if scope["method"] == "POST":
+            if header(scope, b"content-type") != "application/json":
+                return None
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                return None
+            product_ids = data.get("product_ids")
+            rec_types = data.get("types") or []
+            limit = data.get("limit")
+            if data.get("order") is not None:
+                return None
+        else:
+            product_ids = [int(value) for value in args.get("product_id", [])]
+            rec_types = args.get("type", [])
+            limit = int(args["limit"][0]) if "limit" in args else None
+            if "order" in args:
+                return None
+            if header(scope, b"if-none-match") is not None:
+                return None
+        product_ids, rec_types, limit = validate_batch(product_ids, rec_types, limit)
+
+        versions = {} if scope["method"] == "GET" else None
+        found = await snapshot_call(
+            recommendation_snapshot.lookup_many, product_ids, rec_types, limit, versions
+        )
+        missing = [product_id for product_id in product_ids if product_id not in found]
+        if missing:
+            engine = self.get_engine()
+            if versions is not None:
+                versions.update(await fetch(engine, Product.versions_statement(missing)))
+            chunk = self.app.config["ASYNC_BATCH_CHUNK"]
+            semaphore = asyncio.Semaphore(self.app.config["ASYNC_CONCURRENCY"])
+
+            async def lookup_chunk(chunk_ids):
+                statement = Recommendation.lookup_many_statement(chunk_ids, rec_types, limit)
+                async with semaphore:
+                    rows = await fetch(engine, statement)
+                return Recommendation.grouped_link_dicts(chunk_ids, rows)
+
+            for results in await asyncio.gather(
+                *(lookup_chunk(missing[i:i + chunk]) for i in range(0, len(missing), chunk))
+            ):
+                found.update(results)
+        results = [
+            {"product_id": product_id, "recommendations": found[product_id]}
+            for product_id in product_ids
+        ]
+        tag = None if versions is None else batch_etag(product_ids, versions, rec_types, limit)
+        return BATCH_PATH, results, tag
+
+
+async def snapshot_call(func, *args):
+    """
+    Awaits a snapshot read, on a thread of the default executor when a
+    snapshot is configured, as it reads and reopens the file
+    """
+    if recommendation_snapshot.path is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def fetch(engine, statement) -> list:
+    """Runs a SELECT on a connection of its own and returns its rows"""
+    async with engine.connect() as conn:
+        result = await conn.execute(statement)
+        return result.all()
+
+
+async def read_body(receive) -> bytes:
+    """Reads the whole body of an HTTP request"""
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def replay(body: bytes, receive):
+    """Returns a receive callable that yields a body already read, then receive's messages"""
+    sent = False
+
+    async def replayed():
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return replayed
+
+
+def header(scope, name: bytes) -> str:
+    """Returns the value of a request header or None"""
+    for key, value in scope["headers"]:
+        if key.lower() == name:
+            return value.decode("latin1")
+    return None
+
+
+# The ASGI application of this worker
+application = AsyncService(app)
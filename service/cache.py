@@ -0,0 +1,515 @@
+"""
+Recommendation Cache
+
+A read-through cache in front of the recommendation lookups. Entries are
+tagged with the products they were built from: "p:<id>" for the product
+whose recommendations they hold and "t:<id>" for every target product in
+them. Writes invalidate exactly the entries that carry the tags of the
+products they touch:
+
+* updating or deleting a product drops its own entries and every entry
+  that lists it as a target
+* writing recommendations drops the entries of their source products
+
+Concurrent lookups of the same key are coalesced: one request of the
+worker computes the value and the others wait for it instead of running
+the same queries. Entries are also refreshed early, with a probability that
+grows as they near their expiry and with how long they took to compute,
+so that a hot key is recomputed by a single request before it expires
+instead of by every request after it expires.
+
+Two backends are available. The memory backend is a bounded LRU with a
+TTL that lives in each worker, so a worker only sees its own invalidations
+and the others catch up when their entries expire. The redis backend is
+shared by every worker, so they all see every invalidation; its size is
+bounded by the server's maxmemory and allkeys-lru eviction policy.
+"""
+import asyncio
+import json
+import logging
+import math
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from service.models import product_listeners, recommendation_listeners
+
+logger = logging.getLogger("flask.app")
+
+
+class MemoryCache:
+    """
+    An in-process LRU cache with a time to live and tag invalidation
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires at, value, tags, delta)
+        self._tags = {}  # tag -> set of keys
+        self._generation = 0  # counts the invalidations
+        self._invalidated = OrderedDict()  # tag -> generation it was last invalidated at
+        self._forgotten = 0  # the latest generation dropped from _invalidated
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        """Returns the cached value of a key or None"""
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def generation(self) -> int:
+        """Returns the current invalidation generation, to pass to set()"""
+        return self._generation
+
+    def get_entry(self, key: str):
+        """
+        Returns (value, seconds to live, seconds it took to compute) of a
+        key or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            remaining = entry[0] - time.monotonic()
+            if remaining < 0:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], remaining, entry[3]
+
+    def set(self, key: str, value, tags=(), delta: float = 0, generation: int = None) -> bool:
+        """
+        Caches a value under a key, evicting the least recently used
+
+        A value computed since generation is not cached if one of its tags
+        was invalidated meanwhile, as it may have been read before the
+        write. Returns True if the value was cached.
+        """
+        with self._lock:
+            if generation is not None and (
+                generation < self._forgotten
+                or any(self._invalidated.get(tag, 0) > generation for tag in tags)
+            ):
+                return False
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags), delta)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def invalidate(self, tags):
+        """Drops every entry that carries one of the tags"""
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = self._generation
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+            # the oldest are forgotten, and values computed before them are not cached
+            while len(self._invalidated) > self.max_entries:
+                _, self._forgotten = self._invalidated.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._forgotten = self._generation
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        return {
+            "backend": "memory",
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, key: str):
+        """Removes a key and its tags, the lock must be held"""
+        _, _, tags, _ = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisCache:
+    """
+    A cache shared by every worker through Redis
+
+    Values are stored as JSON with a TTL, next to the time they took to
+    compute, and each tag is a Redis set of the keys that carry it. An
+    invalidation also counts up a shared generation and records it under
+    the tag, or under "*" for a clear, for one TTL. Hit and miss counters
+    are kept per worker.
+    """
+
+    # every call is a round trip to the server
+    blocking = True
+
+    def __init__(self, client, ttl: float = 60, prefix: str = "recommendations:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        """Returns the cached value of a key or None"""
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key: str):
+        """
+        Returns (value, seconds to live, seconds it took to compute) of a
+        key or None
+        """
+        pipe = self.client.pipeline()
+        pipe.get(self.prefix + key)
+        pipe.pttl(self.prefix + key)
+        data, remaining = pipe.execute()
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = json.loads(data)
+        return entry["value"], max(remaining, 0) / 1000, entry["delta"]
+
+    def generation(self) -> int:
+        """Returns the current invalidation generation, to pass to set()"""
+        return int(self.client.get(self.prefix + "generation") or 0)
+
+    def set(self, key: str, value, tags=(), delta: float = 0, generation: int = None) -> bool:
+        """
+        Caches a value under a key, unless it was computed since generation
+        and one of its tags was invalidated meanwhile by any worker.
+        Returns True if the value was cached.
+        """
+        from redis.exceptions import WatchError  # pylint: disable=import-outside-toplevel
+
+        ttl = max(1, int(self.ttl))
+        with self.client.pipeline() as pipe:
+            try:
+                if generation is not None:
+                    # an invalidation between this check and the write aborts it
+                    seen = [self.prefix + "generation:" + tag for tag in ("*",) + tuple(tags)]
+                    pipe.watch(*seen)
+                    if any(int(gen) > generation for gen in pipe.mget(seen) if gen is not None):
+                        return False
+                    pipe.multi()
+                pipe.set(self.prefix + key, json.dumps({"value": value, "delta": delta}), ex=ttl)
+                for tag in tags:
+                    pipe.sadd(self.prefix + "tag:" + tag, key)
+                    # a tag outlives its keys by one TTL at most
+                    pipe.expire(self.prefix + "tag:" + tag, ttl)
+                pipe.execute()
+            except WatchError:
+                return False
+        return True
+
+    def _record_invalidation(self, tags):
+        """Records the next generation under each tag for one TTL"""
+        generation = self.client.incr(self.prefix + "generation")
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.set(self.prefix + "generation:" + tag, generation, ex=max(1, int(self.ttl)))
+        pipe.execute()
+
+    def invalidate(self, tags):
+        """Drops every entry that carries one of the tags"""
+        tags = list(tags)
+        self._record_invalidation(tags)
+        for tag in tags:
+            tag_key = self.prefix + "tag:" + tag
+            keys = self.client.smembers(tag_key)
+            pipe = self.client.pipeline()
+            for key in keys:
+                pipe.delete(self.prefix + key.decode())
+            pipe.delete(tag_key)
+            pipe.execute()
+            self.invalidations += len(keys)
+
+    def clear(self):
+        """Drops every entry"""
+        self._record_invalidation(["*"])
+        kept = {
+            (self.prefix + name).encode() for name in ("generation", "generation:*")
+        }
+        keys = [key for key in self.client.scan_iter(match=self.prefix + "*") if key not in kept]
+        if keys:
+            self.client.delete(*keys)
+        self.invalidations += len(keys)
+
+    def ping(self):
+        """Raises an error if Redis cannot be reached"""
+        self.client.ping()
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        return {
+            "backend": "redis",
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time, sharing its outcome with every
+    caller that asks for the same key while it runs
+    """
+
+    class Call:  # pylint: disable=too-few-public-methods
+        """A computation in flight"""
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.computations = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """Returns func(), or the outcome of the call already running for key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+                self.computations += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, func):
+        """
+        Awaits func(), or the task already running for key on the event loop
+
+        The task is shielded so that a caller going away does not cancel
+        it for the others.
+        """
+        task = self._tasks.get(key)
+        with self._lock:
+            if task is None:
+                self.computations += 1
+            else:
+                self.coalesced += 1
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(func())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
+
+
+class RecommendationCache:
+    """
+    The cache of recommendation lookups, configured from the Flask app
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.flight = SingleFlight()
+        self.beta = 1.0
+        self.early_refreshes = 0
+
+    def init_app(self, app):
+        """Creates the backend selected by the app configuration"""
+        config = app.config
+        self.flight = SingleFlight()
+        self.beta = config["CACHE_EARLY_REFRESH_BETA"]
+        self.early_refreshes = 0
+        if not config["CACHE_ENABLED"]:
+            self.backend = None
+        elif config["CACHE_BACKEND"] == "redis":
+            import redis  # pylint: disable=import-outside-toplevel
+
+            client = redis.Redis.from_url(config["CACHE_REDIS_URL"])
+            self.backend = RedisCache(client, config["CACHE_TTL"])
+        else:
+            self.backend = MemoryCache(config["CACHE_MAX_ENTRIES"], config["CACHE_TTL"])
+        logger.info(
+            "Recommendation cache: %s", config["CACHE_BACKEND"] if self.backend else "off"
+        )
+
+    @staticmethod
+    def key(product_id: int, rec_type=None) -> str:
+        """Returns the cache key of a lookup"""
+        return "{}:{}".format(product_id, rec_type.value if rec_type else "all")
+
+    def get(self, product_id: int, rec_type=None):
+        """Returns a cached lookup or None"""
+        if self.backend is None:
+            return None
+        return self.backend.get(self.key(product_id, rec_type))
+
+    def generation(self):
+        """Returns the invalidation generation of the backend, or None"""
+        return None if self.backend is None else self.backend.generation()
+
+    def set(self, product_id: int, rec_type, message: dict, delta: float = 0, generation=None):
+        """
+        Caches the lookup of a product that took delta seconds to compute,
+        unless a product in it was invalidated since generation
+        """
+        if self.backend is None:
+            return
+        tags = ["p:{}".format(product_id)]
+        tags.extend("t:{}".format(rec["product_id"]) for rec in message["recommendations"])
+        if not self.backend.set(self.key(product_id, rec_type), message, tags, delta, generation):
+            logger.debug("Lookup %s changed while computed, not cached", product_id)
+
+    def refresh_early(self, remaining: float, delta: float) -> bool:
+        """
+        Decides at random to recompute an entry before it expires
+
+        An entry that took delta seconds to compute is refreshed with a
+        probability that reaches 1 as its remaining time nears beta * delta.
+        """
+        if self.beta <= 0 or delta <= 0:
+            return False
+        return -delta * self.beta * math.log(1.0 - random.random()) >= remaining
+
+    def get_or_compute(self, product_id: int, rec_type, compute) -> dict:
+        """
+        Returns the cached lookup of a product or computes and caches it
+
+        Concurrent misses of the same lookup run compute() once and share
+        its result, and an entry close to its expiry may be recomputed by
+        one caller while the others are still served from the cache.
+        """
+        key = self.key(product_id, rec_type)
+        message = self._get_fresh(key)
+        if message is not None:
+            return message
+
+        def compute_and_set():
+            # a write invalidating the lookup while it is computed keeps it out
+            generation = self.generation()
+            start = time.perf_counter()
+            message = compute()
+            self.set(product_id, rec_type, message, time.perf_counter() - start, generation)
+            return message
+
+        return self.flight.do(key, compute_and_set)
+
+    async def get_or_compute_async(self, product_id: int, rec_type, compute) -> dict:
+        """
+        Like get_or_compute() for a coroutine function compute
+
+        The calls of a backend that blocks on the network run on a thread
+        of the default executor, so a Redis round trip does not stall the
+        other requests of the event loop.
+        """
+        key = self.key(product_id, rec_type)
+        message = await self._off_loop(self._get_fresh, key)
+        if message is not None:
+            return message
+
+        async def compute_and_set():
+            generation = await self._off_loop(self.generation)
+            start = time.perf_counter()
+            message = await compute()
+            delta = time.perf_counter() - start
+            await self._off_loop(self.set, product_id, rec_type, message, delta, generation)
+            return message
+
+        return await self.flight.do_async(key, compute_and_set)
+
+    async def _off_loop(self, func, *args):
+        """Awaits func(*args), on an executor thread when the backend blocks"""
+        if not getattr(self.backend, "blocking", False):
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _get_fresh(self, key: str):
+        """Returns a cached value unless it is missing or picked to refresh"""
+        if self.backend is None:
+            return None
+        entry = self.backend.get_entry(key)
+        if entry is None:
+            return None
+        value, remaining, delta = entry
+        if not self.refresh_early(remaining, delta):
+            return value
+        self.early_refreshes += 1
+        return None
+
+    def on_product_change(self, action: str, product):
+        """Product listener that drops the lookups showing the product"""
+        if self.backend is None or action not in ("update", "delete"):
+            return
+        self.backend.invalidate(["p:{}".format(product.id), "t:{}".format(product.id)])
+
+    def on_recommendation_change(self, source_ids):
+        """Recommendation listener that drops the lookups of the sources"""
+        if self.backend is None:
+            return
+        if source_ids is None:
+            self.backend.clear()
+        else:
+            self.backend.invalidate(["p:{}".format(source) for source in source_ids])
+
+    def ping(self):
+        """Raises an error if a shared backend cannot be reached"""
+        if hasattr(self.backend, "ping"):
+            self.backend.ping()
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the cache, with the lookups computed, those
+        that waited for a computation already running instead (the queries
+        saved) and the entries refreshed early
+        """
+        stats = {"backend": "off"} if self.backend is None else self.backend.stats()
+        stats["computations"] = self.flight.computations
+        stats["coalesced"] = self.flight.coalesced
+        stats["early_refreshes"] = self.early_refreshes
+        return stats
+
+
+# The cache shared by every request of this worker
+recommendation_cache = RecommendationCache()
+product_listeners.append(recommendation_cache.on_product_change)
+recommendation_listeners.append(recommendation_cache.on_recommendation_change)
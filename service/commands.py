@@ -0,0 +1,55 @@
+"""
+Module: commands
+
+Flask CLI commands that manage the database. Workers never create the
+schema themselves, so run this once per deploy before they start:
+
+  FLASK_APP=service:app flask db-create
+
+Publish a new recommendation snapshot for the workers to serve with:
+
+  FLASK_APP=service:app flask snapshot-export
+
+Run the jobs queued through /recommendations/jobs with:
+
+  FLASK_APP=service:app flask jobs-run
+"""
+import click
+
+from service import jobs, snapshot
+from service.models import db
+from . import app
+
+
+@app.cli.command("db-create")
+@click.option("--drop", is_flag=True, help="drop the existing tables first")
+def db_create(drop):
+    """Creates the database tables"""
+    if drop:
+        db.drop_all()
+    db.create_all()
+    click.echo("Created the database tables")
+
+
+@app.cli.command("snapshot-export")
+@click.option("--path", help="where to write it, SNAPSHOT_PATH by default")
+def snapshot_export(path):
+    """Publishes a snapshot of the recommendations for the workers"""
+    path = path or app.config["SNAPSHOT_PATH"]
+    if not path:
+        raise click.UsageError("Set SNAPSHOT_PATH or pass --path")
+    version = snapshot.export(path)
+    click.echo("Published snapshot {} to {}".format(version, path))
+
+
+@app.cli.command("jobs-run")
+@click.option("--workers", type=int, help="processes per job, JOBS_WORKERS by default")
+@click.option("--once", is_flag=True, help="run the oldest queued job and exit")
+def jobs_run(workers, once):
+    """Runs the queued background jobs"""
+    runner = jobs.JobRunner(workers)
+    if once:
+        job = runner.run_once()
+        click.echo("Job {} {}".format(job.id, job.status.value) if job else "No queued jobs")
+        return
+    runner.run_forever(app.config["JOBS_POLL_INTERVAL"])
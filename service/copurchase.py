@@ -0,0 +1,492 @@
+"""
+Co-purchase Recommendations
+
+Builds "customers who bought A also bought B" recommendations from an
+order-line log. The log is read in chunks, each chunk is turned into a
+sparse order x product incidence matrix X, and X.T @ X is added into a
+sparse product x product co-occurrence matrix. The pairs are then scored
+and the top K targets of every product are written to the recommendations
+table as CROSS_SELL links.
+
+The log is a CSV file with order_id and product_id columns or an NDJSON
+file with the same keys. Order ids are integers that grow over time and
+all of the lines of an order must be adjacent, which is how order exports
+are normally sorted, so that chunks can be cut on order boundaries and
+memory stays bounded by the chunk size.
+
+A full build also stores the pair counts and the highest order id it
+counted (the watermark). An incremental update then only reads the orders
+after the watermark, adds their counts to the stored ones and re-ranks the
+products that appear in those orders. The lists of their partners are
+refreshed by the next full build.
+
+Run it with:
+  python -m service.copurchase orders.csv --top-k 10 --method lift
+  python -m service.copurchase orders.csv --incremental
+"""
+import argparse
+import csv
+import json
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from service import app
+from service.models import (
+    CoPurchaseCount,
+    CoPurchaseWatermark,
+    Product,
+    Recommendation,
+    RecommendationType,
+    db,
+    increment_statement,
+    notify_recommendation_listeners,
+)
+
+logger = logging.getLogger("flask.app")
+
+SCORING_METHODS = ("lift", "cosine")
+
+# the origin of the links this module computes
+ORIGIN = "copurchase"
+
+
+def read_order_lines(path: str, chunk_lines: int = 1000000, after: int = None):
+    """
+    Yields lists of (order_id, product_id) tuples from an order-line log
+
+    A chunk is closed at the first order boundary after chunk_lines lines,
+    so an order is never split across two chunks. Orders with an id at or
+    below after are skipped.
+    """
+    is_ndjson = path.endswith((".ndjson", ".jsonl"))
+    with open(path, newline="") as log:
+        if is_ndjson:
+            lines = (json.loads(line) for line in log if line.strip())
+        else:
+            lines = csv.DictReader(log)
+        chunk = []
+        last_order = None
+        for line in lines:
+            order_id = int(line["order_id"])
+            if after is not None and order_id <= after:
+                continue
+            if len(chunk) >= chunk_lines and order_id != last_order:
+                yield chunk
+                chunk = []
+            chunk.append((order_id, int(line["product_id"])))
+            last_order = order_id
+        if chunk:
+            yield chunk
+
+
+def incidence_matrix(chunk: list, product_ids: np.ndarray) -> sparse.csr_matrix:
+    """
+    Returns the binary order x product matrix of a chunk of order lines
+
+    Products that are not in product_ids (the sorted catalog) are dropped.
+    """
+    order_index = np.empty(len(chunk), dtype=np.int64)
+    line_products = np.empty(len(chunk), dtype=np.int64)
+    orders = -1
+    last_order = None
+    for i, (order_id, product_id) in enumerate(chunk):
+        if order_id != last_order:
+            orders += 1
+            last_order = order_id
+        order_index[i] = orders
+        line_products[i] = product_id
+
+    columns = np.searchsorted(product_ids, line_products)
+    columns[columns == len(product_ids)] = 0
+    known = product_ids[columns] == line_products if len(product_ids) else columns < 0
+    matrix = sparse.csr_matrix(
+        (np.ones(known.sum(), dtype=np.int32), (order_index[known], columns[known])),
+        shape=(orders + 1, len(product_ids)),
+    )
+    # an order that lists the same product twice still counts it once
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def count_cooccurrences(chunks, product_ids: np.ndarray) -> tuple:
+    """
+    Accumulates co-occurrence counts over chunks of order lines
+
+    Returns:
+        a tuple of (the product x product count matrix, the number of orders)
+        where the diagonal holds the number of orders containing each product
+    """
+    size = len(product_ids)
+    counts = sparse.csr_matrix((size, size), dtype=np.int64)
+    orders = 0
+    for chunk in chunks:
+        matrix = incidence_matrix(chunk, product_ids)
+        orders += matrix.shape[0]
+        counts = counts + (matrix.T @ matrix).astype(np.int64)
+        logger.info("Counted %s order lines, %s orders so far", len(chunk), orders)
+    return counts.tocsr(), orders
+
+
+def score_pairs(
+    counts: sparse.csr_matrix, orders: int, method: str = "lift", min_count: int = 2
+) -> sparse.csr_matrix:
+    """
+    Scores every pair of products bought together at least min_count times
+
+    lift is P(A and B) / (P(A) * P(B)); cosine is count(A, B) divided by
+    sqrt(count(A) * count(B)).
+    """
+    if method not in SCORING_METHODS:
+        raise ValueError("Unknown scoring method: " + method)
+    frequency = counts.diagonal().astype(np.float64)
+    pairs = counts.tocoo()
+    keep = (pairs.row != pairs.col) & (pairs.data >= min_count)
+    rows, cols = pairs.row[keep], pairs.col[keep]
+    together = pairs.data[keep].astype(np.float64)
+    if method == "lift":
+        scores = together * orders / (frequency[rows] * frequency[cols])
+    else:
+        scores = together / np.sqrt(frequency[rows] * frequency[cols])
+    return sparse.csr_matrix((scores, (rows, cols)), shape=counts.shape)
+
+
+def top_k(scores: sparse.csr_matrix, k: int):
+    """Yields (row, target columns, target scores) best first for each row"""
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        if start == end:
+            continue
+        columns = scores.indices[start:end]
+        values = scores.data[start:end]
+        if len(values) > k:
+            best = np.argpartition(-values, k - 1)[:k]
+            columns, values = columns[best], values[best]
+        # ties are broken by the lower target index so runs are repeatable
+        order = np.lexsort((columns, -values))
+        yield row, columns[order], values[order]
+
+
+def write_recommendations(
+    product_ids: np.ndarray,
+    ranked,
+    sources=None,
+    batch_size: int = 1000,
+    rec_type: RecommendationType = RecommendationType.CROSS_SELL,
+    origin: str = ORIGIN,
+) -> int:
+    """
+    Replaces the computed links of a type and origin with the ranked targets
+
+    Args:
+        product_ids: the sorted catalog that the matrix indexes map onto
+        ranked: (row, target columns, target scores) tuples from top_k()
+        sources: the product ids whose links are replaced, or None for all
+        batch_size (int): the number of links inserted per statement
+        rec_type (RecommendationType): the type of the links, CROSS_SELL
+            by default
+        origin (str): the pipeline that computed them, co-purchase by default
+
+    Curated links (the ones without a score) and the links of other origins
+    are kept, and a computed link that would duplicate one is skipped. The
+    stale links are deleted and the new ones inserted in one transaction,
+    so lookups, the cache and snapshot exports see either the old lists or
+    the new ones.
+    """
+    try:
+        written = _replace_links(product_ids, ranked, sources, batch_size, rec_type, origin)
+        # the lookups of the sources only read as changed once every link is in
+        Product.bump_versions(sources)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    notify_recommendation_listeners(sources)
+    return written
+
+
+def _replace_links(product_ids, ranked, sources, batch_size, rec_type, origin) -> int:
+    """Deletes the links of an origin of the sources and inserts the ranked ones, uncommitted"""
+    stale = Recommendation.query.filter(
+        Recommendation.type == rec_type,
+        Recommendation.score.isnot(None),
+        Recommendation.origin == origin,
+    )
+    # what is left is curated or from another origin
+    left = db.session.query(
+        Recommendation.source_product_id, Recommendation.target_product_id
+    ).filter(Recommendation.type == rec_type)
+    if sources is None:
+        stale.delete(synchronize_session=False)
+        kept = set(left)
+    else:
+        kept = set()
+        for start in range(0, len(sources), 1000):
+            chunk = Recommendation.source_product_id.in_(sources[start:start + 1000])
+            stale.filter(chunk).delete(synchronize_session=False)
+            kept.update(left.filter(chunk))
+    table = Recommendation.__table__
+    written = 0
+    batch = []
+    for row, columns, values in ranked:
+        source = int(product_ids[row])
+        rank = 0
+        for column, score in zip(columns, values):
+            target = int(product_ids[column])
+            if (source, target) in kept:
+                continue
+            rank += 1
+            batch.append(
+                {
+                    "source_product_id": source,
+                    "target_product_id": target,
+                    "type": rec_type,
+                    "rank": rank,
+                    "score": float(score),
+                    "origin": origin,
+                }
+            )
+        if len(batch) >= batch_size:
+            db.session.execute(table.insert(), batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        written += len(batch)
+    return written
+
+
+def catalog_ids() -> np.ndarray:
+    """Returns the sorted ids of every Product in the catalog"""
+    ids = [product_id for (product_id,) in db.session.query(Product.id).yield_per(10000)]
+    return np.sort(np.array(ids, dtype=np.int64))
+
+
+def last_order_id(chunks, watermark: CoPurchaseWatermark):
+    """Passes chunks through while moving the watermark to their last order"""
+    for chunk in chunks:
+        watermark.last_order_id = max(watermark.last_order_id, chunk[-1][0])
+        yield chunk
+
+
+def upsert_counts(
+    counts: sparse.spmatrix,
+    product_ids: np.ndarray,
+    replace: bool = False,
+    batch_size: int = 1000,
+):
+    """
+    Adds the upper triangle of a catalog-indexed count matrix into the
+    stored pair counts
+
+    With replace the stored counts are cleared first, otherwise they are
+    incremented with an upsert.
+    """
+    table = CoPurchaseCount.__table__
+    if replace:
+        db.session.execute(table.delete())
+        statement = table.insert()
+    else:
+        statement = _increment_statement(table)
+    pairs = sparse.triu(counts).tocoo()
+    for start in range(0, pairs.nnz, batch_size):
+        end = start + batch_size
+        db.session.execute(
+            statement,
+            [
+                {
+                    "product_a": int(product_ids[a]),
+                    "product_b": int(product_ids[b]),
+                    "count": int(count),
+                }
+                for a, b, count in zip(
+                    pairs.row[start:end], pairs.col[start:end], pairs.data[start:end]
+                )
+            ],
+        )
+    db.session.commit()
+    logger.info("Stored %s co-purchase pair counts", pairs.nnz)
+
+
+def _increment_statement(table):
+    """Returns an INSERT that adds to the count of an existing pair"""
+    return increment_statement(table, [table.c.product_a, table.c.product_b], [table.c.count])
+
+
+def load_counts(sources: list, product_ids: np.ndarray) -> sparse.csr_matrix:
+    """
+    Loads the stored counts of the sources into a catalog-indexed matrix
+
+    Only the rows of the sources are filled in, along with the diagonal of
+    every product they were bought with, which is all score_pairs() needs
+    to score those rows.
+    """
+    rows, cols, data = [], [], []
+    partners = set(sources)
+    for start in range(0, len(sources), 1000):
+        chunk = sources[start:start + 1000]
+        pairs = db.session.query(
+            CoPurchaseCount.product_a, CoPurchaseCount.product_b, CoPurchaseCount.count
+        ).filter(
+            db.or_(
+                CoPurchaseCount.product_a.in_(chunk),
+                CoPurchaseCount.product_b.in_(chunk),
+            )
+        )
+        chunk = set(chunk)
+        for product_a, product_b, count in pairs:
+            if product_a == product_b:
+                continue
+            for source, partner in ((product_a, product_b), (product_b, product_a)):
+                if source in chunk:
+                    rows.append(source)
+                    cols.append(partner)
+                    data.append(count)
+                    partners.add(partner)
+    partners = sorted(partners)
+    for start in range(0, len(partners), 1000):
+        chunk = partners[start:start + 1000]
+        diagonal = db.session.query(
+            CoPurchaseCount.product_a, CoPurchaseCount.count
+        ).filter(
+            CoPurchaseCount.product_a == CoPurchaseCount.product_b,
+            CoPurchaseCount.product_a.in_(chunk),
+        )
+        for product_id, count in diagonal:
+            rows.append(product_id)
+            cols.append(product_id)
+            data.append(count)
+
+    size = len(product_ids)
+    row_index = np.searchsorted(product_ids, np.array(rows, dtype=np.int64))
+    col_index = np.searchsorted(product_ids, np.array(cols, dtype=np.int64))
+    return sparse.csr_matrix(
+        (np.array(data, dtype=np.int64), (row_index, col_index)), shape=(size, size)
+    )
+
+
+def count(path: str, chunk_lines: int = 1000000) -> tuple:
+    """
+    Counts every order of an order-line log and stores the pair counts
+
+    Returns:
+        a tuple of (the count matrix, the number of orders, the catalog)
+    """
+    product_ids = catalog_ids()
+    watermark = CoPurchaseWatermark.get()
+    watermark.last_order_id = 0
+    chunks = last_order_id(read_order_lines(path, chunk_lines), watermark)
+    counts, orders = count_cooccurrences(chunks, product_ids)
+    watermark.orders = orders
+    upsert_counts(counts, product_ids, replace=True)
+    return counts, orders, product_ids
+
+
+def rank(
+    sources: list,
+    product_ids: np.ndarray,
+    orders: int,
+    k: int = 10,
+    method: str = "lift",
+    min_count: int = 2,
+) -> int:
+    """
+    Re-ranks the recommendations of the sources from the stored counts
+
+    Returns:
+        the number of recommendations written
+    """
+    counts = load_counts(sources, product_ids)
+    scores = score_pairs(counts, orders, method, min_count)
+    rows = set(np.searchsorted(product_ids, np.array(sources, dtype=np.int64)).tolist())
+    ranked = (ranking for ranking in top_k(scores, k) if ranking[0] in rows)
+    return write_recommendations(product_ids, ranked, sources)
+
+
+def build(
+    path: str,
+    k: int = 10,
+    method: str = "lift",
+    min_count: int = 2,
+    chunk_lines: int = 1000000,
+) -> int:
+    """
+    Rebuilds every co-purchase recommendation from an order-line log
+
+    Returns:
+        the number of recommendations written
+    """
+    logger.info("Building co-purchase recommendations from %s", path)
+    counts, orders, product_ids = count(path, chunk_lines)
+    scores = score_pairs(counts, orders, method, min_count)
+    written = write_recommendations(product_ids, top_k(scores, k))
+    logger.info("Wrote %s co-purchase recommendations from %s orders", written, orders)
+    return written
+
+
+def update(
+    path: str,
+    k: int = 10,
+    method: str = "lift",
+    min_count: int = 2,
+    chunk_lines: int = 1000000,
+) -> int:
+    """
+    Folds the orders logged after the watermark into the recommendations
+
+    Returns:
+        the number of recommendations written
+    """
+    watermark = CoPurchaseWatermark.get()
+    logger.info(
+        "Updating co-purchase recommendations from %s after order %s",
+        path,
+        watermark.last_order_id,
+    )
+    product_ids = catalog_ids()
+    after = watermark.last_order_id
+    chunks = last_order_id(read_order_lines(path, chunk_lines, after), watermark)
+    delta, orders = count_cooccurrences(chunks, product_ids)
+    if not orders:
+        logger.info("No new orders after %s", after)
+        db.session.commit()
+        return 0
+    watermark.orders += orders
+    upsert_counts(delta, product_ids)
+
+    affected = np.flatnonzero(delta.diagonal())
+    sources = [int(product_id) for product_id in product_ids[affected]]
+    written = rank(sources, product_ids, watermark.orders, k, method, min_count)
+    logger.info(
+        "Re-ranked %s products from %s new orders, wrote %s recommendations",
+        len(sources),
+        orders,
+        written,
+    )
+    return written
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description="Build co-purchase recommendations")
+    parser.add_argument("path", help="CSV or NDJSON log of order_id, product_id")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--method", choices=SCORING_METHODS, default="lift")
+    parser.add_argument("--min-count", type=int, default=2)
+    parser.add_argument("--chunk-lines", type=int, default=1000000)
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only count the orders after the stored watermark",
+    )
+    args = parser.parse_args()
+    run = update if args.incremental else build
+    with app.app_context():
+        written = run(args.path, args.top_k, args.method, args.min_count, args.chunk_lines)
+    print("Wrote {} recommendations".format(written))
+
+
+if __name__ == "__main__":
+    main()
@@ -51,6 +51,17 @@ def not_found(error):
     )
 
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def resource_conflict(error):
+    """Handles requests that conflict with the state of a resource with 409_CONFLICT"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
+
+
 # @app.errorhandler(status.HTTP_405_METHOD_NOT_ALLOWED)
 # def method_not_supported(error):
 #     """Handles unsupported HTTP methods with 405_METHOD_NOT_SUPPORTED"""
@@ -81,6 +92,25 @@ def mediatype_not_supported(error):
     )
 
 
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """Handles requests that cannot be answered yet with 503_SERVICE_UNAVAILABLE"""
+    message = str(error)
+    app.logger.warning(message)
+    headers = {}
+    if getattr(error, "retry_after", None) is not None:
+        headers["Retry-After"] = str(error.retry_after)
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers,
+    )
+
+
 # @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 # def internal_server_error(error):
 #     """Handles unexpected server error with 500_SERVER_ERROR"""
@@ -0,0 +1,291 @@
+"""
+Interaction Events
+
+Counts how often each recommendation is shown (an impression) and followed
+(a click) without writing a row per event. POST /recommendations/events
+adds its counts to an in-memory buffer of this worker keyed on the
+(source, target, type) link, and the buffer is written out as one batch of
+upserts that add to the stored counts:
+
+  - every EVENTS_FLUSH_INTERVAL seconds, by a background thread
+  - as soon as EVENTS_BUFFER_SIZE links are waiting, by the request that
+    filled it, so the buffer stays bounded
+  - when the worker exits
+
+A flush that fails puts its counts back, as long as they fit, and events
+of products that no longer exist are dropped. A worker that is killed
+loses at most the counts of the last interval.
+
+Lookups can be ordered by click-through with ?order=ctr. The CTR of a link
+is smoothed towards a prior of EVENTS_CTR_PRIOR_CLICKS clicks in
+EVENTS_CTR_PRIOR_IMPRESSIONS impressions, so that a link clicked once in
+two impressions does not outrank one clicked 50 times in 500.
+"""
+import atexit
+import logging
+import os
+import threading
+
+from service.models import (
+    DataValidationError,
+    InteractionCount,
+    Product,
+    RecommendationType,
+    db,
+)
+
+logger = logging.getLogger("flask.app")
+
+EVENT_KINDS = ("impression", "click")
+
+
+def parse_events(data, max_count: int = 1000000) -> list:
+    """
+    Validates a body of events and returns (source, target, type, kind,
+    count) tuples
+
+    The body is one event or a list of them, each a dictionary with
+    source_product_id, target_product_id, type, event ("impression" or
+    "click") and an optional count of at most max_count.
+    """
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list) or not data:
+        raise DataValidationError("Invalid events: body must be an event or a list of events")
+    events = []
+    for event in data:
+        if not isinstance(event, dict):
+            raise DataValidationError("Invalid event: must be a JSON object")
+        try:
+            source, target = event["source_product_id"], event["target_product_id"]
+            kind, count = event["event"], event.get("count", 1)
+            rec_type = RecommendationType.parse(event["type"])
+        except KeyError as error:
+            raise DataValidationError("Invalid event: missing " + error.args[0])
+        if not all(
+            isinstance(value, int) and not isinstance(value, bool)
+            for value in (source, target, count)
+        ):
+            raise DataValidationError("Invalid event: product ids and count must be integers")
+        if kind not in EVENT_KINDS:
+            raise DataValidationError("Invalid event: event must be impression or click")
+        if not 0 < count <= max_count:
+            raise DataValidationError(
+                "Invalid event: count must be between 1 and {}".format(max_count)
+            )
+        events.append((source, target, rec_type, kind, count))
+    return events
+
+
+class InteractionBuffer:
+    """
+    The impression and click counts of this worker waiting to be written
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._counts = {}  # (source, target, type) -> [impressions, clicks]
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self.app = None
+        self.size = 10000
+        self.interval = 10.0
+        self.prior_clicks = 1.0
+        self.prior_impressions = 20.0
+        self.flushed = 0
+        self.dropped = 0
+
+    def init_app(self, app):
+        """Reads the buffer settings from the app configuration"""
+        config = app.config
+        self.app = app
+        self.size = config["EVENTS_BUFFER_SIZE"]
+        self.interval = config["EVENTS_FLUSH_INTERVAL"]
+        self.prior_clicks = config["EVENTS_CTR_PRIOR_CLICKS"]
+        self.prior_impressions = config["EVENTS_CTR_PRIOR_IMPRESSIONS"]
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, events: list) -> int:
+        """
+        Adds (source, target, type, kind, count) events to the buffer
+
+        Returns the number of events that fit. A full buffer is flushed by
+        the caller, and the events of new links that still do not fit are
+        dropped.
+        """
+        self._start_flusher()
+        added = 0
+        for source, target, rec_type, kind, count in events:
+            key = (source, target, rec_type)
+            with self._lock:
+                counts = self._counts.get(key)
+                if counts is None and len(self._counts) >= self.size:
+                    full = True
+                else:
+                    full = False
+                    if counts is None:
+                        counts = self._counts[key] = [0, 0]
+                    counts[EVENT_KINDS.index(kind)] += count
+                    added += 1
+            if full:
+                self.flush()
+                with self._lock:
+                    if len(self._counts) < self.size:
+                        counts = self._counts.setdefault(key, [0, 0])
+                        counts[EVENT_KINDS.index(kind)] += count
+                        added += 1
+                    else:
+                        self.dropped += 1
+        return added
+
+    def pending(self, source_ids) -> dict:
+        """Returns the unwritten counts of the links out of the sources"""
+        sources = set(source_ids)
+        with self._lock:
+            return {
+                key: tuple(counts) for key, counts in self._counts.items() if key[0] in sources
+            }
+
+    def flush(self) -> int:
+        """Adds the buffered counts to the stored ones and returns the links written"""
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, {}
+            if not counts:
+                return 0
+            try:
+                written = self._write(counts)
+            except Exception:  # pylint: disable=broad-except
+                # the counts were swapped out, so any error must put them back
+                db.session.rollback()
+                logger.exception("Cannot write %s interaction counts", len(counts))
+                self._put_back(counts)
+                return 0
+            self.flushed += written
+            logger.info("Wrote the interaction counts of %s links", written)
+            return written
+
+    def _write(self, counts: dict) -> int:
+        """Upserts the counts of the links whose products still exist"""
+        products = sorted({key[0] for key in counts} | {key[1] for key in counts})
+        known = set()
+        for start in range(0, len(products), 1000):
+            chunk = products[start:start + 1000]
+            known.update(
+                product_id
+                for (product_id,) in db.session.query(Product.id).filter(Product.id.in_(chunk))
+            )
+        rows = [
+            {
+                "source_product_id": source,
+                "target_product_id": target,
+                "type": rec_type,
+                "impressions": impressions,
+                "clicks": clicks,
+            }
+            for (source, target, rec_type), (impressions, clicks) in counts.items()
+            if source in known and target in known
+        ]
+        if rows:
+            InteractionCount.increment(rows)
+        # counted once written, as a failed flush puts them back
+        self.dropped += len(counts) - len(rows)
+        return len(rows)
+
+    def _put_back(self, counts: dict):
+        """Merges the counts of a failed flush back into the buffer"""
+        with self._lock:
+            for key, (impressions, clicks) in counts.items():
+                current = self._counts.get(key)
+                if current is None:
+                    if len(self._counts) >= self.size:
+                        self.dropped += 1
+                        continue
+                    current = self._counts[key] = [0, 0]
+                current[0] += impressions
+                current[1] += clicks
+
+    def flush_in_app(self):
+        """Flushes from outside of a request, with an app context of its own"""
+        if self.app is None or not self._counts:
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+
+    def _start_flusher(self):
+        """Starts the periodic flush thread of this process once"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="events-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Flushes every interval until stopped"""
+        stop = self._stop
+        while not stop.wait(self.interval):
+            try:
+                self.flush_in_app()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Interaction flush failed")
+
+    def stop(self):
+        """Stops the flush thread and writes out what is left"""
+        if self._pid == os.getpid():
+            self._stop.set()
+            self._pid = None
+        self.flush_in_app()
+
+    def ctr(self, impressions: int, clicks: int) -> float:
+        """Returns the smoothed click-through rate of a link"""
+        return (clicks + self.prior_clicks) / (impressions + self.prior_impressions)
+
+    def order_by_ctr(self, results: dict) -> dict:
+        """
+        Returns {source id: [recommendation]} ordered by smoothed CTR, the
+        stored order breaking ties, with the impressions, clicks and ctr
+        of each recommendation added
+        """
+        counts = InteractionCount.counts_of(list(results))
+        for key, (impressions, clicks) in self.pending(results).items():
+            stored = counts.get(key, (0, 0))
+            counts[key] = (stored[0] + impressions, stored[1] + clicks)
+        ordered = {}
+        for source, recommendations in results.items():
+            scored = []
+            for recommendation in recommendations:
+                rec_type = RecommendationType(recommendation["type"])
+                impressions, clicks = counts.get(
+                    (source, recommendation["product_id"], rec_type), (0, 0)
+                )
+                scored.append(
+                    dict(
+                        recommendation,
+                        impressions=impressions,
+                        clicks=clicks,
+                        ctr=self.ctr(impressions, clicks),
+                    )
+                )
+            scored.sort(key=lambda recommendation: -recommendation["ctr"])
+            ordered[source] = scored
+        return ordered
+
+    def stats(self) -> dict:
+        """Returns the links buffered, the links written and the ones dropped"""
+        return {"buffered": len(self._counts), "flushed": self.flushed, "dropped": self.dropped}
+
+
+# The event buffer of this worker
+interaction_buffer = InteractionBuffer()
+atexit.register(interaction_buffer.stop)
@@ -0,0 +1,27 @@
+"""
+Fast JSON Responses
+
+Read endpoints encode their plain dictionaries and lists straight to
+bytes with orjson when it is installed, and with the standard library json
+module when it is not, instead of going through Flask's jsonify.
+"""
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(data) -> bytes:
+    """Encodes data as compact JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(data, status: int = 200, headers: dict = None) -> Response:
+    """Returns a JSON Response of data"""
+    return Response(dumps(data), status, headers, mimetype="application/json")
@@ -0,0 +1,277 @@
+"""
+Recommendation Graph
+
+Walks the recommendation links more than one hop deep, for bundles such as
+"the accessories of the upsells of X" or "the cross-sells within two hops".
+
+The links are held as CSR adjacency arrays: the sorted product ids, one
+row pointer per product and the (target, score, type) columns of every
+link, ordered by source. A traversal is a breadth-first search that
+expands the whole frontier of a hop with a handful of numpy operations, so
+its cost follows the number of links it visits and not the catalog size.
+
+The arrays come from the memory-mapped snapshot when one is published, so
+the workers share them. Otherwise each worker builds its own as
+service.index describes, when GRAPH_AUTOBUILD is set, and rebuilds it
+after GRAPH_TTL seconds or once it has seen the links change. Until it is
+warm the links of each hop are read from the database with one query, and
+the same search runs on them.
+
+A path scores the product of the scores of its links, a link without a
+score counting as 1, times GRAPH_DECAY for every hop after the first. A
+product is only reached once: at its nearest hop, through its best path.
+"""
+import logging
+
+import numpy as np
+from flask import current_app
+
+from service.index import InProcessIndex
+from service.models import (
+    Product,
+    Recommendation,
+    db,
+    product_listeners,
+    recommendation_listeners,
+)
+from service.snapshot import RECORD, TYPE_CODES, TYPES, recommendation_snapshot
+
+logger = logging.getLogger("flask.app")
+
+
+class Adjacency:
+    """
+    CSR adjacency arrays of the recommendation links
+    """
+
+    def __init__(self, ids, offsets, records):
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = records["target"]
+        self.scores = records["score"]
+        self.types = records["type"]
+
+    def edges(self, frontier):
+        """
+        Returns the (frontier position, target, type, score) arrays of the
+        links out of the frontier ids
+        """
+        if not len(self.ids):  # pylint: disable=len-as-condition
+            return query_edges(frontier[:0])
+        positions = np.minimum(np.searchsorted(self.ids, frontier), len(self.ids) - 1)
+        known = self.ids[positions] == frontier
+        starts = np.where(known, self.offsets[positions], 0)
+        counts = np.where(known, self.offsets[positions + 1] - starts, 0)
+        parents = np.repeat(np.arange(len(frontier)), counts)
+        # the index of every link: its row start plus its place in the row
+        first = np.cumsum(counts) - counts
+        edges = np.repeat(starts - first, counts) + np.arange(counts.sum())
+        return parents, self.targets[edges], self.types[edges], self.scores[edges]
+
+
+def query_edges(frontier):
+    """Returns the links out of the frontier ids like Adjacency.edges()"""
+    rows = []
+    if len(frontier):  # pylint: disable=len-as-condition
+        rows = (
+            db.session.query(
+                Recommendation.source_product_id,
+                Recommendation.target_product_id,
+                Recommendation.type,
+                Recommendation.score,
+            )
+            .filter(Recommendation.source_product_id.in_(frontier.tolist()))
+            .all()
+        )
+    parent_of = {product_id: i for i, product_id in enumerate(frontier.tolist())}
+    return (
+        np.array([parent_of[row[0]] for row in rows], dtype=np.int64),
+        np.array([row[1] for row in rows], dtype=np.int64),
+        np.array([TYPE_CODES[row[2]] for row in rows], dtype=np.uint8),
+        np.array([np.nan if row[3] is None else row[3] for row in rows], dtype=np.float64),
+    )
+
+
+def traverse(
+    edges, product_id: int, hop_types: list, decay: float, limit: int, min_hops: int = 1
+) -> list:
+    """
+    Searches breadth first from a product and returns the best paths
+
+    Args:
+        edges: returns the links out of an array of ids, see Adjacency.edges()
+        product_id (int): the product to start from
+        hop_types (list): one list of allowed RecommendationTypes per hop,
+            an empty list allows every type
+        decay (float): the factor applied to a path for every further hop
+        limit (int): the number of products to return, or None for all
+        min_hops (int): leave out the products reached in fewer hops
+
+    Returns a list of (target id, type, score, hops, via) tuples, the best
+    scores first, where via is the product the last link leaves from.
+    """
+    seen = np.array([product_id], dtype=np.int64)
+    frontier = seen
+    frontier_scores = np.ones(1)
+    found = []
+    for hop, types in enumerate(hop_types, start=1):
+        parents, targets, codes, scores = edges(frontier)
+        keep = ~np.isin(targets, seen)
+        if types:
+            keep &= np.isin(codes, [TYPE_CODES[rec_type] for rec_type in types])
+        parents, targets, codes, scores = parents[keep], targets[keep], codes[keep], scores[keep]
+        if not len(targets):  # pylint: disable=len-as-condition
+            break
+        scores = np.where(np.isnan(scores), 1.0, scores) * frontier_scores[parents]
+        if hop > 1:
+            scores = scores * decay
+        # keep the best path to every target
+        order = np.lexsort((-scores, targets))
+        targets, parents, codes, scores = (
+            targets[order], parents[order], codes[order], scores[order]
+        )
+        first = np.ones(len(targets), dtype=bool)
+        first[1:] = targets[1:] != targets[:-1]
+        targets, parents, codes, scores = (
+            targets[first], parents[first], codes[first], scores[first]
+        )
+        found.extend(
+            zip(
+                targets.tolist(),
+                codes.tolist(),
+                scores.tolist(),
+                [hop] * len(targets),
+                frontier[parents].tolist(),
+            )
+        )
+        seen = np.union1d(seen, targets)
+        frontier, frontier_scores = targets, scores
+    found = [path for path in found if path[3] >= min_hops]
+    found.sort(key=lambda path: (-path[2], path[3], path[0]))
+    return [
+        (target, TYPES[code], score, hops, via)
+        for target, code, score, hops, via in found[:limit]
+    ]
+
+
+class RecommendationGraph(InProcessIndex):
+    """
+    The adjacency arrays this worker traverses
+    """
+
+    name = "recommendation graph"
+    config = "GRAPH"
+
+    def __init__(self):
+        super().__init__()
+        self._adjacency = None
+
+    def __len__(self) -> int:
+        adjacency = self._adjacency
+        return 0 if adjacency is None else len(adjacency.targets)
+
+    def _reset(self):
+        """Drops the arrays, the lock must be held"""
+        self._adjacency = None
+
+    def _build(self):
+        """Reads the tables into new adjacency arrays"""
+        ids = np.fromiter(
+            (product_id for (product_id,) in
+             db.session.query(Product.id).order_by(Product.id).yield_per(10000)),
+            dtype=np.int64,
+        )
+        links = db.session.query(
+            Recommendation.source_product_id,
+            Recommendation.target_product_id,
+            Recommendation.score,
+            Recommendation.type,
+        ).order_by(Recommendation.source_product_id)
+        sources, records = [], []
+        for source, target, score, rec_type in links.yield_per(10000):
+            sources.append(source)
+            records.append((target, np.nan if score is None else score, 0, TYPE_CODES[rec_type]))
+        sources = np.array(sources, dtype=np.int64)
+        records = np.array(records, dtype=RECORD)
+        kept = np.isin(sources, ids)
+        sources, records = sources[kept], records[kept]
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(np.searchsorted(ids, sources), minlength=len(ids)),
+            out=offsets[1:],
+        )
+        with self._lock:
+            self._adjacency = Adjacency(ids, offsets, records)
+            # the changes seen meanwhile only mark the graph dirty
+            self._built()
+
+    def on_change(self, action: str, product):
+        """Product listener that marks the graph stale when links go away"""
+        if action == "delete":
+            self._dirty = True
+
+    def on_recommendation_change(self, source_ids):
+        """Recommendation listener that marks the graph stale"""
+        self._dirty = True
+
+    def edges(self):
+        """
+        Returns the fastest source of links: the snapshot, the arrays of
+        this worker, or the database while they are being built
+        """
+        snapshot = recommendation_snapshot.current()
+        if snapshot is not None:
+            return Adjacency(snapshot.ids, snapshot.offsets, snapshot.records).edges
+        self.refresh()
+        adjacency = self._adjacency
+        if adjacency is not None:
+            return adjacency.edges
+        logger.info("Recommendation graph is cold, using the database")
+        return query_edges
+
+
+def recommend(
+    product_id: int, hop_types: list, limit: int, decay: float = None, min_hops: int = 1
+) -> list:
+    """
+    Returns the products reached from a product as dictionaries
+
+    Each one has the type of its last link, its path score, the number of
+    hops to it and the product it was reached through. The links may still
+    lead to deleted products, which are dropped before the limit is taken.
+    """
+    if decay is None:
+        decay = current_app.config["GRAPH_DECAY"]
+    paths = traverse(
+        recommendation_graph.edges(), product_id, hop_types, decay, None, min_hops
+    )
+    rows = db.session.query(Product.id, Product.name, Product.category, Product.price)
+    found, kept, start = {}, [], 0
+    while len(kept) < limit and start < len(paths):
+        # look up a few more than needed in case some are gone
+        window = paths[start:start + 2 * limit]
+        start += len(window)
+        found.update(
+            (row[0], row) for row in rows.filter(Product.id.in_([path[0] for path in window]))
+        )
+        kept.extend(path for path in window if path[0] in found)
+    return [
+        {
+            "product_id": target,
+            "type": rec_type.value,
+            "rank": rank,
+            "score": score,
+            "hops": hops,
+            "via": via,
+            "name": found[target][1],
+            "category": found[target][2],
+            "price": found[target][3],
+        }
+        for rank, (target, rec_type, score, hops, via) in enumerate(kept[:limit], start=1)
+    ]
+
+
+# The graph shared by every request of this worker
+recommendation_graph = RecommendationGraph()
+product_listeners.append(recommendation_graph.on_change)
+recommendation_listeners.append(recommendation_graph.on_recommendation_change)
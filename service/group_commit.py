@@ -0,0 +1,131 @@
+"""
+Group Commit
+
+Single product creates and updates each end in a commit, and with many
+clients writing one product at a time the worker spends most of its time
+waiting for those commits. With GROUP_COMMIT_ENABLED the writes that
+arrive at a worker at about the same time are committed together:
+
+  - the first write to arrive leads: it waits up to GROUP_COMMIT_MAX_WAIT
+    seconds for GROUP_COMMIT_MAX_BATCH writes to queue up behind it
+  - the leader runs the statements of every queued write in one
+    transaction on a connection of its own and commits once
+  - each writer gets its own outcome, such as the id of the product it
+    created, and the next write to arrive leads the next group
+
+When the group's transaction fails, each of its writes is run again in a
+transaction of its own, so a write only fails with its own error and the
+others are still committed. A write waits at most GROUP_COMMIT_MAX_WAIT
+longer than it would alone, which is the price of the mode, so it is off
+by default.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger("flask.app")
+
+
+class GroupCommit:
+    """
+    Commits the concurrent writes of this worker in groups
+    """
+
+    class Write:  # pylint: disable=too-few-public-methods
+        """A write waiting to be committed"""
+
+        def __init__(self, apply):
+            self.apply = apply
+            self.finished = False
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = []
+        self._leading = False
+        self.db = None
+        self.enabled = False
+        self.max_batch = 64
+        self.max_wait = 0.002
+        self.groups = 0
+        self.writes = 0
+        self.retried = 0
+
+    def init_app(self, app, db):
+        """Reads the group settings from the app configuration"""
+        config = app.config
+        self.db = db
+        self.enabled = config["GROUP_COMMIT_ENABLED"]
+        self.max_batch = config["GROUP_COMMIT_MAX_BATCH"]
+        self.max_wait = config["GROUP_COMMIT_MAX_WAIT"]
+
+    def submit(self, apply):
+        """
+        Runs apply(connection) in the transaction of the next group and
+        returns its result once the group is committed, or raises its error
+        """
+        write = self.Write(apply)
+        with self._cond:
+            self._queue.append(write)
+            if len(self._queue) >= self.max_batch:
+                self._cond.notify_all()
+            while self._leading and not write.finished:
+                self._cond.wait()
+            if not write.finished:
+                self._leading = True
+        if not write.finished:
+            try:
+                # the writes queued first go first, so lead until ours is in
+                while not write.finished:
+                    self._commit(self._collect())
+            finally:
+                with self._cond:
+                    self._leading = False
+                    self._cond.notify_all()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _collect(self) -> list:
+        """Waits for a full group or the end of the wait and takes it off the queue"""
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            while len(self._queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            group = self._queue[:self.max_batch]
+            del self._queue[:self.max_batch]
+        return group
+
+    def _commit(self, group: list):
+        """Runs a group in one transaction, or each of its writes alone if it fails"""
+        try:
+            with self.db.engine.begin() as connection:
+                results = [write.apply(connection) for write in group]
+        except Exception as error:  # pylint: disable=broad-except
+            if len(group) > 1:
+                logger.warning("Group of %s writes failed, committing each alone", len(group))
+                self.retried += len(group)
+                for write in group:
+                    self._commit([write])
+                return
+            results = [None]
+            group[0].error = error
+        with self._cond:
+            self.groups += 1
+            self.writes += len(group)
+            for write, result in zip(group, results):
+                write.result = result
+                write.finished = True
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Returns the groups committed, the writes in them and those committed alone"""
+        return {"groups": self.groups, "writes": self.writes, "retried": self.retried}
+
+
+# The group commit of this worker
+group_commit = GroupCommit()
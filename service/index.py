@@ -0,0 +1,157 @@
+"""
+In-Process Indexes
+
+What the price index, the search index, the similarity matrix and the
+recommendation graph have in common: each worker keeps its own copy of
+the catalog in memory, built from the tables on a background thread the
+first time it is needed. The requests that find it cold are answered some
+other way, from the database or with 503 Service Unavailable, rather than
+waiting for the build.
+
+The Product change listeners keep a warm index current. The changes seen
+while a build is running are kept aside and replayed onto the new copy,
+and a bulk insert, which cannot be replayed, marks the index dirty. Each
+worker only sees its own writes, so an index is also rebuilt after a TTL
+to pick up the writes of the others, serving the old copy meanwhile.
+"""
+import logging
+import threading
+import time
+
+from flask import current_app
+
+from service.models import Product, db
+
+logger = logging.getLogger("flask.app")
+
+
+class InProcessIndex:
+    """
+    The build lifecycle of an index of the catalog
+
+    A subclass names itself and the settings it reads, <config>_TTL and
+    <config>_AUTOBUILD, and implements _build() to read the tables and
+    install the new copy with _built(), _change() and _apply() to follow
+    the Product changes, _reset() to empty it and __len__().
+    """
+
+    name = "index"
+    config = None
+    # build a cold index on first use even when AUTOBUILD is not set
+    builds_when_cold = False
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pending = None  # changes seen while a build is running
+        self._dirty = False
+        self.built_at = None
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    @property
+    def is_warm(self) -> bool:
+        """True once the index has been built"""
+        return self.built_at is not None
+
+    @property
+    def is_building(self) -> bool:
+        """True while the index is being built"""
+        return self._pending is not None
+
+    def is_stale(self, ttl: float) -> bool:
+        """True if the index should be rebuilt"""
+        if not self.is_warm:
+            return True
+        return self._dirty or time.monotonic() - self.built_at > ttl
+
+    def clear(self):
+        """Empties the index and makes it cold"""
+        with self._lock:
+            self._reset()
+            self._dirty = False
+            self.built_at = None
+
+    def _reset(self):
+        """Empties the index, the lock must be held"""
+        raise NotImplementedError
+
+    def refresh(self) -> bool:
+        """
+        Starts a build in the background when the index is stale and
+        AUTOBUILD is set, or cold and builds_when_cold is set, and returns
+        True if the index is warm
+        """
+        config = current_app.config
+        if self.is_stale(config[self.config + "_TTL"]) and (
+            config[self.config + "_AUTOBUILD"] or (self.builds_when_cold and not self.is_warm)
+        ):
+            self.build_in_background(current_app._get_current_object())
+        return self.is_warm
+
+    def build(self):
+        """Builds the index from the tables"""
+        with self._lock:
+            if self.is_building:
+                return
+            self._pending = []
+            # a bulk insert seen from here on may be missed by the query
+            self._dirty = False
+        logger.info("Building %s", self.name)
+        try:
+            self._build()
+        finally:
+            with self._lock:
+                self._pending = None
+        logger.info("Built %s of %s entries", self.name, len(self))
+
+    def _build(self):
+        """Reads the tables and installs the new copy with _built()"""
+        raise NotImplementedError
+
+    def _built(self):
+        """
+        Replays the changes seen during the build onto the new copy and
+        marks the index warm, the lock must be held
+        """
+        for change in self._pending or ():
+            self._apply(*change)
+        self._pending = None
+        self.built_at = time.monotonic()
+
+    def build_in_background(self, app):
+        """Starts a build on a daemon thread unless one is already running"""
+        if self.is_building:
+            return
+
+        def run():
+            with app.app_context():
+                try:
+                    self.build()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Build of %s failed", self.name)
+                finally:
+                    db.session.remove()
+
+        name = "{}-build".format(self.name.replace(" ", "-"))
+        threading.Thread(target=run, name=name, daemon=True).start()
+
+    def on_change(self, action: str, product: Product):
+        """Product listener that keeps the index current"""
+        with self._lock:
+            if action == "bulk":
+                self._dirty = True
+                return
+            change = self._change(action, product)
+            if self.is_building:
+                self._pending.append(change)
+            elif self.is_warm:
+                self._apply(*change)
+
+    def _change(self, action: str, product: Product) -> tuple:
+        """Returns the arguments of _apply() for a Product change"""
+        raise NotImplementedError
+
+    def _apply(self, action: str, *fields):
+        """Applies one Product change to the index, the lock must be held"""
+        raise NotImplementedError
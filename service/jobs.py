@@ -0,0 +1,419 @@
+"""
+Background Jobs
+
+Heavy recomputations run as Jobs instead of inside a request. POST
+/recommendations/jobs queues one in the job table, and a runner started
+with `flask jobs-run` claims the oldest queued Job, cuts it into
+partitions and runs them on a pool of JOBS_WORKERS processes:
+
+  similarity    the content based neighbours of every product, written as
+                computed links of a type (cross_sell by default), one
+                partition per range of JOBS_PARTITION_SIZE product ids. The
+                index is built once by the runner and saved to the work
+                directory of the Job, where every partition maps it
+  copurchase    a full co-purchase build from an order-line log in
+                JOBS_COPURCHASE_LOG_DIR: the log is counted once, then
+                the products are ranked from the stored counts one
+                product id range per partition
+  snapshot      a recommendation snapshot export to SNAPSHOT_PATH, in
+                one partition
+
+Partitions run phase by phase, and every partition records its outcome
+when it ends, which is the checkpoint: a resumed Job only runs the
+partitions that did not succeed. A cancelled Job stops once the partitions
+already running end. A runner keeps the heartbeat of its Job fresh, and a
+running Job whose runner has not been heard from for JOBS_STALE_AFTER
+seconds is queued again and resumed by the next runner.
+"""
+import logging
+import os
+import socket
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from service import app, copurchase, similarity, snapshot
+from service.models import (
+    CoPurchaseWatermark,
+    DataValidationError,
+    Job,
+    JobPartition,
+    JobStatus,
+    Product,
+    RecommendationType,
+    db,
+)
+from service.similarity import SimilarityIndex
+
+logger = logging.getLogger("flask.app")
+
+# plan(params) returns the (phase, key) of every partition of a Job and
+# run(params, key) does the work of one of them and returns the links written.
+# prepare(params, workdir), if set, runs once in the runner before the
+# partitions and returns the params they get, with what it left in workdir
+Kind = namedtuple("Kind", ["validate", "plan", "run", "prepare"], defaults=[None])
+
+# what the partitions of the Job running in this process have loaded
+_loaded = {}
+
+
+def loaded(name: str, load):
+    """Returns what load() returns, calling it once per Job and process"""
+    if name not in _loaded:
+        _loaded[name] = load()
+    return _loaded[name]
+
+
+def product_ranges(size: int) -> list:
+    """Returns {first, last} id ranges that cover the catalog, size ids each"""
+    ids = [product_id for (product_id,) in db.session.query(Product.id).order_by(Product.id)]
+    return [
+        {"first": ids[start], "last": ids[min(start + size, len(ids)) - 1]}
+        for start in range(0, len(ids), size)
+    ]
+
+
+def sources_in(catalog: np.ndarray, key: dict) -> list:
+    """Returns the ids of the catalog in the range of a partition"""
+    start = np.searchsorted(catalog, key["first"], "left")
+    end = np.searchsorted(catalog, key["last"], "right")
+    return [int(product_id) for product_id in catalog[start:end]]
+
+
+def _int_param(params: dict, name: str, default: int, least: int = 1) -> int:
+    """Returns an integer parameter or raises a DataValidationError"""
+    value = params.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool) or value < least:
+        raise DataValidationError("{} must be an integer of at least {}".format(name, least))
+    return value
+
+
+######################################################################
+# SIMILARITY
+######################################################################
+def validate_similarity(params: dict) -> dict:
+    """Checks the parameters of a similarity Job"""
+    return {
+        "top_k": _int_param(params, "top_k", 10),
+        "type": RecommendationType.parse(params.get("type", "cross_sell")).value,
+    }
+
+
+def plan_similarity(params: dict) -> list:
+    """Cuts the catalog into product id ranges"""
+    return [(0, key) for key in product_ranges(app.config["JOBS_PARTITION_SIZE"])]
+
+
+def prepare_similarity(params: dict, workdir: str) -> dict:
+    """Builds the index once for every partition and saves it to workdir"""
+    index = SimilarityIndex()
+    index.init_app(app)
+    index.build()
+    index.save(workdir)
+    return dict(params, index=workdir)
+
+
+def run_similarity(params: dict, key: dict) -> int:
+    """Writes the neighbours of the products in a range as computed links"""
+
+    def open_index():
+        index = SimilarityIndex()
+        index.init_app(app)
+        index.open(params["index"])
+        return index
+
+    index = loaded("similarity", open_index)
+    catalog = loaded("catalog", copurchase.catalog_ids)
+    sources = sources_in(catalog, key)
+    found = index.similar(sources, params["top_k"])
+    ranked = (
+        (
+            int(np.searchsorted(catalog, source)),
+            np.searchsorted(catalog, [target for target, _ in neighbours]),
+            [score for _, score in neighbours],
+        )
+        for source, neighbours in found.items()
+    )
+    return copurchase.write_recommendations(
+        catalog,
+        ranked,
+        sources,
+        rec_type=RecommendationType(params["type"]),
+        origin=similarity.ORIGIN,
+    )
+
+
+######################################################################
+# CO-PURCHASE
+######################################################################
+def validate_copurchase(params: dict) -> dict:
+    """Checks the parameters of a co-purchase Job"""
+    path = log_path(params.get("path"))
+    method = params.get("method", "lift")
+    if method not in copurchase.SCORING_METHODS:
+        raise DataValidationError(
+            "method must be one of " + ", ".join(copurchase.SCORING_METHODS)
+        )
+    return {
+        "path": path,
+        "top_k": _int_param(params, "top_k", 10),
+        "method": method,
+        "min_count": _int_param(params, "min_count", 2),
+        "chunk_lines": _int_param(params, "chunk_lines", 1000000),
+    }
+
+
+def log_path(path) -> str:
+    """
+    Resolves the path of an order-line log, which must name a file inside
+    JOBS_COPURCHASE_LOG_DIR, relative to it or absolute
+    """
+    if not isinstance(path, str) or not path:
+        raise DataValidationError("path of the order-line log is required")
+    directory = app.config["JOBS_COPURCHASE_LOG_DIR"]
+    if not directory:
+        raise DataValidationError("co-purchase Jobs need JOBS_COPURCHASE_LOG_DIR to be set")
+    directory = os.path.realpath(directory)
+    resolved = os.path.realpath(os.path.join(directory, path))
+    if os.path.commonpath([directory, resolved]) != directory or resolved == directory:
+        raise DataValidationError("path must name a log inside JOBS_COPURCHASE_LOG_DIR")
+    return resolved
+
+
+def plan_copurchase(params: dict) -> list:
+    """Counts the log first, then ranks the catalog by product id range"""
+    ranges = product_ranges(app.config["JOBS_PARTITION_SIZE"])
+    return [(0, {"step": "count"})] + [(1, key) for key in ranges]
+
+
+def run_copurchase(params: dict, key: dict) -> int:
+    """Counts the log or ranks the products of a range"""
+    if key.get("step") == "count":
+        # checked again for Jobs queued before the directory changed
+        _, orders, _ = copurchase.count(log_path(params["path"]), params["chunk_lines"])
+        logger.info("Counted %s orders of %s", orders, params["path"])
+        return 0
+    catalog = loaded("catalog", copurchase.catalog_ids)
+    orders = loaded("orders", lambda: CoPurchaseWatermark.get().orders)
+    return copurchase.rank(
+        sources_in(catalog, key),
+        catalog,
+        orders,
+        params["top_k"],
+        params["method"],
+        params["min_count"],
+    )
+
+
+######################################################################
+# SNAPSHOT
+######################################################################
+def validate_snapshot(params: dict) -> dict:
+    """Checks the parameters of a snapshot Job, which is always written to SNAPSHOT_PATH"""
+    if "path" in params:
+        raise DataValidationError("path is not a parameter, snapshots are written to SNAPSHOT_PATH")
+    if not app.config["SNAPSHOT_PATH"]:
+        raise DataValidationError("snapshot Jobs need SNAPSHOT_PATH to be set")
+    return {}
+
+
+def run_snapshot(params: dict, key: dict) -> int:
+    """Publishes a snapshot"""
+    path = app.config["SNAPSHOT_PATH"]
+    version = snapshot.export(path)
+    logger.info("Published snapshot %s to %s", version, path)
+    return 0
+
+
+KINDS = {
+    "similarity": Kind(validate_similarity, plan_similarity, run_similarity, prepare_similarity),
+    "copurchase": Kind(validate_copurchase, plan_copurchase, run_copurchase),
+    "snapshot": Kind(validate_snapshot, lambda params: [(0, {})], run_snapshot),
+}
+
+
+def validate(kind, params) -> dict:
+    """Returns the checked parameters of a Job or raises a DataValidationError"""
+    if kind not in KINDS:
+        raise DataValidationError("kind must be one of " + ", ".join(sorted(KINDS)))
+    if not isinstance(params, dict):
+        raise DataValidationError("params must be a JSON object")
+    return KINDS[kind].validate(params)
+
+
+def run_partition(kind: str, params: dict, key: dict) -> int:
+    """Runs one partition, in a pool process or in the runner"""
+    with app.app_context():
+        try:
+            return KINDS[kind].run(params, key)
+        finally:
+            db.session.remove()
+
+
+######################################################################
+# RUNNER
+######################################################################
+class JobRunner:
+    """
+    Claims queued Jobs from the job table and runs their partitions
+    """
+
+    def __init__(self, workers: int = None):
+        config = app.config
+        self.workers = config["JOBS_WORKERS"] if workers is None else workers
+        self.heartbeat_interval = config["JOBS_HEARTBEAT_INTERVAL"]
+        self.stale_after = config["JOBS_STALE_AFTER"]
+        self.name = "{}:{}".format(socket.gethostname(), os.getpid())[:63]
+        self._stop = threading.Event()
+
+    def run_forever(self, poll_interval: float):
+        """Runs Jobs until stopped, polling the table when there are none"""
+        logger.info("Job runner %s started with %s workers", self.name, self.workers)
+        while not self._stop.is_set():
+            if self.run_once() is None:
+                self._stop.wait(poll_interval)
+
+    def stop(self):
+        """Stops polling once the current Job is done"""
+        self._stop.set()
+
+    def run_once(self):
+        """Runs the oldest queued Job and returns it, or None if there is none"""
+        before = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        requeued = Job.requeue_stale(before)
+        if requeued:
+            logger.warning("Queued %s jobs again whose runner went away", requeued)
+        job = Job.claim(self.name)
+        if job is not None:
+            self.run(job)
+        return job
+
+    def run(self, job: Job):
+        """Runs the partitions of a claimed Job that have not succeeded"""
+        logger.info("Running %s job %s", job.kind, job.id)
+        _loaded.clear()
+        workdir = tempfile.TemporaryDirectory(prefix="job-{}-".format(job.id))
+        try:
+            partitions = JobPartition.of(job.id) or self._plan(job)
+            prepare = KINDS[job.kind].prepare
+            params = job.params if prepare is None else prepare(job.params, workdir.name)
+            for phase in sorted({partition.phase for partition in partitions}):
+                todo = [
+                    partition
+                    for partition in partitions
+                    if partition.phase == phase and partition.status != JobStatus.SUCCEEDED
+                ]
+                if todo and not self._run_phase(job, todo, params):
+                    break
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("Job %s failed", job.id)
+            db.session.rollback()
+            job.error = "{}: {}".format(type(error).__name__, error)
+            db.session.commit()
+        finally:
+            _loaded.clear()
+            workdir.cleanup()
+        self._finish(job)
+
+    def _plan(self, job: Job) -> list:
+        """Creates the partitions of a Job"""
+        partitions = [
+            JobPartition(job_id=job.id, number=number, phase=phase, key=key)
+            for number, (phase, key) in enumerate(KINDS[job.kind].plan(job.params))
+        ]
+        db.session.add_all(partitions)
+        job.partitions_total = len(partitions)
+        db.session.commit()
+        logger.info("Job %s has %s partitions", job.id, len(partitions))
+        return partitions
+
+    def _run_phase(self, job: Job, partitions: list, params: dict) -> bool:
+        """Runs partitions with params and returns whether the next phase may start"""
+        kind = KINDS[job.kind]
+        if not self.workers:
+            for partition in partitions:
+                if not self._heartbeat(job):
+                    return False
+                try:
+                    written = kind.run(params, partition.key)
+                except Exception as error:  # pylint: disable=broad-except
+                    db.session.rollback()
+                    self._record(job, partition, error=error)
+                    return False
+                self._record(job, partition, written)
+            return True
+
+        failed = False
+        keys = [partition.key for partition in partitions]
+        # the pool forks on the first submit, with no connection checked out
+        db.session.commit()
+        with ProcessPoolExecutor(min(self.workers, len(partitions))) as pool:
+            running = {
+                pool.submit(run_partition, job.kind, params, key): partition
+                for partition, key in zip(partitions, keys)
+            }
+            while running:
+                done, _ = wait(running, self.heartbeat_interval, FIRST_COMPLETED)
+                for future in done:
+                    partition = running.pop(future)
+                    if future.cancelled():
+                        continue
+                    error = future.exception()
+                    if error is None:
+                        self._record(job, partition, future.result())
+                    else:
+                        self._record(job, partition, error=error)
+                        failed = True
+                if (failed or not self._heartbeat(job)) and running:
+                    # the partitions that started run to their end
+                    for future in running:
+                        future.cancel()
+        return not failed and not job.cancel_requested
+
+    @staticmethod
+    def _record(job: Job, partition: JobPartition, written: int = 0, error=None):
+        """Checkpoints the outcome of a partition"""
+        partition.finished_at = datetime.utcnow()
+        if error is None:
+            partition.status = JobStatus.SUCCEEDED
+            partition.written = written
+            job.partitions_done += 1
+            job.written += written
+        else:
+            logger.error("Partition %s of job %s failed: %s", partition.number, job.id, error)
+            partition.status = JobStatus.FAILED
+            partition.error = job.error = "{}: {}".format(type(error).__name__, error)
+        db.session.commit()
+
+    @staticmethod
+    def _heartbeat(job: Job) -> bool:
+        """Tells the table the runner is alive and returns False if cancelled"""
+        job.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+        db.session.refresh(job)
+        return not job.cancel_requested
+
+    @staticmethod
+    def _finish(job: Job):
+        """Sets the final status of a Job from its partitions"""
+        db.session.refresh(job)
+        if job.partitions_done == job.partitions_total and not job.error:
+            job.status = JobStatus.SUCCEEDED
+        elif job.cancel_requested:
+            job.status = JobStatus.CANCELLED
+        else:
+            job.status = JobStatus.FAILED
+            job.error = job.error or "Job did not finish"
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        logger.info(
+            "Job %s %s after %s of %s partitions",
+            job.id,
+            job.status.value,
+            job.partitions_done,
+            job.partitions_total,
+        )
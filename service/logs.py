@@ -0,0 +1,208 @@
+"""
+Structured Logging
+
+Log records of the app are put on a bounded in-memory queue by the thread
+that logs them and written out by a listener thread, so a slow sink such
+as a full pipe or a remote collector never stalls a request. When the
+queue is full the record is dropped and counted instead of waiting.
+
+The request thread only merges the message with its arguments; the JSON
+encoding and the I/O happen on the listener thread. Each record carries
+the id of its request, taken from the X-Request-ID header or generated.
+
+Every request ends with an access line. INFO and lower records, access
+lines included, are sampled per request: a request is kept whole with the
+probability LOG_ACCESS_SAMPLE_RATE or not logged at INFO at all, while
+warnings, errors and the access lines of failed requests are always kept.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import current_app, g, has_request_context, request
+
+from service import fastjson
+
+# attributes that every LogRecord has, anything else was passed in extra=
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON with its extra fields
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return fastjson.dumps(entry).decode("utf-8")
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drops the INFO and lower records of requests that were not sampled and
+    tags the others with their request id
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not has_request_context():
+            return True
+        if record.levelno <= logging.INFO and not g.get("log_sampled", True):
+            return False
+        record.request_id = g.get("request_id")
+        return True
+
+
+sampling_filter = SamplingFilter()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue without blocking, counting the ones
+    that did not fit
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Makes a record safe to hand to another thread, leaving the
+        formatting to the listener
+        """
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class AsyncLogging:
+    """
+    Moves the handlers of the app logger behind a queue and a listener
+    """
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.handlers = []
+        self.queue_size = 0
+        self.sample_rate = 1.0
+
+    def init_app(self, app):
+        """Formats and queues the records of the app logger as configured"""
+        config = app.config
+        self.stop()
+        self.sample_rate = config["LOG_ACCESS_SAMPLE_RATE"]
+        self.queue_size = config["LOG_QUEUE_SIZE"]
+        handlers = [handler for handler in app.logger.handlers if handler is not self.handler]
+        self.handlers = handlers or self.handlers or [logging.StreamHandler(sys.stderr)]
+        if config["LOG_FORMAT"] == "json":
+            for handler in self.handlers:
+                handler.setFormatter(JsonFormatter())
+        if config["LOG_ASYNC"]:
+            self.start()
+            handlers = [self.handler]
+        else:
+            for handler in self.handlers:
+                handler.addFilter(sampling_filter)
+            handlers = self.handlers
+        app.logger.handlers = handlers
+        # the modules log through "flask.app", which is not the app logger
+        module_logger = logging.getLogger("flask.app")
+        if module_logger is not app.logger:
+            module_logger.handlers = list(handlers)
+            module_logger.setLevel(app.logger.getEffectiveLevel())
+            module_logger.propagate = False
+        if self.start_request not in app.before_request_funcs.setdefault(None, []):
+            app.before_request(self.start_request)
+            app.after_request(self.log_request)
+
+    def start(self):
+        """Starts a listener thread writing a new queue to the handlers"""
+        log_queue = queue.Queue(self.queue_size)
+        if self.handler is None:
+            self.handler = DroppingQueueHandler(log_queue)
+            self.handler.addFilter(sampling_filter)
+        else:
+            # the loggers keep the handler, only its queue is replaced
+            self.handler.queue = log_queue
+        self.listener = QueueListener(log_queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Writes out the queued records and stops the listener thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def restart(self):
+        """Gives a forked worker a listener thread of its own"""
+        if self.listener is not None:
+            self.start()
+
+    def start_request(self):
+        """Decides whether the INFO records of this request are logged"""
+        g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+        g.log_sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        g.log_start = time.perf_counter()
+
+    def log_request(self, response):
+        """Logs the access line of the request"""
+        if "log_start" not in g:
+            return response
+        level = logging.INFO if response.status_code < 500 else logging.WARNING
+        current_app.logger.log(
+            level,
+            "%s %s %s",
+            request.method,
+            request.full_path.rstrip("?"),
+            response.status_code,
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round((time.perf_counter() - g.log_start) * 1000, 3),
+            },
+        )
+        response.headers.setdefault("X-Request-ID", g.request_id)
+        return response
+
+    def stats(self) -> dict:
+        """Returns the records waiting in the queue and the ones dropped"""
+        if self.handler is None:
+            return {"queued": 0, "dropped": 0}
+        return {"queued": self.handler.queue.qsize(), "dropped": self.handler.dropped}
+
+
+# The logging of this worker, set up by the app
+async_logging = AsyncLogging()
+os.register_at_fork(after_in_child=async_logging.restart)
+atexit.register(async_logging.stop)
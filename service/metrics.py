@@ -0,0 +1,256 @@
+"""
+Module: metrics
+
+Collects Prometheus metrics for every request and SQL statement and serves
+them at /metrics:
+
+* request latency histograms and request counts by route and status code
+* the number of SQL statements each request ran
+* SQL statement counts and timings from SQLAlchemy engine events
+* connection pool checkouts and the time they waited for a connection,
+  by bind ("primary" or the read "replica")
+* recommendation cache and connection pool gauges
+* requests running and waiting for admission, the time they waited and
+  the ones shed by class and reason
+
+Under gunicorn each worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(set up by gunicorn.conf.py) and /metrics adds up the files of every
+worker, so a scrape sees the whole server whichever worker answers it.
+"""
+import os
+import time
+
+from flask import Response, g, has_app_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from service.admission import (
+    PRIORITIES,
+    SHED_REASONS,
+    admission_control,
+    admission_listeners,
+)
+from service.cache import recommendation_cache
+from service.events import interaction_buffer
+from service.logs import async_logging
+from service.models import db, pool_listeners
+from . import app
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent answering requests",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_COUNT = Counter(
+    "http_requests_total", "Requests answered", ["method", "route", "status"]
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries",
+    "SQL statements run per request",
+    ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "Time spent running SQL statements",
+    ["statement"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_GAUGES = {
+    name: Gauge(
+        "recommendation_cache_" + name,
+        "Recommendation cache " + name + " of the live workers",
+        multiprocess_mode="livesum",
+    )
+    for name in (
+        "size",
+        "hits",
+        "misses",
+        "evictions",
+        "invalidations",
+        "computations",
+        "coalesced",
+        "early_refreshes",
+    )
+}
+LOG_GAUGES = {
+    name: Gauge(
+        "log_records_" + name,
+        "Log records " + name + " in the live workers",
+        multiprocess_mode="livesum",
+    )
+    for name in ("queued", "dropped")
+}
+EVENT_GAUGES = {
+    name: Gauge(
+        "interaction_links_" + name,
+        "Interaction counts of links " + name + " by the live workers",
+        multiprocess_mode="livesum",
+    )
+    for name in ("buffered", "flushed", "dropped")
+}
+POOL_GAUGES = {
+    name: Gauge(
+        "db_pool_" + name,
+        "Database connections " + name.replace("_", " ") + " in the live workers",
+        ["bind"],
+        multiprocess_mode="livesum",
+    )
+    for name in ("size", "checked_out", "overflow")
+}
+POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Connections checked out of the pool", ["bind"]
+)
+POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the pool",
+    ["bind"],
+    buckets=(0.0001, 0.0005,) + LATENCY_BUCKETS,
+)
+ADMISSION_RUNNING = Gauge(
+    "admission_requests_running",
+    "Admitted requests running in the live workers",
+    multiprocess_mode="livesum",
+)
+ADMISSION_GAUGES = {
+    name: Gauge(
+        "admission_requests_" + name,
+        "Requests " + name + " by admission control in the live workers",
+        ["class"] + (["reason"] if name == "shed" else []),
+        multiprocess_mode="livesum",
+    )
+    for name in ("waiting", "admitted", "shed")
+}
+ADMISSION_WAIT = Histogram(
+    "admission_wait_seconds",
+    "Time admitted requests waited to run",
+    ["class"],
+    buckets=(0.0001, 0.0005,) + LATENCY_BUCKETS,
+)
+
+
+def record_checkout(bind: str, waited: float):
+    """Pool listener that records a checkout and how long it waited"""
+    POOL_CHECKOUTS.labels(bind).inc()
+    POOL_WAIT.labels(bind).observe(waited)
+
+
+pool_listeners.append(record_checkout)
+
+
+def record_admission(rec_class: str, waited: float):
+    """Admission listener that records how long a request waited to run"""
+    ADMISSION_WAIT.labels(rec_class).observe(waited)
+
+
+admission_listeners.append(record_admission)
+
+
+######################################################################
+# SQL STATEMENT EVENTS
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Remembers when a statement started"""
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Records how long a statement took"""
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    DB_QUERY_LATENCY.labels(verb).observe(elapsed)
+    if has_app_context() and "queries" in g:
+        g.queries += 1
+
+
+######################################################################
+# REQUEST HOOKS
+######################################################################
+@app.before_request
+def start_timer():
+    """Remembers when the request started"""
+    g.start_time = time.perf_counter()
+    g.queries = 0
+
+
+@app.after_request
+def record_request(response):
+    """Records the latency and outcome of the request"""
+    if "start_time" not in g:
+        return response
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUEST_LATENCY.labels(request.method, route).observe(
+        time.perf_counter() - g.start_time
+    )
+    REQUEST_COUNT.labels(request.method, route, response.status_code).inc()
+    REQUEST_QUERIES.labels(request.method, route).observe(g.queries)
+    update_gauges()
+    return response
+
+
+def update_gauges():
+    """
+    Copies the cache, log, event, admission and pool counters of this
+    worker into its gauges
+    """
+    stats = recommendation_cache.stats()
+    for name, gauge in CACHE_GAUGES.items():
+        gauge.set(stats.get(name, 0))
+    stats = async_logging.stats()
+    for name, gauge in LOG_GAUGES.items():
+        gauge.set(stats[name])
+    stats = interaction_buffer.stats()
+    for name, gauge in EVENT_GAUGES.items():
+        gauge.set(stats[name])
+    stats = admission_control.stats()
+    ADMISSION_RUNNING.set(stats["running"])
+    for rec_class in PRIORITIES:
+        ADMISSION_GAUGES["waiting"].labels(rec_class).set(stats["waiting"][rec_class])
+        ADMISSION_GAUGES["admitted"].labels(rec_class).set(stats["admitted"][rec_class])
+        for reason in SHED_REASONS:
+            ADMISSION_GAUGES["shed"].labels(rec_class, reason).set(
+                stats["shed"][(rec_class, reason)]
+            )
+    engines = [("primary", db.engine)]
+    if "replica" in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        engines.append(("replica", db.get_engine(app, bind="replica")))
+    for bind, engine in engines:
+        for name, method in (
+            ("size", "size"),
+            ("checked_out", "checkedout"),
+            ("overflow", "overflow"),
+        ):
+            if hasattr(engine.pool, method):
+                POOL_GAUGES[name].labels(bind).set(getattr(engine.pool, method)())
+
+
+######################################################################
+# METRICS ENDPOINT
+######################################################################
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Returns the metrics of every worker in the Prometheus text format"""
+    update_gauges()  # requests shed since the last one never reached the hooks
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -4,14 +4,127 @@ Models for Product
 All of the models are stored in this module
 """
 import logging
-from flask_sqlalchemy import SQLAlchemy
-from flask import Flask
+import os
+import time
+import weakref
+from datetime import datetime
+from enum import Enum
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+from flask import Flask, current_app, has_request_context, request
+from service.group_commit import group_commit
 
 
 logger = logging.getLogger("flask.app")
 
+# Engine options that only a QueuePool understands
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout")
+
+# The range of an Integer column
+INT_MIN, INT_MAX = -(2 ** 31), 2 ** 31 - 1
+
+# Callbacks run after a connection is checked out of a pool, called as
+# callback(bind, seconds) with "primary" or "replica" and the time waited
+pool_listeners = []
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that reports how long every checkout waited"""
+
+    bind = "primary"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            for callback in pool_listeners:
+                callback(self.bind, waited)
+
+
+def reads_from_replica() -> bool:
+    """True while serving a read request and a replica is configured"""
+    return (
+        has_request_context()
+        and request.method in ("GET", "HEAD")
+        and "replica" in (current_app.config.get("SQLALCHEMY_BINDS") or {})
+    )
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends the reads of GET requests to the read replica
+
+    Everything else, and anything flushed, goes to the primary.
+    """
+
+    def __init__(self, db, **options):  # pylint: disable=invalid-name
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and reads_from_replica():
+            return self.db.get_engine(self.app, bind="replica")
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with read replica routing and instrumented connection pools
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._engines = weakref.WeakSet()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def dispose_engines(self):
+        """
+        Drops the pooled connections inherited from a parent process
+
+        The parent keeps its connections open, the child just forgets them
+        and opens its own on first use.
+        """
+        for engine in list(self._engines):
+            engine.dispose(close=False)
+
+    def create_engine(self, sa_url, engine_opts):
+        if sa_url.drivername.startswith("sqlite"):
+            # SQLite gets a null or singleton pool, which take no sizes
+            for option in QUEUE_POOL_OPTIONS:
+                engine_opts.pop(option, None)
+        else:
+            replica = (self.get_app().config.get("SQLALCHEMY_BINDS") or {}).get("replica")
+            bind = "replica" if replica and make_url(replica) == sa_url else "primary"
+            engine_opts.setdefault(
+                "poolclass", type(bind.title() + "Pool", (TimedQueuePool,), {"bind": bind})
+            )
+        engine = super().create_engine(sa_url, engine_opts)
+        self._engines.add(engine)
+        return engine
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+# gunicorn --preload forks workers from a process that may have connected
+os.register_at_fork(after_in_child=db.dispose_engines)
+
+
+# Callbacks run after a Product change is committed, called as
+# callback(action, product) where action is "create", "update", "delete"
+# or "bulk", which passes no product because many rows were inserted
+product_listeners = []
+
+# Callbacks run after Recommendations are written, called as
+# callback(source_ids) with the ids of the products whose links changed,
+# or None when the links of any product may have changed
+recommendation_listeners = []
 
 
 class DataValidationError(Exception):
@@ -20,6 +133,24 @@ class DataValidationError(Exception):
     pass
 
 
+def notify_product_listeners(action: str, product=None):
+    """Tells every registered listener that Products changed"""
+    for callback in product_listeners:
+        try:
+            callback(action, product)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Product listener %r failed on %s", callback, action)
+
+
+def notify_recommendation_listeners(source_ids):
+    """Tells every registered listener that Recommendations changed"""
+    for callback in recommendation_listeners:
+        try:
+            callback(source_ids)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Recommendation listener %r failed", callback)
+
+
 class Product(db.Model):
     """
     Class that represents a Product
@@ -32,6 +163,13 @@ class Product(db.Model):
     price = db.Column(db.Integer, nullable=False, default=0)
     name = db.Column(db.String(63), nullable=False)
     category = db.Column(db.String(63), nullable=False)
+    # Moved on by every change to what a lookup of the product returns: the
+    # product itself, its recommendations or a product they point to. It is
+    # what the ETags of the lookups are made of
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    # Price based lookups walk the products of one category in price order
+    __table_args__ = (db.Index("ix_product_category_price", "category", "price", "id"),)
 
     def create(self):
         """
@@ -39,8 +177,28 @@ class Product(db.Model):
         """
         logger.info("Creating %s", self.name)
         self.id = None  # id must be none to generate next primary key
+        if group_commit.enabled:
+            self._create_in_group()
+        else:
+            db.session.add(self)
+            db.session.commit()
+        notify_product_listeners("create", self)
+
+    def _create_in_group(self):
+        """Inserts the Product in the next group commit of the worker"""
+        row = {
+            column: getattr(self, column)
+            for column in ("name", "category", "price")
+            if getattr(self, column) is not None
+        }
+        table = Product.__table__
+        self.id = group_commit.submit(
+            lambda connection: connection.execute(table.insert(), row).inserted_primary_key[0]
+        )
+        self.version = 1
+        # it is known to be stored, so the session tracks it without a read
+        orm.make_transient_to_detached(self)
         db.session.add(self)
-        db.session.commit()
 
     def update(self):
         """
@@ -53,13 +211,59 @@ class Product(db.Model):
             raise DataValidationError("Update called with non-integer ID field")
         if type(self.price) is not int:
             raise DataValidationError("Update called with non-integer price field")
-        db.session.commit()
+        if group_commit.enabled:
+            self._update_in_group()
+        else:
+            self.version = Product.version + 1
+            Product.bump_versions(Recommendation.sources_of(self.id))
+            db.session.commit()
+        notify_product_listeners("update", self)
+
+    def _update_in_group(self):
+        """Writes the Product in the next group commit of the worker"""
+        table = Product.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == self.id)
+            .values(
+                name=self.name,
+                category=self.category,
+                price=self.price,
+                version=table.c.version + 1,
+            )
+        )
+        bump = Product.bump_statement(Recommendation.sources_of(self.id))
+
+        def apply(connection):
+            connection.execute(statement)
+            connection.execute(bump)
+
+        group_commit.submit(apply)
+        # the changes are stored, the session's copy is read again on use
+        if self in db.session:
+            db.session.expire(self)
 
     def delete(self):
-        """Removes a Pet from the data store"""
+        """Removes a Product and every link and count that refers to it"""
         logger.info("Deleting %s", self.name)
+        Product.bump_versions(Recommendation.sources_of(self.id))
+        # pruned by indexed lookups on both ends so the rest of the tables
+        # are left alone, and on backends that don't enforce ON DELETE too
+        Recommendation.query.filter(
+            db.or_(
+                Recommendation.source_product_id == self.id,
+                Recommendation.target_product_id == self.id,
+            )
+        ).delete(synchronize_session=False)
+        CoPurchaseCount.query.filter(
+            db.or_(
+                CoPurchaseCount.product_a == self.id,
+                CoPurchaseCount.product_b == self.id,
+            )
+        ).delete(synchronize_session=False)
         db.session.delete(self)
         db.session.commit()
+        notify_product_listeners("delete", self)
 
     def serialize(self) -> dict:
         """Serializes a Pet into a dictionary"""
@@ -68,6 +272,7 @@ class Product(db.Model):
             "price": self.price,
             "name": self.name,
             "category": self.category,
+            "version": self.version,
         }
 
     def deserialize(self, data: dict):
@@ -77,9 +282,23 @@ class Product(db.Model):
             data (dict): A dictionary containing the Pet data
         """
         try:
+            for field in ("name", "category"):
+                value = data[field]
+                if not isinstance(value, str):
+                    raise DataValidationError(
+                        "Invalid type for string [{}]:".format(field) + str(type(value))
+                    )
+                # checked here so the database never rejects a whole batch for one row
+                length = Product.__table__.c[field].type.length
+                if len(value) > length:
+                    raise DataValidationError(
+                        "Invalid [{}]: longer than {} characters".format(field, length)
+                    )
             self.name = data["name"]
             self.category = data["category"]
             if isinstance(data["price"], int):
+                if not INT_MIN <= data["price"] <= INT_MAX:
+                    raise DataValidationError("Invalid [price]: out of range")
                 self.price = data["price"]
             else:
                 raise DataValidationError(
@@ -103,10 +322,10 @@ class Product(db.Model):
         :type data: Flask
         """
         logger.info("Initializing database")
-        # This is where we initialize SQLAlchemy from the Flask app
+        # This is where we initialize SQLAlchemy from the Flask app. The
+        # engines connect on first use, so nothing touches the database
+        # here and the tables are made by the db-create command
         db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
 
     @classmethod
     def all(cls) -> list:
@@ -114,4 +333,718 @@ class Product(db.Model):
         logger.info("Processing all Products")
         return cls.query.all()
 
+    @classmethod
+    def page(cls, after: int = None, limit: int = 100) -> list:
+        """Returns up to limit Products with an id greater than after
+
+        Pages are keyed on the primary key instead of an OFFSET, so every
+        page is a single index range scan no matter how deep it is.
+        """
+        logger.info("Processing page of %s Products after %s", limit, after)
+        query = cls.query
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit).all()
+
+    @classmethod
+    def page_rows(cls, after: int = None, limit: int = 100) -> list:
+        """Returns the same page as page() as dictionaries
+
+        Only the columns are selected, so no ORM objects are hydrated or
+        tracked in the session's identity map.
+        """
+        logger.info("Processing page of %s Product rows after %s", limit, after)
+        query = db.session.query(cls.id, cls.price, cls.name, cls.category, cls.version)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return [cls.row_dict(row) for row in query.order_by(cls.id).limit(limit)]
+
+    @classmethod
+    def stream(cls, after: int = None, chunk_size: int = 1000):
+        """Yields every Product with an id greater than after as a dictionary
+
+        Rows are read as plain column tuples through a server-side cursor
+        chunk_size rows at a time, so memory stays flat however large the
+        table is.
+        """
+        logger.info("Streaming Products after %s", after)
+        query = db.session.query(cls.id, cls.price, cls.name, cls.category, cls.version)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        for row in query.order_by(cls.id).yield_per(chunk_size):
+            yield cls.row_dict(row)
+
+    @classmethod
+    def create_bulk(cls, rows, batch_size: int = 1000) -> tuple:
+        """
+        Creates many Products with one multi-row insert and commit per batch
+
+        Args:
+            rows: an iterable of (index, data) pairs, where data is the
+                dictionary to deserialize or a DataValidationError raised
+                while the row was being parsed
+            batch_size (int): the number of rows validated and inserted
+                in each transaction
+
+        Returns:
+            a tuple of (number of products created, list of per-row errors)
+        """
+        logger.info("Bulk creating Products in batches of %s", batch_size)
+        created = 0
+        errors = []
+        batch = []
+        for index, data in rows:
+            try:
+                if isinstance(data, DataValidationError):
+                    raise data
+                product = cls().deserialize(data)
+                batch.append(
+                    (
+                        index,
+                        {
+                            "name": product.name,
+                            "category": product.category,
+                            "price": product.price,
+                        },
+                    )
+                )
+            except DataValidationError as error:
+                errors.append({"index": index, "message": str(error)})
+            if len(batch) >= batch_size:
+                created += cls._insert_batch(batch, errors)
+                batch = []
+        if batch:
+            created += cls._insert_batch(batch, errors)
+        if created:
+            notify_product_listeners("bulk")
+        errors.sort(key=lambda error: error["index"])
+        logger.info("Bulk created %s Products with %s errors", created, len(errors))
+        return created, errors
+
+    @classmethod
+    def _insert_batch(cls, batch: list, errors: list) -> int:
+        """
+        Inserts one batch of validated rows in a single transaction, or
+        each row in its own if the database rejects the batch, so every
+        row that fails is reported with its own error
+        """
+        try:
+            db.session.execute(cls.__table__.insert(), [row for _, row in batch])
+            db.session.commit()
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            if len(batch) == 1:
+                message = "Rejected by the database: " + str(getattr(error, "orig", None) or error)
+                errors.append({"index": batch[0][0], "message": message})
+                return 0
+            logger.warning("Batch of %s rows rejected, inserting each alone", len(batch))
+            return sum(cls._insert_batch([row], errors) for row in batch)
+        return len(batch)
+
+    @classmethod
+    def find(cls, product_id: int):
+        """Finds a Product by its ID"""
+        logger.info("Processing lookup for id %s ...", product_id)
+        return db.session.get(cls, product_id)
+
+    @classmethod
+    def find_row(cls, product_id: int) -> dict:
+        """Finds a Product by its ID as a dictionary without hydrating it"""
+        logger.info("Processing row lookup for id %s ...", product_id)
+        return cls.row_dict(db.session.execute(cls.find_row_statement(product_id)).first())
+
+    @classmethod
+    def find_row_statement(cls, product_id: int):
+        """Returns the SELECT of find_row(), to run on any connection"""
+        return db.select(cls.id, cls.price, cls.name, cls.category, cls.version).where(
+            cls.id == product_id
+        )
+
+    @staticmethod
+    def row_dict(row) -> dict:
+        """Converts the row of find_row_statement() into a dictionary or None"""
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "price": row[1],
+            "name": row[2],
+            "category": row[3],
+            "version": row[4],
+        }
+
+    @classmethod
+    def find_version(cls, product_id: int) -> int:
+        """Returns the version of a Product, or None if there is none"""
+        return db.session.execute(db.select(cls.version).where(cls.id == product_id)).scalar()
+
+    @classmethod
+    def versions(cls, product_ids: list) -> dict:
+        """Returns the versions of the Products that exist by their id"""
+        return dict(db.session.execute(cls.versions_statement(product_ids)).all())
+
+    @classmethod
+    def versions_statement(cls, product_ids: list):
+        """Returns the SELECT of versions(), to run on any connection"""
+        return db.select(cls.id, cls.version).where(cls.id.in_(product_ids))
+
+    @classmethod
+    def bump_versions(cls, product_ids=None):
+        """
+        Moves the version of Products on in the current transaction
+
+        Args:
+            product_ids: the ids, or a SELECT of them, or None for every
+                Product
+
+        A list of ids is updated 1000 at a time, keeping the IN lists short.
+        """
+        if not isinstance(product_ids, (list, tuple)):
+            db.session.execute(cls.bump_statement(product_ids))
+            return
+        for start in range(0, len(product_ids), 1000):
+            db.session.execute(cls.bump_statement(product_ids[start:start + 1000]))
+
+    @classmethod
+    def bump_statement(cls, product_ids=None):
+        """Returns the UPDATE of bump_versions(), to run on any connection"""
+        table = cls.__table__
+        statement = table.update().values(version=table.c.version + 1)
+        if product_ids is not None:
+            statement = statement.where(table.c.id.in_(product_ids))
+        return statement
+
+
+class RecommendationType(Enum):
+    """Enumeration of valid Recommendation types"""
+
+    CROSS_SELL = "cross_sell"
+    UPSELL = "upsell"
+    ACCESSORY = "accessory"
+
+    @classmethod
+    def parse(cls, value: str):
+        """Converts a query or body value into a RecommendationType"""
+        try:
+            return cls(str(value).lower())
+        except ValueError:
+            raise DataValidationError("Invalid recommendation type: " + str(value))
+
+
+class Recommendation(db.Model):
+    """
+    Class that represents a typed link from a source Product to a target Product
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    source_product_id = db.Column(
+        db.Integer, db.ForeignKey("product.id", ondelete="CASCADE"), nullable=False
+    )
+    target_product_id = db.Column(
+        db.Integer, db.ForeignKey("product.id", ondelete="CASCADE"), nullable=False
+    )
+    # stored as the member name so links sort by type the same on every backend
+    type = db.Column(db.Enum(RecommendationType, native_enum=False), nullable=False)
+    rank = db.Column(db.Integer, nullable=False, default=0)
+    # Links computed by a pipeline carry its score and name, curated links
+    # have neither, so a rebuild only replaces the links of its own pipeline
+    score = db.Column(db.Float, nullable=True)
+    origin = db.Column(db.String(31), nullable=True)
+
+    # Product pages look recommendations up by source and type ordered by
+    # rank on every view, so that lookup must be an index range scan
+    __table_args__ = (
+        db.Index("ix_recommendation_source_type_rank", "source_product_id", "type", "rank"),
+        db.Index("ix_recommendation_target", "target_product_id"),
+        db.UniqueConstraint(
+            "source_product_id", "target_product_id", "type",
+            name="uq_recommendation_source_target_type",
+        ),
+    )
+
+    def create(self):
+        """
+        Creates a Recommendation to the database
+        """
+        logger.info(
+            "Creating %s recommendation %s -> %s",
+            self.type, self.source_product_id, self.target_product_id,
+        )
+        self.id = None  # id must be none to generate next primary key
+        db.session.add(self)
+        try:
+            Product.bump_versions([self.source_product_id])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise DataValidationError(
+                "Recommendation {} -> {} of type {} already exists".format(
+                    self.source_product_id, self.target_product_id, self.type.value
+                )
+            )
+        notify_recommendation_listeners([self.source_product_id])
+
+    def delete(self):
+        """Removes a Recommendation from the data store"""
+        logger.info("Deleting recommendation %s", self.id)
+        db.session.delete(self)
+        Product.bump_versions([self.source_product_id])
+        db.session.commit()
+        notify_recommendation_listeners([self.source_product_id])
+
+    def serialize(self) -> dict:
+        """Serializes a Recommendation into a dictionary"""
+        return {
+            "id": self.id,
+            "source_product_id": self.source_product_id,
+            "target_product_id": self.target_product_id,
+            "type": self.type.value,
+            "rank": self.rank,
+            "score": self.score,
+        }
+
+    def deserialize(self, data: dict):
+        """
+        Deserializes a Recommendation from a dictionary
+        Args:
+            data (dict): A dictionary containing the Recommendation data
+        """
+        try:
+            self.target_product_id = data["target_product_id"]
+            if not isinstance(self.target_product_id, int):
+                raise DataValidationError(
+                    "Invalid type for integer [target_product_id]:"
+                    + str(type(data["target_product_id"]))
+                )
+            self.type = RecommendationType.parse(data["type"])
+            self.rank = data.get("rank", 0)
+            if not isinstance(self.rank, int):
+                raise DataValidationError(
+                    "Invalid type for integer [rank]:" + str(type(data["rank"]))
+                )
+        except AttributeError as error:
+            raise DataValidationError("Invalid attribute: " + error.args[0])
+        except KeyError as error:
+            raise DataValidationError(
+                "Invalid recommendation: missing " + error.args[0]
+            )
+        except TypeError as error:
+            raise DataValidationError(
+                "Invalid recommendation: body of request contained bad or no data "
+                + str(error)
+            )
+        return self
+
+    @classmethod
+    def sources_of(cls, product_id: int):
+        """Returns a SELECT of the products that link to a Product"""
+        return db.select(cls.source_product_id).where(cls.target_product_id == product_id)
+
+    @classmethod
+    def lookup(cls, product_id: int, rec_type: RecommendationType = None) -> list:
+        """Returns the recommendations of a Product as dictionaries
+
+        The links and their target products are read with a single query that
+        walks the (source_product_id, type, rank) index and joins the target
+        columns in, so no ORM objects are hydrated or lazily loaded per row.
+        """
+        logger.info("Processing recommendations for product %s", product_id)
+        return cls.link_dicts(db.session.execute(cls.lookup_statement(product_id, rec_type)))
+
+    @classmethod
+    def lookup_statement(cls, product_id: int, rec_type: RecommendationType = None):
+        """Returns the SELECT of lookup(), to run on any connection"""
+        statement = (
+            db.select(
+                cls.target_product_id,
+                cls.type,
+                cls.rank,
+                cls.score,
+                Product.name,
+                Product.category,
+                Product.price,
+            )
+            .join(Product, Product.id == cls.target_product_id)
+            .where(cls.source_product_id == product_id)
+        )
+        if rec_type is not None:
+            statement = statement.where(cls.type == rec_type)
+        return statement.order_by(cls.type, cls.rank)
+
+    @staticmethod
+    def link_dicts(rows) -> list:
+        """Converts the rows of lookup_statement() into dictionaries"""
+        return [
+            {
+                "product_id": target_id,
+                "type": link_type.value,
+                "rank": rank,
+                "score": score,
+                "name": name,
+                "category": category,
+                "price": price,
+            }
+            for target_id, link_type, rank, score, name, category, price in rows
+        ]
+
+    @classmethod
+    def lookup_many(cls, product_ids: list, rec_types: list = None, limit: int = None) -> dict:
+        """Returns the recommendations of many Products grouped by product id
+
+        All of the products are answered by one query on source_product_id
+        IN (...), and the per-product limit is applied in SQL by numbering
+        the links of each source with a ROW_NUMBER() window.
+        """
+        logger.info("Processing recommendations for %s products", len(product_ids))
+        statement = cls.lookup_many_statement(product_ids, rec_types, limit)
+        return cls.grouped_link_dicts(product_ids, db.session.execute(statement))
+
+    @classmethod
+    def lookup_many_statement(cls, product_ids: list, rec_types: list = None, limit: int = None):
+        """Returns the SELECT of lookup_many(), to run on any connection"""
+        position = (
+            db.func.row_number()
+            .over(partition_by=cls.source_product_id, order_by=(cls.type, cls.rank))
+            .label("position")
+        )
+        ranked = db.select(
+            cls.source_product_id,
+            cls.target_product_id,
+            cls.type,
+            cls.rank,
+            cls.score,
+            position,
+        ).where(cls.source_product_id.in_(product_ids))
+        if rec_types:
+            ranked = ranked.where(cls.type.in_(rec_types))
+        ranked = ranked.subquery()
+
+        statement = db.select(
+            ranked.c.source_product_id,
+            ranked.c.target_product_id,
+            ranked.c.type,
+            ranked.c.rank,
+            ranked.c.score,
+            Product.name,
+            Product.category,
+            Product.price,
+        ).join(Product, Product.id == ranked.c.target_product_id)
+        if limit is not None:
+            statement = statement.where(ranked.c.position <= limit)
+        return statement.order_by(ranked.c.source_product_id, ranked.c.position)
+
+    @staticmethod
+    def grouped_link_dicts(product_ids: list, rows) -> dict:
+        """Converts the rows of lookup_many_statement() into dictionaries"""
+        results = {product_id: [] for product_id in product_ids}
+        for source_id, target_id, link_type, rank, score, name, category, price in rows:
+            results[source_id].append(
+                {
+                    "product_id": target_id,
+                    "type": link_type.value,
+                    "rank": rank,
+                    "score": score,
+                    "name": name,
+                    "category": category,
+                    "price": price,
+                }
+            )
+        return results
+
+
+class CoPurchaseCount(db.Model):
+    """
+    Class that represents how many orders contained a pair of Products
+
+    Pairs are stored once with product_a <= product_b, and the pair of a
+    Product with itself holds the number of orders that contained it.
+    """
+
+    # Table Schema
+    product_a = db.Column(
+        db.Integer, db.ForeignKey("product.id", ondelete="CASCADE"), primary_key=True
+    )
+    product_b = db.Column(
+        db.Integer,
+        db.ForeignKey("product.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class CoPurchaseWatermark(db.Model):
+    """
+    Class that represents how much of the order log has been counted
+
+    There is a single row: the highest order id counted so far and the
+    number of orders counted, which lift scores are relative to.
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    last_order_id = db.Column(db.BigInteger, nullable=False, default=0)
+    orders = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def get(cls):
+        """Returns the watermark, creating it if the log was never counted"""
+        watermark = db.session.get(cls, 1)
+        if watermark is None:
+            watermark = cls(id=1, last_order_id=0, orders=0)
+            db.session.add(watermark)
+        return watermark
+
+
+class InteractionCount(db.Model):
+    """
+    Class that represents how often a Recommendation was shown and clicked
+
+    The counts are added to in aggregated batches by the event buffer, one
+    row per (source, target, type) link.
+    """
+
+    # Table Schema
+    source_product_id = db.Column(
+        db.Integer, db.ForeignKey("product.id", ondelete="CASCADE"), primary_key=True
+    )
+    target_product_id = db.Column(
+        db.Integer, db.ForeignKey("product.id", ondelete="CASCADE"), primary_key=True
+    )
+    type = db.Column(db.Enum(RecommendationType, native_enum=False), primary_key=True)
+    impressions = db.Column(db.BigInteger, nullable=False, default=0)
+    clicks = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def increment(cls, rows: list):
+        """
+        Adds impressions and clicks to the counts of links with one upsert
+
+        Args:
+            rows (list): dictionaries of source_product_id, target_product_id,
+                type, impressions and clicks
+        """
+        table = cls.__table__
+        statement = increment_statement(
+            table,
+            [table.c.source_product_id, table.c.target_product_id, table.c.type],
+            [table.c.impressions, table.c.clicks],
+        )
+        db.session.execute(statement, rows)
+        db.session.commit()
+
+    @classmethod
+    def counts_of(cls, source_ids: list) -> dict:
+        """Returns {(source, target, type): (impressions, clicks)} of the sources"""
+        rows = db.session.query(
+            cls.source_product_id, cls.target_product_id, cls.type, cls.impressions, cls.clicks
+        ).filter(cls.source_product_id.in_(source_ids))
+        return {
+            (source, target, rec_type): (impressions, clicks)
+            for source, target, rec_type, impressions, clicks in rows
+        }
+
+
+class JobStatus(Enum):
+    """Enumeration of the states of a Job and of its partitions"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class Job(db.Model):
+    """
+    Class that represents a background recomputation and its progress
+
+    The table is the queue: a runner claims the oldest queued Job by moving
+    it to running, and keeps its heartbeat fresh while it works on it.
+    """
+
+    # Table Schema
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(31), nullable=False)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(
+        db.Enum(JobStatus, native_enum=False), nullable=False, default=JobStatus.QUEUED
+    )
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    partitions_total = db.Column(db.Integer, nullable=False, default=0)
+    partitions_done = db.Column(db.Integer, nullable=False, default=0)
+    written = db.Column(db.BigInteger, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    runner = db.Column(db.String(63), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+
+    # Runners look for the oldest queued job on every poll
+    __table_args__ = (db.Index("ix_job_status_id", "status", "id"),)
+
+    def create(self):
+        """
+        Queues a Job
+        """
+        logger.info("Queueing %s job", self.kind)
+        self.id = None  # id must be none to generate next primary key
+        self.status = JobStatus.QUEUED
+        db.session.add(self)
+        db.session.commit()
+
+    def serialize(self) -> dict:
+        """Serializes a Job into a dictionary"""
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "status": self.status.value,
+            "cancel_requested": self.cancel_requested,
+            "progress": {"done": self.partitions_done, "total": self.partitions_total},
+            "written": self.written,
+            "error": self.error,
+            "created_at": _isoformat(self.created_at),
+            "started_at": _isoformat(self.started_at),
+            "finished_at": _isoformat(self.finished_at),
+        }
+
+    def cancel(self) -> bool:
+        """
+        Cancels a queued Job, or asks the runner of a running one to stop,
+        and returns False if the Job had already ended
+        """
+        logger.info("Cancelling job %s", self.id)
+        cancelled = Job.query.filter(Job.id == self.id, Job.status == JobStatus.QUEUED).update(
+            {"status": JobStatus.CANCELLED, "finished_at": datetime.utcnow()},
+            synchronize_session=False,
+        )
+        db.session.commit()
+        db.session.refresh(self)
+        if cancelled:
+            return True
+        if self.status != JobStatus.RUNNING:
+            return False
+        self.cancel_requested = True
+        db.session.commit()
+        return True
+
+    def resume(self) -> bool:
+        """
+        Queues a failed or cancelled Job again to run the partitions that
+        did not succeed, and returns False if it had not stopped
+        """
+        if self.status not in (JobStatus.FAILED, JobStatus.CANCELLED):
+            return False
+        logger.info("Resuming job %s", self.id)
+        JobPartition.query.filter(
+            JobPartition.job_id == self.id, JobPartition.status == JobStatus.FAILED
+        ).update({"status": JobStatus.QUEUED, "error": None}, synchronize_session=False)
+        self.status = JobStatus.QUEUED
+        self.cancel_requested = False
+        self.error = None
+        self.finished_at = None
+        db.session.commit()
+        return True
+
+    @classmethod
+    def find(cls, job_id: int):
+        """Finds a Job by its ID"""
+        logger.info("Processing lookup for job id %s ...", job_id)
+        return db.session.get(cls, job_id)
+
+    @classmethod
+    def recent(cls, limit: int = 100) -> list:
+        """Returns the latest Jobs, newest first"""
+        return cls.query.order_by(cls.id.desc()).limit(limit).all()
+
+    @classmethod
+    def claim(cls, runner: str):
+        """
+        Moves the oldest queued Job to running and returns it, or None
+
+        The move only succeeds if the Job is still queued, so two runners
+        polling the same table never both claim it.
+        """
+        while True:
+            candidate = (
+                db.session.query(cls.id)
+                .filter(cls.status == JobStatus.QUEUED)
+                .order_by(cls.id)
+                .first()
+            )
+            if candidate is None:
+                db.session.commit()
+                return None
+            now = datetime.utcnow()
+            claimed = (
+                cls.query.filter(cls.id == candidate[0], cls.status == JobStatus.QUEUED)
+                .update(
+                    {"status": JobStatus.RUNNING, "runner": runner, "heartbeat_at": now},
+                    synchronize_session=False,
+                )
+            )
+            db.session.commit()
+            if claimed:
+                job = db.session.get(cls, candidate[0])
+                job.started_at = job.started_at or now
+                db.session.commit()
+                return job
+
+    @classmethod
+    def requeue_stale(cls, before: datetime) -> int:
+        """Queues the running Jobs whose runner was last seen before a time"""
+        requeued = cls.query.filter(
+            cls.status == JobStatus.RUNNING, cls.heartbeat_at < before
+        ).update({"status": JobStatus.QUEUED, "runner": None}, synchronize_session=False)
+        db.session.commit()
+        return requeued
+
+
+class JobPartition(db.Model):
+    """
+    Class that represents one slice of the work of a Job
+
+    Partitions are run phase by phase, and the ones that succeeded are the
+    checkpoint a resumed Job starts from.
+    """
+
+    # Table Schema
+    job_id = db.Column(db.Integer, db.ForeignKey("job.id", ondelete="CASCADE"), primary_key=True)
+    number = db.Column(db.Integer, primary_key=True)
+    phase = db.Column(db.Integer, nullable=False, default=0)
+    key = db.Column(db.JSON, nullable=False)
+    status = db.Column(
+        db.Enum(JobStatus, native_enum=False), nullable=False, default=JobStatus.QUEUED
+    )
+    written = db.Column(db.BigInteger, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    @classmethod
+    def of(cls, job_id: int) -> list:
+        """Returns the partitions of a Job in the order they run"""
+        return cls.query.filter(cls.job_id == job_id).order_by(cls.phase, cls.number).all()
+
+
+def _isoformat(value):
+    """Returns a datetime in ISO 8601 format, or None"""
+    return value.isoformat() if value is not None else None
+
 
+def increment_statement(table, index_elements: list, counters: list):
+    """Returns an INSERT that adds to the counters of an existing row"""
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError("Incremental counts are not supported on " + dialect)
+    statement = insert(table)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={column.name: column + statement.excluded[column.name] for column in counters},
+    )
@@ -0,0 +1,215 @@
+"""
+Price Index
+
+An in-process index of the catalog that keeps one sorted list of
+(price, id) keys per category, so that upsells (the next more expensive
+products of the same category) and cross-sells (the products of the same
+category nearest in price) are found by bisection instead of SQL range
+scans.
+
+It is built and kept current as service.index describes, when
+PRICE_INDEX_AUTOBUILD is set, and rebuilt every PRICE_INDEX_TTL seconds.
+Until it is warm, lookups are answered from the database.
+"""
+import bisect
+import logging
+
+from service.index import InProcessIndex
+from service.models import Product, RecommendationType, db, product_listeners
+
+logger = logging.getLogger("flask.app")
+
+PRICE_TYPES = (RecommendationType.UPSELL, RecommendationType.CROSS_SELL)
+
+
+def nearest(price: int, below, above, count: int) -> list:
+    """
+    Merges two candidate lists into the ids of the count nearest in price
+
+    Args:
+        price (int): the price to be near to
+        below: (price, id) keys under price, nearest first
+        above: (price, id) keys over price, nearest first
+        count (int): the number of ids to return
+
+    Ties go to the cheaper product.
+    """
+    below, above = iter(below), iter(above)
+    lower, upper = next(below, None), next(above, None)
+    ids = []
+    while len(ids) < count and (lower or upper):
+        if upper is None or (lower is not None and price - lower[0] <= upper[0] - price):
+            ids.append(lower[1])
+            lower = next(below, None)
+        else:
+            ids.append(upper[1])
+            upper = next(above, None)
+    return ids
+
+
+class PriceIndex(InProcessIndex):
+    """
+    Sorted per-category price lists of the catalog
+    """
+
+    name = "price index"
+    config = "PRICE_INDEX"
+
+    def __init__(self):
+        super().__init__()
+        self._reset()
+
+    def __len__(self) -> int:
+        return len(self._products)
+
+    def _reset(self):
+        """Empties the index, the lock must be held"""
+        self._categories = {}  # category -> sorted list of (price, id)
+        self._products = {}  # id -> (category, price)
+
+    def _build(self):
+        """Reads the Product table into new price lists"""
+        categories = {}
+        products = {}
+        rows = db.session.query(Product.id, Product.category, Product.price)
+        for product_id, category, price in rows.yield_per(10000):
+            categories.setdefault(category, []).append((price, product_id))
+            products[product_id] = (category, price)
+        for keys in categories.values():
+            keys.sort()
+        with self._lock:
+            self._categories = categories
+            self._products = products
+            # replaying is safe: every change drops the old key of its id first
+            self._built()
+
+    def _change(self, action: str, product: Product) -> tuple:
+        """Returns the arguments of _apply() for a Product change"""
+        return (action, product.id, product.category, product.price)
+
+    def _apply(self, action: str, product_id: int, category: str, price: int):
+        """Applies one Product change to the index"""
+        old = self._products.pop(product_id, None)
+        if old is not None:
+            keys = self._categories[old[0]]
+            i = bisect.bisect_left(keys, (old[1], product_id))
+            if i < len(keys) and keys[i] == (old[1], product_id):
+                del keys[i]
+            if not keys:
+                del self._categories[old[0]]
+        if action != "delete":
+            bisect.insort(self._categories.setdefault(category, []), (price, product_id))
+            self._products[product_id] = (category, price)
+
+    def upsell(self, product_id: int, count: int) -> list:
+        """
+        Returns the ids of the count cheapest products of the same category
+        that are more expensive, or None if the product is not indexed
+        """
+        with self._lock:
+            if product_id not in self._products:
+                return None
+            category, price = self._products[product_id]
+            keys = self._categories[category]
+            i = bisect.bisect_right(keys, (price, float("inf")))
+            return [key[1] for key in keys[i:i + count]]
+
+    def cross_sell(self, product_id: int, count: int) -> list:
+        """
+        Returns the ids of the count products of the same category nearest
+        in price, or None if the product is not indexed
+        """
+        with self._lock:
+            if product_id not in self._products:
+                return None
+            category, price = self._products[product_id]
+            keys = self._categories[category]
+            i = bisect.bisect_left(keys, (price, product_id))
+            below = (keys[j] for j in range(i - 1, -1, -1))
+            above = (keys[j] for j in range(i + 1, len(keys)))
+            return nearest(price, below, above, count)
+
+
+def query_upsell(product: Product, count: int) -> list:
+    """Returns the ids of the upsells of a Product from the database"""
+    rows = (
+        db.session.query(Product.id)
+        .filter(Product.category == product.category, Product.price > product.price)
+        .order_by(Product.price, Product.id)
+        .limit(count)
+    )
+    return [product_id for (product_id,) in rows]
+
+
+def query_cross_sell(product: Product, count: int) -> list:
+    """Returns the ids of the cross-sells of a Product from the database"""
+    same_category = db.session.query(Product.price, Product.id).filter(
+        Product.category == product.category
+    )
+    below = (
+        same_category.filter(
+            db.or_(
+                Product.price < product.price,
+                db.and_(Product.price == product.price, Product.id < product.id),
+            )
+        )
+        .order_by(Product.price.desc(), Product.id.desc())
+        .limit(count)
+    )
+    above = (
+        same_category.filter(
+            db.or_(
+                Product.price > product.price,
+                db.and_(Product.price == product.price, Product.id > product.id),
+            )
+        )
+        .order_by(Product.price, Product.id)
+        .limit(count)
+    )
+    return nearest(product.price, below.all(), above.all(), count)
+
+
+def recommend(product: Product, rec_type: RecommendationType, count: int) -> list:
+    """
+    Returns the price based recommendations of a Product as dictionaries
+
+    The index answers when it is warm, otherwise the database does and a
+    build is started when PRICE_INDEX_AUTOBUILD is set.
+    """
+    if rec_type not in PRICE_TYPES:
+        raise ValueError("No price based recommendations of type " + rec_type.value)
+    ids = None
+    if price_index.refresh():
+        if rec_type == RecommendationType.UPSELL:
+            ids = price_index.upsell(product.id, count)
+        else:
+            ids = price_index.cross_sell(product.id, count)
+    if ids is None:
+        logger.info("Price index is cold, using the database")
+        if rec_type == RecommendationType.UPSELL:
+            ids = query_upsell(product, count)
+        else:
+            ids = query_cross_sell(product, count)
+    if not ids:
+        return []
+
+    rows = db.session.query(Product.id, Product.name, Product.category, Product.price)
+    found = {row[0]: row for row in rows.filter(Product.id.in_(ids))}
+    return [
+        {
+            "product_id": product_id,
+            "type": rec_type.value,
+            "rank": rank,
+            "score": None,
+            "name": found[product_id][1],
+            "category": found[product_id][2],
+            "price": found[product_id][3],
+        }
+        for rank, product_id in enumerate(ids, start=1)
+        if product_id in found
+    ]
+
+
+# The index shared by every request of this worker
+price_index = PriceIndex()
+product_listeners.append(price_index.on_change)
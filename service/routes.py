@@ -4,17 +4,33 @@ Recommendations Service
 The recommendations resource is a representation a product recommendation based on another product
 """
 
+import hashlib
+import json
 from flask import jsonify, request, url_for, make_response, abort
+from flask import Response, stream_with_context
 from . import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from service.admission import admission_control
+from service.cache import recommendation_cache
+from service.group_commit import group_commit
+from service.snapshot import recommendation_snapshot
 
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
-from service.models import Product
+from service.models import (
+    DataValidationError,
+    Job,
+    Product,
+    Recommendation,
+    RecommendationType,
+    db,
+)
 
 # Import Flask application
-from . import app
+from . import app, events, fastjson, graph, jobs, price_index, search, similarity
+
+NDJSON = "application/x-ndjson"
 
 ######################################################################
 # GET INDEX
@@ -33,6 +49,45 @@ def index():
     )
 
 
+######################################################################
+# LIST ALL PRODUCTS
+######################################################################
+@app.route("/recommendations", methods=["GET"])
+def list_products():
+    """
+    Returns a page of Products keyed on their id
+    Use ?limit= and ?after= to page through the catalog, following the next
+    link, or send Accept: application/x-ndjson to stream every Product
+    """
+    app.logger.info("Request for product list")
+    after = get_int_arg("after")
+    if request.accept_mimetypes.best == NDJSON:
+        rows = Product.stream(after)
+        body = (fastjson.dumps(row) + b"\n" for row in rows)
+        return Response(stream_with_context(body), mimetype=NDJSON)
+
+    limit = get_int_arg("limit", app.config["PAGE_SIZE_DEFAULT"])
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]),
+        )
+    results = Product.page_rows(after, limit)
+    tag = digest_etag(limit, [(row["id"], row["version"]) for row in results])
+    if request.if_none_match.contains_weak(tag):
+        return not_modified(tag)
+    headers = {}
+    if len(results) == limit:
+        next_url = url_for(
+            "list_products", after=results[-1]["id"], limit=limit, _external=True
+        )
+        headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    app.logger.info("Returning %d products", len(results))
+    response = fastjson.json_response(results, status.HTTP_200_OK, headers)
+    response.set_etag(tag)
+    return response
+
+
 @app.route("/recommendations", methods=["POST"])
 def create_products():
     """
@@ -40,9 +95,14 @@ def create_products():
     This endpoint will create a Product based the data in the body that is posted
     """
     app.logger.info("Request to create a Product")
-    check_content_type("application/json")
+    check_content_type("application/json", NDJSON)
+    if request.headers.get("Content-Type") == NDJSON:
+        return create_products_bulk(read_ndjson_rows())
+    data = request.get_json()
+    if isinstance(data, list):
+        return create_products_bulk(enumerate(data))
     product = Product()
-    product.deserialize(request.get_json())
+    product.deserialize(data)
     product.create()
     message = product.serialize()
     location_url = url_for("get_products", item_id=product.id, _external=True)
@@ -53,21 +113,592 @@ def create_products():
     )
 
 
+def create_products_bulk(rows):
+    """
+    Creates many Products from (index, data) rows
+    Rows are validated and inserted in batches, one transaction per batch,
+    and the rows that could not be created are reported by their index
+    """
+    created, errors = Product.create_bulk(rows, app.config["BULK_BATCH_SIZE"])
+    app.logger.info("Bulk request created %s products, %s failed", created, len(errors))
+    return make_response(
+        jsonify(created=created, failed=len(errors), errors=errors),
+        status.HTTP_201_CREATED if created or not errors else status.HTTP_400_BAD_REQUEST,
+    )
+
+
+######################################################################
+# READ A PRODUCT AND ITS RECOMMENDATIONS
+######################################################################
+@app.route("/recommendations/<int:item_id>", methods=["GET"])
+def get_products(item_id):
+    """
+    Retrieve a single Product with its recommendations
+    The recommendations can be narrowed with a ?type= query parameter and
+    ranked by their smoothed click-through rate with ?order=ctr
+
+    ?depth=n follows the links up to n hops deep and ?path=upsell,accessory
+    follows one link of each listed type per hop, returning the products at
+    the end of the path. Both rank by path score and take ?limit= and ?decay=
+
+    Lookups ranked by rank carry an ETag made of the product's version, and
+    one that still matches the If-None-Match of the request is answered
+    with 304 from the version alone
+    """
+    app.logger.info("Request for product with id: %s", item_id)
+    rec_type = request.args.get("type")
+    if rec_type is not None:
+        rec_type = RecommendationType.parse(rec_type)
+    if "depth" in request.args or "path" in request.args:
+        return get_multi_hop_recommendations(item_id, rec_type)
+
+    def lookup():
+        message = recommendation_snapshot.lookup(item_id, rec_type)
+        if message is None:
+            message = Product.find_row(item_id)
+            if not message:
+                raise NotFound("Product with id '{}' was not found.".format(item_id))
+            message["recommendations"] = Recommendation.lookup(item_id, rec_type)
+        return message
+
+    order = get_order_arg(request.args.get("order"))
+    message = None
+    if order == "rank" and request.if_none_match:
+        message = recommendation_cache.get(item_id, rec_type)
+        version = message["version"] if message else lookup_version(item_id, rec_type)
+        tag = lookup_etag(item_id, version, rec_type)
+        if version is not None and request.if_none_match.contains_weak(tag):
+            return not_modified(tag)
+    if message is None:
+        message = recommendation_cache.get_or_compute(item_id, rec_type, lookup)
+    if order == "ctr":
+        message = dict(message)
+        message["recommendations"] = events.interaction_buffer.order_by_ctr(
+            {item_id: message["recommendations"]}
+        )[item_id]
+    app.logger.info("Returning product: %s", message["name"])
+    response = fastjson.json_response(message, status.HTTP_200_OK)
+    if order == "rank":
+        response.set_etag(lookup_etag(item_id, message["version"], rec_type))
+    return response
+
+
+def lookup_version(item_id, rec_type):
+    """
+    Returns the version a lookup would be answered with, from the snapshot
+    or else the product row alone, or None if there is no such product
+    """
+    message = recommendation_snapshot.lookup(item_id, rec_type)
+    if message is not None:
+        return message["version"]
+    return Product.find_version(item_id)
+
+
+def get_multi_hop_recommendations(item_id, rec_type):
+    """Answers a ?depth= or ?path= lookup from the recommendation graph"""
+    depth = get_int_arg("depth")
+    path = request.args.get("path")
+    names = path.split(",") if path is not None else None
+    if names is not None and depth is not None and depth != len(names):
+        abort(status.HTTP_400_BAD_REQUEST, "depth must match the length of path")
+    # checked before the hops are built, so a huge depth costs nothing
+    if not 0 < (len(names) if names is not None else depth) <= app.config["GRAPH_MAX_DEPTH"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "depth must be between 1 and {}".format(app.config["GRAPH_MAX_DEPTH"]),
+        )
+    if names is not None:
+        hop_types = [[RecommendationType.parse(name)] for name in names]
+        min_hops = len(hop_types)
+    else:
+        hop_types = [[rec_type] if rec_type else []] * depth
+        min_hops = 1
+    limit = get_int_arg("limit", 20)
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]),
+        )
+    decay = request.args.get("decay")
+    if decay is not None:
+        try:
+            decay = float(decay)
+        except ValueError:
+            decay = None
+        if decay is None or not 0 < decay <= 1:
+            abort(status.HTTP_400_BAD_REQUEST, "decay must be a number in (0, 1]")
+
+    message = Product.find_row(item_id)
+    if not message:
+        raise NotFound("Product with id '{}' was not found.".format(item_id))
+    message["recommendations"] = graph.recommend(item_id, hop_types, limit, decay, min_hops)
+    return fastjson.json_response(message, status.HTTP_200_OK)
+
+
+######################################################################
+# READ THE RECOMMENDATIONS OF MANY PRODUCTS
+######################################################################
+@app.route("/recommendations/batch", methods=["GET", "POST"])
+def get_recommendations_batch():
+    """
+    Retrieve the recommendations of many Products at once
+    POST a JSON body of {"product_ids": [...], "types": [...], "limit": n,
+    "order": "ctr"} or GET with repeated ?product_id= and ?type= parameters,
+    ?limit= and ?order=
+
+    A GET ranked by rank carries an ETag made of the versions of its
+    products, which are read before their links, and one that still
+    matches the If-None-Match of the request is answered with 304 without
+    reading the links
+    """
+    app.logger.info("Request for a batch of recommendations")
+    if request.method == "POST":
+        check_content_type("application/json")
+        data = request.get_json()
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid batch: body must be a JSON object")
+        product_ids = data.get("product_ids")
+        rec_types = data.get("types") or []
+        limit = data.get("limit")
+        order = data.get("order")
+    else:
+        try:
+            product_ids = [int(value) for value in request.args.getlist("product_id")]
+        except ValueError:
+            raise DataValidationError("product_id must be an integer")
+        rec_types = request.args.getlist("type")
+        limit = get_int_arg("limit")
+        order = request.args.get("order")
+    product_ids, rec_types, limit = validate_batch(product_ids, rec_types, limit)
+    order = get_order_arg(order)
+
+    tag = None
+    versions = {} if request.method == "GET" and order == "rank" else None
+    # ?order=ctr ranks every link of a product before the limit is applied
+    fetch = None if order == "ctr" else limit
+    found = recommendation_snapshot.lookup_many(product_ids, rec_types, fetch, versions)
+    missing = [product_id for product_id in product_ids if product_id not in found]
+    if versions is not None:
+        if missing:
+            versions.update(Product.versions(missing))
+        tag = batch_etag(product_ids, versions, rec_types, limit)
+        if request.if_none_match.contains_weak(tag):
+            return not_modified(tag)
+    if missing:
+        found.update(Recommendation.lookup_many(missing, rec_types, fetch))
+    if order == "ctr":
+        found = events.interaction_buffer.order_by_ctr(
+            {product_id: found[product_id] for product_id in product_ids}
+        )
+        found = {product_id: links[:limit] for product_id, links in found.items()}
+    results = [
+        {"product_id": product_id, "recommendations": found[product_id]}
+        for product_id in product_ids
+    ]
+    app.logger.info("Returning recommendations of %s products", len(results))
+    response = fastjson.json_response(results, status.HTTP_200_OK)
+    if tag is not None:
+        response.set_etag(tag)
+    return response
+
+
+def validate_batch(product_ids, rec_types, limit):
+    """
+    Checks the parameters of a batch and returns the unique product ids,
+    the RecommendationTypes and the limit
+    """
+    if not isinstance(product_ids, list) or not product_ids:
+        raise DataValidationError("Invalid batch: product_ids must be a non-empty list")
+    if not all(isinstance(product_id, int) for product_id in product_ids):
+        raise DataValidationError("Invalid batch: product_ids must be integers")
+    if len(product_ids) > app.config["BATCH_MAX_PRODUCTS"]:
+        raise DataValidationError(
+            "Invalid batch: at most {} product_ids".format(app.config["BATCH_MAX_PRODUCTS"])
+        )
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        raise DataValidationError("Invalid batch: limit must be a positive integer")
+    if not isinstance(rec_types, list):
+        raise DataValidationError("Invalid batch: types must be a list")
+    rec_types = [RecommendationType.parse(rec_type) for rec_type in rec_types]
+    return list(dict.fromkeys(product_ids)), rec_types, limit
+
+
+######################################################################
+# RECORD IMPRESSIONS AND CLICKS
+######################################################################
+@app.route("/recommendations/events", methods=["POST"])
+def record_events():
+    """
+    Counts impressions and clicks of recommendations
+    POST one event or a list of {"source_product_id", "target_product_id",
+    "type", "event": "impression" or "click", "count"}. The counts are
+    buffered and written in batches, so they are accepted, not yet stored
+    """
+    check_content_type("application/json")
+    recorded = events.parse_events(request.get_json(), app.config["EVENTS_MAX_COUNT"])
+    if len(recorded) > app.config["EVENTS_MAX_PER_REQUEST"]:
+        raise DataValidationError(
+            "Invalid events: at most {} per request".format(app.config["EVENTS_MAX_PER_REQUEST"])
+        )
+    accepted = events.interaction_buffer.add(recorded)
+    return fastjson.json_response(
+        {"accepted": accepted, "dropped": len(recorded) - accepted}, status.HTTP_202_ACCEPTED
+    )
+
+
+######################################################################
+# READ SIMILAR PRODUCTS
+######################################################################
+@app.route("/recommendations/similar", methods=["GET"])
+def get_similar_products():
+    """
+    Retrieve the products most like one or more Products
+    Takes repeated ?product_id= parameters, ?limit= neighbours per product
+    and ?probes=, the number of LSH tables searched on large catalogs
+    """
+    app.logger.info("Request for similar products")
+    try:
+        product_ids = [int(value) for value in request.args.getlist("product_id")]
+    except ValueError:
+        raise DataValidationError("product_id must be an integer")
+    if not product_ids:
+        raise DataValidationError("At least one product_id is required")
+    if len(product_ids) > app.config["BATCH_MAX_PRODUCTS"]:
+        raise DataValidationError(
+            "At most {} product_ids".format(app.config["BATCH_MAX_PRODUCTS"])
+        )
+    limit = get_int_arg("limit", 10)
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]),
+        )
+    probes = get_int_arg("probes")
+    if probes is not None and probes < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "probes must be a positive integer")
+
+    product_ids = list(dict.fromkeys(product_ids))
+    found = similarity.recommend(product_ids, limit, probes)
+    results = [
+        {"product_id": product_id, "similar": found.get(product_id, [])}
+        for product_id in product_ids
+    ]
+    return fastjson.json_response(results, status.HTTP_200_OK)
+
+
+######################################################################
+# SEARCH PRODUCTS
+######################################################################
+@app.route("/recommendations/search", methods=["GET"])
+def search_products():
+    """
+    Search the Products by name and category
+    Takes ?q=, the text to look for, ?mode=fuzzy (the default), which
+    tolerates typos, or ?mode=prefix, which matches the start of words as
+    they are typed, and ?limit=
+    """
+    query = request.args.get("q", "")
+    app.logger.info("Request to search products for %r", query)
+    if not search.words(query):
+        abort(status.HTTP_400_BAD_REQUEST, "q must contain a letter or a digit")
+    if len(query) > app.config["SEARCH_MAX_QUERY_LENGTH"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "q must be at most {} characters".format(app.config["SEARCH_MAX_QUERY_LENGTH"]),
+        )
+    mode = request.args.get("mode", "fuzzy")
+    if mode not in ("fuzzy", "prefix"):
+        abort(status.HTTP_400_BAD_REQUEST, "mode must be fuzzy or prefix")
+    limit = get_int_arg("limit", 10)
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]),
+        )
+
+    results = search.search(query, limit, prefix=mode == "prefix")
+    return fastjson.json_response({"query": query, "results": results}, status.HTTP_200_OK)
+
+
+######################################################################
+# BACKGROUND JOBS
+######################################################################
+@app.route("/recommendations/jobs", methods=["POST"])
+def create_job():
+    """
+    Queues a background Job
+    The body names its kind (similarity, copurchase or snapshot) and its
+    params, and the Job is run by `flask jobs-run`
+    """
+    app.logger.info("Request to queue a job")
+    check_content_type("application/json")
+    data = request.get_json()
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid job: body must be a JSON object")
+    kind = data.get("kind")
+    job = Job(kind=kind, params=jobs.validate(kind, data.get("params", {})))
+    job.create()
+    location_url = url_for("get_job", job_id=job.id, _external=True)
+    return make_response(
+        jsonify(job.serialize()), status.HTTP_202_ACCEPTED, {"Location": location_url}
+    )
+
+
+@app.route("/recommendations/jobs", methods=["GET"])
+def list_jobs():
+    """Returns the latest Jobs, newest first"""
+    app.logger.info("Request to list jobs")
+    limit = get_int_arg("limit", 100)
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]),
+        )
+    return jsonify([job.serialize() for job in Job.recent(limit)]), status.HTTP_200_OK
+
+
+@app.route("/recommendations/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    """Returns the status and progress of a Job"""
+    app.logger.info("Request for job %s", job_id)
+    return jsonify(find_job(job_id).serialize()), status.HTTP_200_OK
+
+
+@app.route("/recommendations/jobs/<int:job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    """
+    Cancels a Job
+    A queued Job is cancelled at once and a running one once the
+    partitions already running end
+    """
+    app.logger.info("Request to cancel job %s", job_id)
+    job = find_job(job_id)
+    if not job.cancel():
+        abort(status.HTTP_409_CONFLICT, "Job {} has already {}".format(job_id, job.status.value))
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED
+
+
+@app.route("/recommendations/jobs/<int:job_id>/resume", methods=["POST"])
+def resume_job(job_id):
+    """
+    Resumes a failed or cancelled Job
+    Only the partitions that did not succeed run again
+    """
+    app.logger.info("Request to resume job %s", job_id)
+    job = find_job(job_id)
+    if not job.resume():
+        abort(status.HTTP_409_CONFLICT, "Job {} is {}".format(job_id, job.status.value))
+    return jsonify(job.serialize()), status.HTTP_202_ACCEPTED
+
+
+def find_job(job_id):
+    """Returns a Job or raises NotFound"""
+    job = Job.find(job_id)
+    if not job:
+        raise NotFound("Job with id '{}' was not found.".format(job_id))
+    return job
+
+
+######################################################################
+# READ PRICE BASED RECOMMENDATIONS
+######################################################################
+@app.route("/recommendations/<int:item_id>/by-price", methods=["GET"])
+def get_price_recommendations(item_id):
+    """
+    Retrieve the upsells or cross-sells of a Product by price
+    Upsells are the next more expensive products of the same category and
+    cross-sells the products of the same category nearest in price
+    """
+    app.logger.info("Request for price based recommendations of %s", item_id)
+    product = Product.find(item_id)
+    if not product:
+        raise NotFound("Product with id '{}' was not found.".format(item_id))
+
+    rec_type = RecommendationType.parse(request.args.get("type", "upsell"))
+    if rec_type not in price_index.PRICE_TYPES:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "type must be one of {}".format(
+                ", ".join(t.value for t in price_index.PRICE_TYPES)
+            ),
+        )
+    limit = get_int_arg("limit", 10)
+    if not 0 < limit <= app.config["PAGE_SIZE_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "limit must be between 1 and {}".format(app.config["PAGE_SIZE_MAX"]),
+        )
+
+    message = product.serialize()
+    message["recommendations"] = price_index.recommend(product, rec_type, limit)
+    return fastjson.json_response(message, status.HTTP_200_OK)
+
+
+######################################################################
+# ADD A RECOMMENDATION TO A PRODUCT
+######################################################################
+@app.route("/recommendations/<int:item_id>/links", methods=["POST"])
+def create_recommendations(item_id):
+    """
+    Creates a Recommendation
+    This endpoint links the Product to the target Product given in the body
+    """
+    app.logger.info("Request to add a recommendation to product %s", item_id)
+    check_content_type("application/json")
+    if not Product.find(item_id):
+        raise NotFound("Product with id '{}' was not found.".format(item_id))
+
+    recommendation = Recommendation()
+    recommendation.deserialize(request.get_json())
+    recommendation.source_product_id = item_id
+    if not Product.find(recommendation.target_product_id):
+        raise NotFound(
+            "Product with id '{}' was not found.".format(recommendation.target_product_id)
+        )
+    recommendation.create()
+    message = recommendation.serialize()
+    location_url = url_for("get_products", item_id=item_id, _external=True)
+
+    app.logger.info("Recommendation with ID [%s] created.", recommendation.id)
+    return make_response(
+        jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
+    )
+
+
+######################################################################
+# HEALTH CHECKS
+######################################################################
+@app.route("/health", methods=["GET"])
+def health():
+    """Liveness: the worker is up and answering requests"""
+    return jsonify(status="OK"), status.HTTP_200_OK
+
+
+@app.route("/health/ready", methods=["GET"])
+def ready():
+    """
+    Readiness: the worker can serve requests
+
+    Every database bind must answer a query on the product table, which
+    also checks that the schema has been created, and a shared cache must
+    answer a ping. Responds 503 with the failed checks otherwise.
+    """
+    checks = {}
+    binds = [None] + list(app.config.get("SQLALCHEMY_BINDS") or ())
+    for bind in binds:
+        try:
+            with db.get_engine(app, bind=bind).connect() as conn:
+                conn.execute(db.select(Product.id).limit(1)).fetchall()
+            checks[bind or "database"] = "ok"
+        except Exception as error:  # pylint: disable=broad-except
+            checks[bind or "database"] = str(error).splitlines()[0]
+    try:
+        recommendation_cache.ping()
+        checks["cache"] = "ok"
+    except Exception as error:  # pylint: disable=broad-except
+        checks["cache"] = str(error).splitlines()[0]
+
+    if all(result == "ok" for result in checks.values()):
+        return jsonify(status="ready", checks=checks), status.HTTP_200_OK
+    app.logger.warning("Not ready: %s", checks)
+    return jsonify(status="unavailable", checks=checks), status.HTTP_503_SERVICE_UNAVAILABLE
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-def check_content_type(media_type):
+def check_content_type(*media_types):
     """Checks that the media type is correct"""
     content_type = request.headers.get("Content-Type")
-    if content_type and content_type == media_type:
+    if content_type and content_type in media_types:
         return
     app.logger.error("Invalid Content-Type: %s", content_type)
     abort(
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-        "Content-Type must be {}".format(media_type),
+        "Content-Type must be {}".format(" or ".join(media_types)),
     )
 
+
+def get_int_arg(name, default=None):
+    """Returns an integer query parameter or aborts with 400_BAD_REQUEST"""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "{} must be an integer".format(name))
+
+
+def get_order_arg(order):
+    """Returns the order of the recommendations or aborts with 400_BAD_REQUEST"""
+    if order is None:
+        return "rank"
+    if order not in ("rank", "ctr"):
+        abort(status.HTTP_400_BAD_REQUEST, "order must be rank or ctr")
+    return order
+
+
+def lookup_etag(item_id, version, rec_type=None):
+    """Returns the ETag of a lookup of a product at a version"""
+    return "{}-{}-{}".format(item_id, version, rec_type.value if rec_type else "all")
+
+
+def batch_etag(product_ids, versions, rec_types, limit):
+    """Returns the ETag of a batch from its parameters and product versions"""
+    return digest_etag(
+        limit,
+        [rec_type.value for rec_type in rec_types],
+        [(product_id, versions.get(product_id, 0)) for product_id in product_ids],
+    )
+
+
+def digest_etag(*parts):
+    """Returns an ETag that digests the ids, versions and parameters of a response"""
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def not_modified(tag):
+    """Returns an empty 304_NOT_MODIFIED response with its ETag"""
+    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    response.set_etag(tag)
+    return response
+
+
+@app.after_request
+def set_cache_control(response):
+    """Adds the Cache-Control configured for the endpoint to its GET responses"""
+    if (
+        request.method in ("GET", "HEAD")
+        and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED)
+        and "Cache-Control" not in response.headers
+    ):
+        cache_control = app.config["HTTP_CACHE_CONTROL"].get(request.endpoint)
+        if cache_control:
+            response.headers["Cache-Control"] = cache_control
+    return response
+
+
+def read_ndjson_rows():
+    """Yields (index, data) for each line of a newline delimited JSON body"""
+    index = 0
+    for line in request.stream:
+        if not line.strip():
+            continue
+        try:
+            yield index, json.loads(line)
+        except ValueError as error:
+            yield index, DataValidationError("Invalid JSON: " + str(error))
+        index += 1
+
 def init_db():
-    """ Initializes the SQLAlchemy app """
-    Product.init_db(app)
\ No newline at end of file
+    """ Initializes the SQLAlchemy app and the cache, without connecting """
+    Product.init_db(app)
+    recommendation_cache.init_app(app)
+    group_commit.init_app(app, db)
+    recommendation_snapshot.init_app(app)
+    similarity.similarity_index.init_app(app)
+    search.trigram_index.init_app(app)
+    events.interaction_buffer.init_app(app)
+    admission_control.init_app(app)
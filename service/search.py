@@ -0,0 +1,364 @@
+"""
+Product Search
+
+An in-process trigram inverted index over the name and category of every
+product, behind the typeahead of the admin UI. Text is cut into words of
+letters and digits, lower cased, and each word is padded with two spaces
+in front and one behind before it is cut into trigrams, as pg_trgm does,
+so "Phone" gives "  p", " ph", "pho", "hon", "one" and "ne ". Every
+trigram maps to a posting list: the sorted ids of the products that have
+it, kept as a compact array of C ints.
+
+A query is cut into trigrams the same way and ranked by the share of its
+trigrams a product has, then by the similarity of the two trigram sets
+(shared / union), which puts shorter names first:
+
+  - a fuzzy query keeps the products that share at least
+    SEARCH_MIN_SIMILARITY of its trigrams, so typos still match
+  - a prefix query leaves the trailing space off its last word, keeps the
+    products that have every one of its trigrams, and checks that each
+    query word starts a word of the product
+
+A product sharing m of the q trigrams of a query must be in one of the
+q - m + 1 shortest posting lists, so only those are merged into the
+candidates and the longer ones are binary searched for them. A fuzzy
+search starts by asking for every trigram and asks for fewer until it has
+enough matches, and stops early once it has some and the next step would
+merge more than SEARCH_MAX_POSTINGS ids. Results are cached until the
+index changes, which covers the few short prefixes that match the most.
+
+The index is built and kept current as service.index describes, on first
+use, and rebuilt every SEARCH_TTL seconds when SEARCH_AUTOBUILD is set.
+Until it is warm, searches are answered from the database.
+"""
+import bisect
+import logging
+import math
+import re
+from array import array
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import func, or_
+
+from service.index import InProcessIndex
+from service.models import Product, db, product_listeners
+
+logger = logging.getLogger("flask.app")
+
+WORD = re.compile(r"[^\W_]+")
+
+
+def words(text: str) -> list:
+    """Returns the lower cased words of letters and digits of text"""
+    return WORD.findall(text.lower())
+
+
+def trigrams(text: str, prefix: bool = False) -> set:
+    """
+    Returns the trigrams of the words of text
+
+    With prefix the last word is not padded behind, so that it matches the
+    start of a longer word, unless text ends between words.
+    """
+    found = set()
+    terms = words(text)
+    for i, word in enumerate(terms):
+        padded = "  " + word
+        if not (prefix and i == len(terms) - 1 and WORD.match(text[-1:])):
+            padded += " "
+        found.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return found
+
+
+class TrigramIndex(InProcessIndex):
+    """
+    Posting lists of the trigrams of the catalog
+    """
+
+    name = "search index"
+    config = "SEARCH"
+    builds_when_cold = True
+
+    def __init__(self):
+        super().__init__()
+        self.max_postings = 20000
+        self.cache_size = 1024
+        self._reset()
+
+    def init_app(self, app):
+        """Reads the search settings from the app configuration"""
+        config = app.config
+        self.max_postings = config["SEARCH_MAX_POSTINGS"]
+        self.cache_size = config["SEARCH_CACHE_SIZE"]
+
+    def _reset(self):
+        """Empties the index, the lock must be held"""
+        self._postings = {}  # trigram -> array of sorted product ids
+        self._texts = {}  # product id -> indexed words
+        self._sizes = {}  # product id -> trigram count
+        self._results = {}  # recent searches, until the index changes
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def _build(self):
+        """Reads the Product table into new posting lists"""
+        rows = db.session.query(Product.id, Product.name, Product.category)
+        self.load(rows.yield_per(10000))
+
+    def load(self, rows):
+        """Replaces the index with the (id, name, category) rows"""
+        postings, texts, sizes = {}, {}, {}
+        for product_id, name, category in sorted(rows):
+            text = " ".join(words(name) + words(category))
+            grams = trigrams(text)
+            for gram in grams:
+                postings.setdefault(gram, array("i")).append(product_id)
+            texts[product_id] = text
+            sizes[product_id] = len(grams)
+        with self._lock:
+            self._postings = postings
+            self._texts = texts
+            self._sizes = sizes
+            self._results = {}
+            # replaying is safe: every change drops the old trigrams of its id
+            self._built()
+
+    def _change(self, action: str, product: Product) -> tuple:
+        """Returns the arguments of _apply() for a Product change"""
+        return (action, product.id, product.name, product.category)
+
+    def _apply(self, action: str, product_id: int, name: str, category: str):
+        """Applies one Product change to the posting lists"""
+        self._results = {}
+        old = self._texts.pop(product_id, None)
+        old_grams = trigrams(old) if old is not None else set()
+        new_grams = set()
+        if action != "delete":
+            text = " ".join(words(name) + words(category))
+            new_grams = trigrams(text)
+            self._texts[product_id] = text
+        for gram in old_grams - new_grams:
+            ids = self._postings[gram]
+            i = bisect.bisect_left(ids, product_id)
+            if i < len(ids) and ids[i] == product_id:
+                del ids[i]
+            if not ids:
+                del self._postings[gram]
+        for gram in new_grams - old_grams:
+            ids = self._postings.setdefault(gram, array("i"))
+            if not ids or ids[-1] < product_id:
+                ids.append(product_id)  # new products have the highest ids
+            else:
+                ids.insert(bisect.bisect_left(ids, product_id), product_id)
+        if action == "delete":
+            self._sizes.pop(product_id, None)
+        else:
+            self._sizes[product_id] = len(new_grams)
+
+    def search(self, query: str, count: int, prefix: bool = False, threshold: float = 0.3) -> list:
+        """
+        Returns the (product id, score) of the count best matches of query
+
+        Args:
+            query (str): the text to look for
+            count (int): the number of matches to return
+            prefix (bool): match the start of words instead of fuzzily
+            threshold (float): the share of the trigrams of the query that
+                a fuzzy match must have
+
+        The score is the share of the trigrams of the query the product has.
+        Once some products match, fewer than count are returned rather than
+        merging more than max_postings ids to find weaker matches.
+        """
+        grams = trigrams(query, prefix)
+        if not grams or count < 1:
+            return []
+        least = len(grams) if prefix else max(1, math.ceil(threshold * len(grams) - 1e-9))
+        terms = words(query)
+        key = (frozenset(grams), prefix and tuple(terms), count, least)
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            lists = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+            sizes = np.cumsum([len(ids) for ids in lists])
+            # the products with the most trigrams rank first, so the best
+            # count are found by lowering the trigrams needed until there
+            # are enough, missing by 1, 2, 4, ... which merges few lists
+            needed, step = len(grams), 1
+            while True:
+                matches = self._matches(lists, needed, count, prefix and terms)
+                if len(matches) >= count or needed <= least:
+                    break
+                lower = max(least, needed - step)
+                if matches and sizes[len(lists) - lower] > self.max_postings:
+                    break
+                needed, step = lower, 2 * step
+            matches = [(product_id, found / len(grams)) for product_id, found in matches]
+            if len(self._results) >= self.cache_size:
+                self._results = {}
+            self._results[key] = matches
+            return matches
+
+    def _matches(self, lists: list, needed: int, count: int, terms) -> list:
+        """
+        Returns the (product id, trigrams shared) of the count best products
+        that have at least needed of the posting lists, the lock must be held
+
+        With terms, products must also have a word starting with each term.
+        """
+        ids, shared = self._candidates(lists, needed)
+        sizes = np.fromiter(
+            (self._sizes[product_id] for product_id in ids.tolist()),
+            dtype=np.int64,
+            count=len(ids),
+        )
+        if needed == len(lists):
+            # every candidate has every trigram, the fewest others rank first
+            keys = -sizes
+        else:
+            # shared ranks first and the set similarity, always below 1, breaks ties
+            union = len(lists) + sizes - shared
+            keys = shared + shared / union
+        matches, start = [], 0
+        while len(matches) < count and start < len(ids):
+            # rank a few more than needed, prefix checks may drop some
+            best = self._best(keys, start + 2 * count)
+            for i in best[start:].tolist():
+                product_id = int(ids[i])
+                if not terms or self._starts_words(product_id, terms):
+                    matches.append((product_id, int(shared[i])))
+                    if len(matches) == count:
+                        break
+            start = len(best)
+        return matches
+
+    @staticmethod
+    def _candidates(lists: list, needed: int):
+        """
+        Returns the ids in at least needed of the posting lists, shortest
+        first, and how many they are in
+
+        A product in needed of the n lists is in one of the n - needed + 1
+        shortest, so only those are merged and the others binary searched.
+        The arrays only view the posting lists inside this method, which
+        cannot grow while a view of their buffer exists.
+        """
+        merged = len(lists) - needed + 1
+        views = [np.frombuffer(ids, dtype=np.intc) for ids in lists if len(ids)]
+        merged -= len(lists) - len(views)
+        if merged <= 0:
+            return np.zeros(0, dtype=np.intc), np.zeros(0, dtype=np.int64)
+        if merged == 1:
+            ids = views[0]
+            shared = np.ones(len(ids), dtype=np.int64)
+        else:
+            ids, shared = np.unique(np.concatenate(views[:merged]), return_counts=True)
+        left = len(views) - merged
+        for view in views[merged:]:
+            # drop the ids that can no longer be in enough lists
+            keep = shared + left >= needed
+            ids, shared = ids[keep], shared[keep]
+            if not len(ids):
+                break
+            found = np.searchsorted(view, ids)
+            found[found == len(view)] = 0
+            shared += view[found] == ids
+            left -= 1
+        keep = shared >= needed
+        return ids[keep], shared[keep]
+
+    @staticmethod
+    def _best(keys, count: int):
+        """
+        Returns the positions of the count best keys, the first position
+        first on ties, which is the lowest id as candidates are sorted
+        """
+        if len(keys) > count:
+            kth = np.partition(keys, len(keys) - count)[len(keys) - count]
+            above = np.flatnonzero(keys > kth)
+            tied = np.flatnonzero(keys == kth)[:count - len(above)]
+            top = np.concatenate([above, tied])
+        else:
+            top = np.arange(len(keys))
+        return top[np.argsort(-keys[top], kind="stable")]
+
+    def _starts_words(self, product_id: int, terms: list) -> bool:
+        """True if every term starts a word of the product"""
+        indexed = self._texts.get(product_id, "").split()
+        return all(any(word.startswith(term) for word in indexed) for term in terms)
+
+
+def search(query: str, count: int, prefix: bool = False) -> list:
+    """
+    Returns the products matching query as dictionaries, best first
+
+    A cold index is built in the background and the database answers
+    until it is warm. A stale one is rebuilt in the background when
+    SEARCH_AUTOBUILD is set, serving the old copy meanwhile.
+    """
+    if not trigram_index.refresh():
+        logger.info("Search index is cold, using the database")
+        return query_search(query, count, prefix)
+
+    found = trigram_index.search(
+        query, count, prefix, current_app.config["SEARCH_MIN_SIMILARITY"]
+    )
+    if not found:
+        return []
+    rows = db.session.query(Product.id, Product.name, Product.category, Product.price)
+    details = {row[0]: row for row in rows.filter(Product.id.in_([pid for pid, _ in found]))}
+    return [
+        {
+            "product_id": product_id,
+            "rank": rank,
+            "score": round(score, 6),
+            "name": details[product_id][1],
+            "category": details[product_id][2],
+            "price": details[product_id][3],
+        }
+        for rank, (product_id, score) in enumerate(
+            (pair for pair in found if pair[0] in details), start=1
+        )
+    ]
+
+
+def query_search(query: str, count: int, prefix: bool = False) -> list:
+    """
+    Returns the products whose name or category contain every word of
+    query as dictionaries, at most count of them, shortest names first
+
+    Stands in for a cold index, so typos do not match. The scores are the
+    share of the trigrams of the query the product has, as in the index.
+    """
+    terms = words(query)
+    grams = trigrams(query, prefix)
+    if not terms or count < 1:
+        return []
+    rows = db.session.query(Product.id, Product.name, Product.category, Product.price)
+    for term in terms:
+        pattern = "%" + term + "%"
+        rows = rows.filter(or_(Product.name.ilike(pattern), Product.category.ilike(pattern)))
+    rows = rows.order_by(func.length(Product.name), Product.id).limit(count)
+    found = []
+    for product_id, name, category, price in rows:
+        share = len(grams & trigrams(name + " " + category)) / len(grams)
+        found.append((share, product_id, name, category, price))
+    found.sort(key=lambda match: -match[0])
+    return [
+        {
+            "product_id": product_id,
+            "rank": rank,
+            "score": round(score, 6),
+            "name": name,
+            "category": category,
+            "price": price,
+        }
+        for rank, (score, product_id, name, category, price) in enumerate(found, start=1)
+    ]
+
+
+# The index shared by every request of this worker
+trigram_index = TrigramIndex()
+product_listeners.append(trigram_index.on_change)
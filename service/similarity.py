@@ -0,0 +1,354 @@
+"""
+Similar Products
+
+Content based "more like this" search. Every product is encoded as one
+row of a float32 feature matrix, L2 normalized so that a dot product is a
+cosine similarity:
+
+* its category, one-hot over SIMILAR_CATEGORY_BUCKETS hashed columns
+* its price, as the angle of a unit vector that turns a quarter circle
+  between 0 and PRICE_SCALE on a log scale, so nearer prices score higher
+* its name, counted as character trigrams hashed into SIMILAR_NAME_BUCKETS
+  columns
+
+A query multiplies the rows of the products asked for with the whole
+matrix in one batched matrix product and keeps the top K of each. Once the
+catalog has more than SIMILAR_EXACT_MAX products the matrix product only
+runs on the candidates of a random projection LSH index: every row is
+hashed to a SIMILAR_LSH_BITS bit signature in each of SIMILAR_LSH_TABLES
+tables, and the candidates of a product are the rows sharing a signature
+with it in any of the tables probed. Probing more tables finds more of the
+true neighbours (recall) for more work (latency).
+
+The matrix is built and kept current as service.index describes, on
+first use, and rebuilt every SIMILAR_TTL seconds when SIMILAR_AUTOBUILD
+is set. Until it is warm, requests are answered with 503 Service
+Unavailable. A created or updated product rewrites its row and a deleted
+one frees it. The sorted LSH tables are only rebuilt with the matrix, so
+the rows that changed since are kept aside and always checked.
+"""
+import logging
+import math
+import os
+import time
+import zlib
+
+import numpy as np
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+
+from service.index import InProcessIndex
+from service.models import Product, db, product_listeners
+
+logger = logging.getLogger("flask.app")
+
+PRICE_SCALE = 1000000
+NGRAM = 3
+# Seconds a request that found the index cold is told to wait before retrying
+BUILD_RETRY_AFTER = 5
+
+# the origin of the links the similarity Jobs compute
+ORIGIN = "similarity"
+
+
+class FeatureEncoder:
+    """
+    Turns products into unit length feature vectors
+    """
+
+    def __init__(self, category_buckets: int = 32, name_buckets: int = 64):
+        self.category_buckets = category_buckets
+        self.name_buckets = name_buckets
+        self.dim = category_buckets + 2 + name_buckets
+
+    @staticmethod
+    def _bucket(text: str, buckets: int) -> int:
+        """Hashes text to a column, the same in every process"""
+        return zlib.crc32(text.encode("utf-8")) % buckets
+
+    def encode(self, name: str, category: str, price: int, out=None):
+        """Writes the features of one product into out and returns it"""
+        vector = np.zeros(self.dim, dtype=np.float32) if out is None else out
+        vector[:] = 0
+        vector[self._bucket(category.lower(), self.category_buckets)] = 1.0
+
+        angle = math.log1p(min(max(price, 0), PRICE_SCALE)) / math.log1p(PRICE_SCALE)
+        vector[self.category_buckets] = math.cos(angle * math.pi / 2)
+        vector[self.category_buckets + 1] = math.sin(angle * math.pi / 2)
+
+        names = vector[self.category_buckets + 2:]
+        padded = " {} ".format(name.lower())
+        for i in range(max(1, len(padded) - NGRAM + 1)):
+            names[self._bucket(padded[i:i + NGRAM], self.name_buckets)] += 1.0
+        norm = np.linalg.norm(names)
+        if norm:
+            names /= norm
+
+        vector /= np.linalg.norm(vector)
+        return vector
+
+
+class SimilarityIndex(InProcessIndex):
+    """
+    The feature matrix of the catalog with an LSH index over its rows
+    """
+
+    name = "similarity index"
+    config = "SIMILAR"
+    builds_when_cold = True
+
+    def __init__(self, encoder: FeatureEncoder = None, tables: int = 8, bits: int = 12):
+        super().__init__()
+        self._configure(encoder or FeatureEncoder(), tables, bits)
+
+    def _configure(self, encoder: FeatureEncoder, tables: int, bits: int, seed: int = 0):
+        """Sets the features and the LSH tables and empties the index"""
+        with self._lock:
+            self.encoder = encoder
+            self.tables = tables
+            self.bits = bits
+            projections = np.random.default_rng(seed).standard_normal(
+                (tables * bits, encoder.dim)
+            )
+            self._projections = projections.astype(np.float32)
+            self._weights = (1 << np.arange(bits)).astype(np.uint32)
+            self._pending = None
+            self._dirty = False
+            self.built_at = None
+            self._reset()
+
+    def init_app(self, app):
+        """Sizes the features and the LSH tables from the app configuration"""
+        config = app.config
+        self._configure(
+            FeatureEncoder(config["SIMILAR_CATEGORY_BUCKETS"], config["SIMILAR_NAME_BUCKETS"]),
+            config["SIMILAR_LSH_TABLES"],
+            config["SIMILAR_LSH_BITS"],
+        )
+
+    def _reset(self, capacity: int = 0):
+        """Empties the matrix, the lock must be held"""
+        self._ids = np.full(capacity, -1, dtype=np.int64)  # -1 marks a free row
+        self._vectors = np.zeros((capacity, self.encoder.dim), dtype=np.float32)
+        self._signatures = np.zeros((capacity, self.tables), dtype=np.uint32)
+        self._row_of = {}
+        self._free = []
+        self._size = 0
+        self._sorted = [(np.zeros(0, np.uint32), np.zeros(0, np.int64))] * self.tables
+        self._changed = set()  # rows written since the tables were sorted
+
+    def __len__(self) -> int:
+        return len(self._row_of)
+
+    def signatures(self, vectors):
+        """Returns the LSH signature of each vector in each table"""
+        bits = (vectors @ self._projections.T > 0).reshape(len(vectors), self.tables, self.bits)
+        return (bits * self._weights).sum(axis=2, dtype=np.uint32)
+
+    def _build(self):
+        """Reads the Product table into a new matrix and LSH tables"""
+        rows = db.session.query(Product.id, Product.name, Product.category, Product.price)
+        self.load(rows.yield_per(10000))
+
+    def load(self, rows):
+        """Replaces the matrix with the (id, name, category, price) rows"""
+        ids, vectors = [], []
+        for product_id, name, category, price in rows:
+            ids.append(product_id)
+            vectors.append(self.encoder.encode(name, category, price))
+        ids = np.array(ids, dtype=np.int64)
+        vectors = np.array(vectors, dtype=np.float32).reshape(len(ids), self.encoder.dim)
+        signatures = self.signatures(vectors)
+        with self._lock:
+            self._reset()
+            self._ids, self._vectors, self._signatures = ids, vectors, signatures
+            self._size = len(ids)
+            self._row_of = {product_id: row for row, product_id in enumerate(ids.tolist())}
+            self._sort_tables()
+            # replaying is safe: every change rewrites or frees its own row
+            self._built()
+
+    def save(self, directory: str):
+        """Writes the matrix and the sorted LSH tables to .npy files in a directory"""
+        with self._lock:
+            self._sort_tables()
+            arrays = {
+                "ids": self._ids[:self._size],
+                "vectors": self._vectors[:self._size],
+                "signatures": self._signatures[:self._size],
+                "sorted_signatures": np.array([table[0] for table in self._sorted], dtype=np.uint32),
+                "sorted_rows": np.array([table[1] for table in self._sorted], dtype=np.int64),
+            }
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+        logger.info("Saved similarity index of %s products to %s", len(self), directory)
+
+    def open(self, directory: str):
+        """
+        Maps a saved matrix read-only, so every process that opens it shares
+        one copy in the page cache. The opened index must not be changed.
+        """
+        arrays = {
+            name: np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+            for name in ("ids", "vectors", "signatures", "sorted_signatures", "sorted_rows")
+        }
+        with self._lock:
+            self._reset()
+            self._ids, self._vectors = arrays["ids"], arrays["vectors"]
+            self._signatures = arrays["signatures"]
+            self._size = len(self._ids)
+            self._row_of = {
+                product_id: row
+                for row, product_id in enumerate(self._ids.tolist())
+                if product_id >= 0
+            }
+            self._sorted = list(zip(arrays["sorted_signatures"], arrays["sorted_rows"]))
+            self.built_at = time.monotonic()
+
+    def _sort_tables(self):
+        """Sorts the rows of every table by signature, the lock must be held"""
+        rows = np.flatnonzero(self._ids[:self._size] >= 0)
+        self._sorted = []
+        for table in range(self.tables):
+            signatures = self._signatures[rows, table]
+            order = np.argsort(signatures, kind="stable")
+            self._sorted.append((signatures[order], rows[order]))
+        self._changed = set()
+
+    def _change(self, action: str, product: Product) -> tuple:
+        """Returns the arguments of _apply() for a Product change"""
+        return (action, product.id, product.name, product.category, product.price)
+
+    def _apply(self, action: str, product_id: int, name: str, category: str, price: int):
+        """Applies one Product change to the matrix"""
+        row = self._row_of.get(product_id)
+        if action == "delete":
+            if row is not None:
+                del self._row_of[product_id]
+                self._ids[row] = -1
+                self._free.append(row)
+            return
+        if row is None:
+            row = self._free.pop() if self._free else self._grow()
+            self._row_of[product_id] = row
+            self._ids[row] = product_id
+        self.encoder.encode(name, category, price, out=self._vectors[row])
+        self._signatures[row] = self.signatures(self._vectors[row:row + 1])[0]
+        self._changed.add(row)
+        if len(self._changed) > max(1000, self._size // 10):
+            self._sort_tables()
+
+    def _grow(self) -> int:
+        """Returns a new row at the end, doubling the arrays when full"""
+        if self._size == len(self._ids):
+            capacity = max(16, 2 * len(self._ids))
+            self._ids = np.concatenate([self._ids, np.full(capacity - len(self._ids), -1)])
+            self._vectors = np.resize(self._vectors, (capacity, self.encoder.dim))
+            self._signatures = np.resize(self._signatures, (capacity, self.tables))
+        self._size += 1
+        return self._size - 1
+
+    def _candidates(self, signature, probes: int):
+        """Returns the rows that share a signature in the probed tables"""
+        found = []
+        for table in range(probes):
+            signatures, rows = self._sorted[table]
+            lo = np.searchsorted(signatures, signature[table], "left")
+            hi = np.searchsorted(signatures, signature[table], "right")
+            found.append(rows[lo:hi])
+        if self._changed:
+            changed = np.fromiter(self._changed, dtype=np.int64)
+            matches = self._signatures[changed, :probes] == signature[:probes]
+            found.append(changed[matches.any(axis=1)])
+        return np.unique(np.concatenate(found))
+
+    def similar(self, product_ids: list, count: int, probes: int = None, exact: bool = None) -> dict:
+        """
+        Returns the count most similar products of each product
+
+        Args:
+            product_ids (list): the products to find neighbours of
+            count (int): the number of neighbours of each
+            probes (int): the number of LSH tables to look in
+            exact (bool): compare with every product instead of the LSH
+                candidates, by default only on small catalogs
+
+        Returns a dict of product id to a list of (product id, similarity),
+        the most similar first. Products that are not indexed are left out.
+        """
+        probes = self.tables if probes is None else max(1, min(probes, self.tables))
+        with self._lock:
+            if exact is None:
+                exact = len(self) <= current_app.config["SIMILAR_EXACT_MAX"]
+            queries = [(pid, self._row_of[pid]) for pid in product_ids if pid in self._row_of]
+            if not queries:
+                return {}
+            ids = self._ids[:self._size]
+            query_rows = np.array([row for _, row in queries])
+            results = {}
+            if exact:
+                # one batched matrix product for every product asked for
+                scores = self._vectors[query_rows] @ self._vectors[:self._size].T
+                scores[:, ids < 0] = -np.inf
+                scores[np.arange(len(queries)), query_rows] = -np.inf
+                for (product_id, _), row_scores in zip(queries, scores):
+                    results[product_id] = self._top(ids, np.arange(len(ids)), row_scores, count)
+            else:
+                signatures = self._signatures[query_rows]
+                for (product_id, row), signature in zip(queries, signatures):
+                    rows = self._candidates(signature, probes)
+                    rows = rows[(ids[rows] >= 0) & (rows != row)]
+                    row_scores = self._vectors[rows] @ self._vectors[row]
+                    results[product_id] = self._top(ids, rows, row_scores, count)
+            return results
+
+    @staticmethod
+    def _top(ids, rows, scores, count: int) -> list:
+        """Returns the (id, score) of the count best scored rows"""
+        keep = np.isfinite(scores)
+        rows, scores = rows[keep], scores[keep]
+        if len(scores) > count:
+            best = np.argpartition(-scores, count - 1)[:count]
+            rows, scores = rows[best], scores[best]
+        order = np.lexsort((ids[rows], -scores))
+        return list(zip(ids[rows[order]].tolist(), scores[order].tolist()))
+
+
+def recommend(product_ids: list, count: int, probes: int = None) -> dict:
+    """
+    Returns the similar products of each product as dictionaries
+
+    A cold index is built in the background and ServiceUnavailable is
+    raised until it is warm. A stale one is rebuilt in the background when
+    SIMILAR_AUTOBUILD is set, serving the old copy meanwhile.
+    """
+    if not similarity_index.refresh():
+        raise ServiceUnavailable(
+            "The similarity index is being built, retry later", retry_after=BUILD_RETRY_AFTER
+        )
+
+    found = similarity_index.similar(product_ids, count, probes)
+    wanted = {target for neighbours in found.values() for target, _ in neighbours}
+    rows = db.session.query(Product.id, Product.name, Product.category, Product.price)
+    details = {row[0]: row for row in rows.filter(Product.id.in_(wanted))} if wanted else {}
+    results = {}
+    for product_id, neighbours in found.items():
+        results[product_id] = [
+            {
+                "product_id": target,
+                "rank": rank,
+                "score": round(score, 6),
+                "name": details[target][1],
+                "category": details[target][2],
+                "price": details[target][3],
+            }
+            for rank, (target, score) in enumerate(
+                (pair for pair in neighbours if pair[0] in details), start=1
+            )
+        ]
+    return results
+
+
+# The index shared by every request of this worker
+similarity_index = SimilarityIndex()
+product_listeners.append(similarity_index.on_change)
@@ -0,0 +1,384 @@
+"""
+Recommendation Snapshot
+
+A compact, read-only binary copy of the catalog and its recommendations
+that every worker maps into memory with mmap, so the operating system keeps
+one copy of it in the page cache however many workers read it.
+
+The file is little-endian and every section is 8-byte aligned:
+
+  header        magic, format, version, products, records, text bytes,
+                the time the export started reading
+  ids           int64[products]      product ids in ascending order
+  prices        int64[products]
+  versions      int64[products]      Product.version of each product
+  offsets       int64[products + 1]  CSR row pointers into the records
+  records       RECORD[records]      (target id, score, rank, type) of the
+                                     recommendations of each product, in
+                                     the order of Recommendation.lookup()
+  text offsets  int64[2 * products + 1] into the text
+  text          UTF-8 names and categories, name then category per product
+
+Lookups read numpy views of the mapping, nothing is copied or parsed when a
+snapshot is opened. The export writes a new file next to the old one and
+renames it over the top, so a worker sees either the whole old snapshot or
+the whole new one. Workers check for a new file at most every
+SNAPSHOT_CHECK_INTERVAL seconds and swap to it.
+
+A snapshot is only as fresh as its export. Products that are not in it are
+answered from the database, and so are the products a worker has seen
+change after the export started reading. The other workers keep serving
+the old copy of those until the next snapshot is published.
+
+Export one with:
+  FLASK_APP=service:app flask snapshot-export
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from service.models import (
+    Product,
+    Recommendation,
+    RecommendationType,
+    db,
+    product_listeners,
+    recommendation_listeners,
+)
+
+logger = logging.getLogger("flask.app")
+
+MAGIC = b"RECSNAP\x00"
+FORMAT = 2
+# magic, format, unused, version, products, records, text, started at
+HEADER = struct.Struct("<8sIIqqqqd")
+
+RECORD = np.dtype(
+    [("target", "<i8"), ("score", "<f8"), ("rank", "<i4"), ("type", "u1")], align=True
+)
+
+# Codes of the types in the order the database sorts them, by their names
+TYPES = sorted(RecommendationType, key=lambda rec_type: rec_type.name)
+TYPE_CODES = {rec_type: code for code, rec_type in enumerate(TYPES)}
+
+
+def _aligned(size: int) -> int:
+    """Rounds a size up to a multiple of 8"""
+    return (size + 7) & ~7
+
+
+def _read_version(path: str) -> int:
+    """Returns the version of the snapshot at path, or 0 if there is none"""
+    try:
+        with open(path, "rb") as snapshot:
+            magic, _, _, version, *_ = HEADER.unpack(snapshot.read(HEADER.size))
+    except (OSError, struct.error):
+        return 0
+    return version if magic == MAGIC else 0
+
+
+######################################################################
+# EXPORT
+######################################################################
+def export(path: str) -> int:
+    """
+    Writes a snapshot of the catalog and its recommendations to path
+
+    Returns the version of the new snapshot, one more than the one it
+    replaces.
+    """
+    version = _read_version(path) + 1
+    started_at = time.time()
+    logger.info("Exporting recommendation snapshot %s to %s", version, path)
+
+    # the versions are read before the links, so a version is never newer
+    # than the links exported with it
+    ids, prices, versions, texts = [], [], [], []
+    rows = db.session.query(
+        Product.id, Product.price, Product.name, Product.category, Product.version
+    )
+    for product_id, price, name, category, version_id in rows.order_by(Product.id).yield_per(
+        10000
+    ):
+        ids.append(product_id)
+        prices.append(price)
+        versions.append(version_id)
+        texts.append(name.encode("utf-8"))
+        texts.append(category.encode("utf-8"))
+    ids = np.array(ids, dtype="<i8")
+    prices = np.array(prices, dtype="<i8")
+    versions = np.array(versions, dtype="<i8")
+    text_offsets = np.zeros(len(texts) + 1, dtype="<i8")
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+    text = b"".join(texts)
+
+    links = db.session.query(
+        Recommendation.source_product_id,
+        Recommendation.target_product_id,
+        Recommendation.score,
+        Recommendation.rank,
+        Recommendation.type,
+    ).order_by(Recommendation.source_product_id, Recommendation.type, Recommendation.rank)
+    sources, records = [], []
+    for source, target, score, rank, rec_type in links.yield_per(10000):
+        sources.append(source)
+        records.append((target, np.nan if score is None else score, rank, TYPE_CODES[rec_type]))
+    sources = np.array(sources, dtype="<i8")
+    records = np.array(records, dtype=RECORD)
+    # drop the links of products deleted between the two queries
+    kept = np.isin(sources, ids) & np.isin(records["target"], ids)
+    sources, records = sources[kept], records[kept]
+    offsets = np.zeros(len(ids) + 1, dtype="<i8")
+    np.cumsum(np.bincount(np.searchsorted(ids, sources), minlength=len(ids)), out=offsets[1:])
+
+    header = HEADER.pack(
+        MAGIC, FORMAT, 0, version, len(ids), len(records), len(text), started_at
+    )
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, "wb") as out:
+        for section in (header, ids, prices, versions, offsets, records, text_offsets, text):
+            data = section if isinstance(section, bytes) else section.tobytes()
+            out.write(data)
+            out.write(b"\x00" * (_aligned(len(data)) - len(data)))
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temp_path, path)
+    logger.info(
+        "Exported snapshot %s with %s products and %s recommendations",
+        version, len(ids), len(records),
+    )
+    return version
+
+
+######################################################################
+# READ
+######################################################################
+class Snapshot:
+    """
+    A snapshot file mapped into memory
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot:
+            stat = os.fstat(snapshot.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, _, version, products, records, text, started_at = HEADER.unpack_from(
+            self._map
+        )
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError("{} is not a format {} snapshot".format(path, FORMAT))
+        self.version = version
+        self.started_at = started_at
+
+        position = _aligned(HEADER.size)
+
+        def section(dtype, count):
+            nonlocal position
+            array = np.frombuffer(self._map, dtype=dtype, count=count, offset=position)
+            position += _aligned(array.nbytes)
+            return array
+
+        self.ids = section("<i8", products)
+        self.prices = section("<i8", products)
+        self.versions = section("<i8", products)
+        self.offsets = section("<i8", products + 1)
+        self.records = section(RECORD, records)
+        self.text_offsets = section("<i8", 2 * products + 1)
+        self.text = memoryview(self._map)[position:position + text]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def position(self, product_id: int) -> int:
+        """Returns the position of a product in the snapshot or None"""
+        i = int(np.searchsorted(self.ids, product_id))
+        if i < len(self.ids) and self.ids[i] == product_id:
+            return i
+        return None
+
+    def _text(self, i: int) -> str:
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+        return str(self.text[start:end], "utf-8")
+
+    def product(self, i: int) -> dict:
+        """Returns the product at position i like Product.find_row()"""
+        return {
+            "id": int(self.ids[i]),
+            "price": int(self.prices[i]),
+            "name": self._text(2 * i),
+            "category": self._text(2 * i + 1),
+            "version": int(self.versions[i]),
+        }
+
+    def links(self, i: int):
+        """Returns the records of the recommendations of position i"""
+        return self.records[self.offsets[i]:self.offsets[i + 1]]
+
+    def recommendations(self, links) -> list:
+        """Returns records as dictionaries like Recommendation.lookup()"""
+        if not len(links):  # pylint: disable=len-as-condition
+            return []
+        positions = np.searchsorted(self.ids, links["target"]).tolist()
+        return [
+            {
+                "product_id": target,
+                "type": TYPES[code].value,
+                "rank": rank,
+                "score": None if score != score else score,  # NaN is no score
+                "name": self._text(2 * i),
+                "category": self._text(2 * i + 1),
+                "price": int(self.prices[i]),
+            }
+            for target, score, rank, code, i in zip(
+                links["target"].tolist(),
+                links["score"].tolist(),
+                links["rank"].tolist(),
+                links["type"].tolist(),
+                positions,
+            )
+        ]
+
+
+class RecommendationSnapshot:
+    """
+    The snapshot served by this worker, swapped when a new one is published
+    """
+
+    def __init__(self):
+        self.path = None
+        self.check_interval = 5
+        self.snapshot = None
+        self._checked_at = 0
+        self._changed = {}  # id -> when this worker saw it change
+        self._all_changed_at = None  # when every source changed at once
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Serves the snapshot at SNAPSHOT_PATH, if one is configured"""
+        self.path = app.config.get("SNAPSHOT_PATH") or None
+        self.check_interval = app.config.get("SNAPSHOT_CHECK_INTERVAL", 5)
+        self.snapshot = None
+        self._checked_at = 0
+        self._changed = {}
+        self._all_changed_at = None
+
+    def current(self) -> Snapshot:
+        """Returns the latest published snapshot, or None if there is none"""
+        if self.path is None:
+            return None
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return self.snapshot
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return self.snapshot
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                return self.snapshot
+            if self.snapshot is None or self.snapshot.identity != (
+                stat.st_ino,
+                stat.st_mtime_ns,
+            ):
+                try:
+                    # the old mapping is released once no lookup is reading it
+                    self.snapshot = Snapshot(self.path)
+                    self._forget_changes(self.snapshot.started_at)
+                    logger.info("Loaded recommendation snapshot %s", self.snapshot.version)
+                except (OSError, ValueError):
+                    logger.exception("Cannot load the recommendation snapshot")
+        return self.snapshot
+
+    def _forget_changes(self, started_at: float):
+        """Forgets the changes that a snapshot started after has seen"""
+        self._changed = {
+            product_id: changed_at
+            for product_id, changed_at in self._changed.items()
+            if changed_at >= started_at
+        }
+        if self._all_changed_at is not None and self._all_changed_at < started_at:
+            self._all_changed_at = None
+
+    def _fresh(self, snapshot: Snapshot, i: int, links) -> bool:
+        """True if nothing a lookup depends on changed in this worker"""
+        if self._all_changed_at is not None:
+            return False
+        changed = self._changed
+        if not changed:
+            return True
+        return int(snapshot.ids[i]) not in changed and changed.keys().isdisjoint(
+            links["target"].tolist()
+        )
+
+    def lookup(self, product_id: int, rec_type: RecommendationType = None) -> dict:
+        """
+        Returns a product with its recommendations like the database lookup,
+        or None if the snapshot cannot answer for it
+        """
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        i = snapshot.position(product_id)
+        if i is None:
+            return None
+        links = snapshot.links(i)
+        if not self._fresh(snapshot, i, links):
+            return None
+        if rec_type is not None:
+            links = links[links["type"] == TYPE_CODES[rec_type]]
+        message = snapshot.product(i)
+        message["recommendations"] = snapshot.recommendations(links)
+        return message
+
+    def lookup_many(
+        self, product_ids: list, rec_types: list = None, limit: int = None, versions: dict = None
+    ) -> dict:
+        """
+        Returns the recommendations of the products the snapshot can answer
+        for, grouped by product id like Recommendation.lookup_many(), and
+        adds the version of each of them to versions when it is given
+        """
+        snapshot = self.current()
+        if snapshot is None:
+            return {}
+        codes = [TYPE_CODES[rec_type] for rec_type in rec_types or ()]
+        results = {}
+        for product_id in product_ids:
+            i = snapshot.position(product_id)
+            if i is None:
+                continue
+            links = snapshot.links(i)
+            if not self._fresh(snapshot, i, links):
+                continue
+            if codes:
+                links = links[np.isin(links["type"], codes)]
+            results[product_id] = snapshot.recommendations(links[:limit])
+            if versions is not None:
+                versions[product_id] = int(snapshot.versions[i])
+        return results
+
+    def on_product_change(self, action: str, product):
+        """Product listener that stops serving a changed product"""
+        if action in ("update", "delete"):
+            self._changed[product.id] = time.time()
+
+    def on_recommendation_change(self, source_ids):
+        """Recommendation listener that stops serving changed sources"""
+        now = time.time()
+        if source_ids is None:
+            self._all_changed_at = now
+        else:
+            self._changed.update((source_id, now) for source_id in source_ids)
+
+
+# The snapshot shared by every request of this worker
+recommendation_snapshot = RecommendationSnapshot()
+product_listeners.append(recommendation_snapshot.on_product_change)
+recommendation_listeners.append(recommendation_snapshot.on_recommendation_change)
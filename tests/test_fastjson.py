@@ -0,0 +1,39 @@
+"""
+Test cases for the fast JSON responses
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from service import app, fastjson
+
+
+######################################################################
+#  F A S T   J S O N   T E S T   C A S E S
+######################################################################
+class TestFastJson(unittest.TestCase):
+    """ Test Cases for fast JSON encoding """
+
+    DATA = {"id": 1, "name": "café", "recommendations": [{"score": None}]}
+
+    def test_dumps(self):
+        """Encode data to JSON bytes"""
+        encoded = fastjson.dumps(self.DATA)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), self.DATA)
+
+    def test_dumps_without_orjson(self):
+        """Fall back to the standard library without orjson"""
+        with patch.object(fastjson, "orjson", None):
+            encoded = fastjson.dumps(self.DATA)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), self.DATA)
+
+    def test_json_response(self):
+        """Build a JSON response"""
+        with app.test_request_context():
+            resp = fastjson.json_response(self.DATA, 201, {"Location": "here"})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.mimetype, "application/json")
+        self.assertEqual(resp.headers["Location"], "here")
+        self.assertEqual(resp.get_json(), self.DATA)
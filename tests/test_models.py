@@ -4,8 +4,19 @@ Test cases for Product Model
 """
 import os
 import logging
+import sqlite3
 import unittest
-from service.models import Product, DataValidationError, db
+from unittest.mock import patch
+from sqlalchemy.exc import IntegrityError
+from service.models import (
+    Product,
+    Recommendation,
+    RecommendationType,
+    DataValidationError,
+    TimedQueuePool,
+    db,
+    pool_listeners,
+)
 from service import app
 from werkzeug.exceptions import NotFound
 from .factories import ProductFactory
@@ -29,12 +40,15 @@ class TestProductModel(unittest.TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         Product.init_db(app)
+        cls.app_context = app.app_context()
+        cls.app_context.push()
         pass
 
     @classmethod
     def tearDownClass(cls):
         """This runs once after the entire test suite"""
         db.session.close()
+        cls.app_context.pop()
 
     def setUp(self):
         """This runs before each test"""
@@ -72,3 +86,287 @@ class TestProductModel(unittest.TestCase):
         self.assertEqual(product.id, 1)
         products = product.all()
         self.assertEqual(len(products), 1)
+
+    def test_create_products_in_bulk(self):
+        """Create Products in batches and report the rows that failed"""
+        rows = [ProductFactory().serialize() for _ in range(5)]
+        rows[1] = {"name": "no price", "category": "phone"}
+        rows[3]["price"] = "free"
+        created, errors = Product.create_bulk(enumerate(rows), batch_size=2)
+        self.assertEqual(created, 3)
+        self.assertEqual([error["index"] for error in errors], [1, 3])
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_create_products_in_bulk_rejected_batch(self):
+        """A batch the database rejects is retried row by row and reported per row"""
+        rows = [ProductFactory().serialize() for _ in range(4)]
+        rows[2]["name"] = "rejected"
+        execute = db.session.execute
+
+        def reject(statement, params=None, *args, **kwargs):
+            if isinstance(params, list) and any(row["name"] == "rejected" for row in params):
+                raise IntegrityError("INSERT", {}, Exception("name rejected"))
+            return execute(statement, params, *args, **kwargs)
+
+        with patch.object(db.session, "execute", side_effect=reject):
+            created, errors = Product.create_bulk(enumerate(rows), batch_size=2)
+        self.assertEqual(created, 3)
+        self.assertEqual([error["index"] for error in errors], [2])
+        self.assertIn("name rejected", errors[0]["message"])
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_create_products_in_bulk_checks_columns(self):
+        """Rows that do not fit the columns are rejected before they are inserted"""
+        rows = [ProductFactory().serialize() for _ in range(5)]
+        rows[0]["name"] = "x" * 64
+        rows[1]["category"] = None
+        rows[2]["price"] = 2 ** 31
+        created, errors = Product.create_bulk(enumerate(rows), batch_size=5)
+        self.assertEqual(created, 2)
+        self.assertEqual([error["index"] for error in errors], [0, 1, 2])
+        self.assertIn("longer than 63", errors[0]["message"])
+
+    def test_page_products(self):
+        """Page through Products keyed on their id"""
+        for _ in range(5):
+            ProductFactory().create()
+        first = Product.page(limit=2)
+        self.assertEqual(len(first), 2)
+        second = Product.page(after=first[-1].id, limit=2)
+        self.assertEqual(len(second), 2)
+        self.assertGreater(second[0].id, first[-1].id)
+        last = Product.page(after=second[-1].id, limit=2)
+        self.assertEqual(len(last), 1)
+
+    def test_page_product_rows(self):
+        """Page through Products as dictionaries"""
+        for _ in range(3):
+            ProductFactory().create()
+        pages = Product.page(limit=2)
+        rows = Product.page_rows(limit=2)
+        self.assertEqual(rows, [product.serialize() for product in pages])
+        rows = Product.page_rows(after=rows[-1]["id"], limit=2)
+        self.assertEqual(len(rows), 1)
+
+    def test_find_product_row(self):
+        """Find a Product by ID as a dictionary"""
+        product = ProductFactory()
+        product.create()
+        self.assertEqual(Product.find_row(product.id), product.serialize())
+        self.assertIsNone(Product.find_row(0))
+
+    def test_stream_products(self):
+        """Stream every Product as a dictionary"""
+        products = [ProductFactory() for _ in range(5)]
+        for product in products:
+            product.create()
+        rows = list(Product.stream(chunk_size=2))
+        self.assertEqual([row["id"] for row in rows], [p.id for p in products])
+        self.assertEqual(rows[0], products[0].serialize())
+        rows = list(Product.stream(after=products[2].id))
+        self.assertEqual(len(rows), 2)
+
+    def test_find_a_product(self):
+        """Find a Product by ID"""
+        product = ProductFactory()
+        product.create()
+        found = Product.find(product.id)
+        self.assertEqual(found.id, product.id)
+        self.assertEqual(found.name, product.name)
+        self.assertIsNone(Product.find(0))
+
+
+######################################################################
+#  R E C O M M E N D A T I O N   M O D E L   T E S T   C A S E S
+######################################################################
+class TestRecommendationModel(unittest.TestCase):
+    """ Test Cases for Recommendation Model """
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.logger.setLevel(logging.CRITICAL)
+        Product.init_db(app)
+        cls.app_context = app.app_context()
+        cls.app_context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+        cls.app_context.pop()
+
+    def setUp(self):
+        """This runs before each test"""
+        db.drop_all()  # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        self.products = []
+        for _ in range(4):
+            product = ProductFactory()
+            product.create()
+            self.products.append(product)
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+        db.drop_all()
+
+    def _link(self, source, target, rec_type, rank=0):
+        """Creates a Recommendation between two products"""
+        recommendation = Recommendation(
+            source_product_id=source.id,
+            target_product_id=target.id,
+            type=rec_type,
+            rank=rank,
+        )
+        recommendation.create()
+        return recommendation
+
+    def test_parse_recommendation_type(self):
+        """Parse recommendation types from strings"""
+        self.assertEqual(RecommendationType.parse("upsell"), RecommendationType.UPSELL)
+        self.assertEqual(
+            RecommendationType.parse("CROSS_SELL"), RecommendationType.CROSS_SELL
+        )
+        self.assertRaises(DataValidationError, RecommendationType.parse, "bogus")
+
+    def test_create_a_recommendation(self):
+        """Create a Recommendation and serialize it"""
+        source, target = self.products[:2]
+        recommendation = self._link(source, target, RecommendationType.UPSELL, 1)
+        self.assertIsNotNone(recommendation.id)
+        data = recommendation.serialize()
+        self.assertEqual(data["source_product_id"], source.id)
+        self.assertEqual(data["target_product_id"], target.id)
+        self.assertEqual(data["type"], "upsell")
+        self.assertEqual(data["rank"], 1)
+
+    def test_create_duplicate_recommendation(self):
+        """A duplicate link is rejected"""
+        source, target = self.products[:2]
+        self._link(source, target, RecommendationType.UPSELL)
+        self.assertRaises(
+            DataValidationError, self._link, source, target, RecommendationType.UPSELL
+        )
+
+    def test_deserialize_a_recommendation(self):
+        """Deserialize a Recommendation"""
+        data = {"target_product_id": 3, "type": "accessory", "rank": 2}
+        recommendation = Recommendation().deserialize(data)
+        self.assertEqual(recommendation.target_product_id, 3)
+        self.assertEqual(recommendation.type, RecommendationType.ACCESSORY)
+        self.assertEqual(recommendation.rank, 2)
+
+    def test_deserialize_bad_data(self):
+        """Deserialize a Recommendation with bad data"""
+        recommendation = Recommendation()
+        self.assertRaises(DataValidationError, recommendation.deserialize, {})
+        self.assertRaises(DataValidationError, recommendation.deserialize, "data")
+        self.assertRaises(
+            DataValidationError,
+            recommendation.deserialize,
+            {"target_product_id": "3", "type": "upsell"},
+        )
+        self.assertRaises(
+            DataValidationError,
+            recommendation.deserialize,
+            {"target_product_id": 3, "type": "upsell", "rank": "1"},
+        )
+
+    def test_lookup_recommendations(self):
+        """Look up recommendations ordered by type and rank"""
+        source, first, second, third = self.products
+        self._link(source, second, RecommendationType.UPSELL, 2)
+        self._link(source, first, RecommendationType.UPSELL, 1)
+        self._link(source, third, RecommendationType.ACCESSORY, 1)
+        self._link(first, third, RecommendationType.UPSELL, 1)
+
+        upsells = Recommendation.lookup(source.id, RecommendationType.UPSELL)
+        self.assertEqual([rec["product_id"] for rec in upsells], [first.id, second.id])
+        self.assertEqual(upsells[0]["name"], first.name)
+        self.assertEqual(upsells[0]["price"], first.price)
+
+        everything = Recommendation.lookup(source.id)
+        self.assertEqual(len(everything), 3)
+        self.assertEqual(Recommendation.lookup(third.id), [])
+
+    def test_delete_a_recommendation(self):
+        """Delete a Recommendation"""
+        source, target = self.products[:2]
+        recommendation = self._link(source, target, RecommendationType.CROSS_SELL)
+        recommendation.delete()
+        self.assertEqual(Recommendation.lookup(source.id), [])
+
+    def test_versions_follow_changes(self):
+        """A product's version moves with every change its lookup shows"""
+        source, target, other, _ = self.products
+
+        def versions():
+            return Product.versions([source.id, target.id, other.id])
+
+        self.assertEqual(versions(), {source.id: 1, target.id: 1, other.id: 1})
+        recommendation = self._link(source, target, RecommendationType.UPSELL)
+        self.assertEqual(versions(), {source.id: 2, target.id: 1, other.id: 1})
+        target.price += 1
+        target.update()
+        self.assertEqual(versions(), {source.id: 3, target.id: 2, other.id: 1})
+        self.assertEqual(Product.find_row(target.id)["version"], 2)
+        recommendation.delete()
+        self.assertEqual(Product.find_version(source.id), 4)
+        self._link(source, other, RecommendationType.UPSELL)
+        other.delete()
+        self.assertEqual(versions(), {source.id: 6, target.id: 2})
+        self.assertIsNone(Product.find_version(other.id))
+        Product.bump_versions()
+        self.assertEqual(versions(), {source.id: 7, target.id: 3})
+
+    def test_lookup_many_recommendations(self):
+        """Look up the recommendations of many products in one query"""
+        source, first, second, third = self.products
+        self._link(source, first, RecommendationType.UPSELL, 1)
+        self._link(source, second, RecommendationType.UPSELL, 2)
+        self._link(source, third, RecommendationType.ACCESSORY, 1)
+        self._link(first, third, RecommendationType.UPSELL, 1)
+
+        results = Recommendation.lookup_many([source.id, first.id, third.id])
+        # ordered by type name, then by rank
+        self.assertEqual(
+            [rec["product_id"] for rec in results[source.id]],
+            [third.id, first.id, second.id],
+        )
+        self.assertEqual(len(results[first.id]), 1)
+        self.assertEqual(results[third.id], [])
+
+        results = Recommendation.lookup_many([source.id, first.id], limit=1)
+        self.assertEqual([rec["product_id"] for rec in results[source.id]], [third.id])
+        self.assertEqual(len(results[first.id]), 1)
+
+        results = Recommendation.lookup_many(
+            [source.id], [RecommendationType.ACCESSORY], limit=5
+        )
+        self.assertEqual([rec["product_id"] for rec in results[source.id]], [third.id])
+
+
+######################################################################
+#  C O N N E C T I O N   P O O L   T E S T   C A S E S
+######################################################################
+class TestTimedQueuePool(unittest.TestCase):
+    """ Test Cases for the instrumented connection pool """
+
+    def test_checkout_reports_wait(self):
+        """Every checkout reports its bind and how long it waited"""
+        waits = []
+        pool_listeners.append(lambda bind, seconds: waits.append((bind, seconds)))
+        pool = TimedQueuePool(lambda: sqlite3.connect(":memory:"), pool_size=1)
+        try:
+            conn = pool.connect()
+            conn.close()
+            pool.connect().close()
+        finally:
+            pool_listeners.pop()
+            pool.dispose()
+        self.assertEqual([bind for bind, _ in waits], ["primary", "primary"])
+        self.assertTrue(all(seconds >= 0 for _, seconds in waits))
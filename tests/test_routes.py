@@ -6,10 +6,13 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
+import tempfile
 from unittest import TestCase
 from service import status  # HTTP Status Codes
-from service.models import db
+from service.models import Product, db
+from service.cache import recommendation_cache
 from service.routes import app, init_db
 from tests.factories import ProductFactory
 from urllib.parse import quote_plus
@@ -35,18 +38,23 @@ class TestYourResourceServer(TestCase):
         app.config["DEBUG"] = False
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        app.config["PRICE_INDEX_AUTOBUILD"] = False
         app.logger.setLevel(logging.CRITICAL)
         init_db()
+        cls.app_context = app.app_context()
+        cls.app_context.push()
 
     @classmethod
     def tearDownClass(cls):
         """Run once after all tests"""
         db.session.close()
+        cls.app_context.pop()
 
     def setUp(self):
         """Runs before each test"""
         db.drop_all()  # clean up the last tests
         db.create_all()  # create new tables
+        recommendation_cache.init_app(app)
         self.app = app.test_client()
 
     def tearDown(self):
@@ -105,3 +113,315 @@ class TestYourResourceServer(TestCase):
         resp = self.app.post(BASE_URL)
         self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 
+    def test_create_products_bulk_json(self):
+        """Create products from a JSON array"""
+        rows = [ProductFactory().serialize() for _ in range(3)]
+        rows.append({"name": "bad"})
+        resp = self.app.post(BASE_URL, json=rows, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual(data["failed"], 1)
+        self.assertEqual(data["errors"][0]["index"], 3)
+
+    def test_create_products_bulk_ndjson(self):
+        """Create products from a newline delimited JSON body"""
+        lines = [json.dumps(ProductFactory().serialize()) for _ in range(3)]
+        lines.insert(1, "{not json")
+        resp = self.app.post(
+            BASE_URL, data="\n".join(lines) + "\n", content_type="application/x-ndjson"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = resp.get_json()
+        self.assertEqual(data["created"], 3)
+        self.assertEqual([error["index"] for error in data["errors"]], [1])
+
+    def test_create_products_bulk_all_invalid(self):
+        """A bulk request where every row is invalid"""
+        resp = self.app.post(BASE_URL, json=[{}, {}], content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()["failed"], 2)
+
+    def test_list_products_paged(self):
+        """List products one page at a time"""
+        self._create_products(5)
+        resp = self.app.get(f"{BASE_URL}?limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        seen = []
+        url = f"{BASE_URL}?limit=2"
+        while url:
+            resp = self.app.get(url)
+            seen.extend(product["id"] for product in resp.get_json())
+            link = resp.headers.get("Link")
+            url = link[link.index("<") + 1:link.index(">")] if link else None
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_list_products_bad_parameters(self):
+        """List products with a bad limit or cursor"""
+        resp = self.app.get(f"{BASE_URL}?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(f"{BASE_URL}?after=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_products_streamed(self):
+        """Stream every product as newline delimited JSON"""
+        products = self._create_products(3)
+        resp = self.app.get(BASE_URL, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([row["id"] for row in rows], [p.id for p in products])
+
+    def test_get_product_not_found(self):
+        """Get a Product that does not exist"""
+        resp = self.app.get(f"{BASE_URL}/0")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def _link(self, source, target, rec_type, rank=0):
+        """Adds a recommendation through the API"""
+        return self.app.post(
+            f"{BASE_URL}/{source.id}/links",
+            json={"target_product_id": target.id, "type": rec_type, "rank": rank},
+            content_type=CONTENT_TYPE_JSON,
+        )
+
+    def test_create_recommendation(self):
+        """Link two products"""
+        source, target = self._create_products(2)
+        resp = self._link(source, target, "upsell", 1)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertIsNotNone(resp.headers.get("Location", None))
+        data = resp.get_json()
+        self.assertEqual(data["source_product_id"], source.id)
+        self.assertEqual(data["target_product_id"], target.id)
+        self.assertEqual(data["type"], "upsell")
+        # a second identical link is rejected
+        resp = self._link(source, target, "upsell", 1)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_recommendation_missing_products(self):
+        """Link products that do not exist"""
+        source = self._create_products(1)[0]
+        resp = self.app.post(
+            f"{BASE_URL}/0/links",
+            json={"target_product_id": source.id, "type": "upsell"},
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post(
+            f"{BASE_URL}/{source.id}/links",
+            json={"target_product_id": 0, "type": "upsell"},
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_recommendations_by_type(self):
+        """Get the recommendations of a product filtered by type"""
+        source, upsell, accessory = self._create_products(3)
+        self._link(source, upsell, "upsell")
+        self._link(source, accessory, "accessory")
+
+        resp = self.app.get(f"{BASE_URL}/{source.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["recommendations"]), 2)
+
+        resp = self.app.get(f"{BASE_URL}/{source.id}?type=upsell")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        recommendations = resp.get_json()["recommendations"]
+        self.assertEqual(len(recommendations), 1)
+        self.assertEqual(recommendations[0]["product_id"], upsell.id)
+        self.assertEqual(recommendations[0]["type"], "upsell")
+
+        resp = self.app.get(f"{BASE_URL}/{source.id}?type=bogus")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_price_recommendations(self):
+        """Get the upsells of a product by price"""
+        products = []
+        for price in (100, 200, 300):
+            resp = self.app.post(
+                BASE_URL,
+                json={"name": "phone", "category": "phone", "price": price},
+                content_type=CONTENT_TYPE_JSON,
+            )
+            products.append(resp.get_json())
+        resp = self.app.get(f"{BASE_URL}/{products[0]['id']}/by-price?type=upsell&limit=1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        recommendations = resp.get_json()["recommendations"]
+        self.assertEqual([rec["product_id"] for rec in recommendations], [products[1]["id"]])
+
+        resp = self.app.get(f"{BASE_URL}/{products[0]['id']}/by-price?type=accessory")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(f"{BASE_URL}/{products[0]['id']}/by-price?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get(f"{BASE_URL}/0/by-price")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_recommendations_batch(self):
+        """Get the recommendations of many products in one request"""
+        first, second, upsell, accessory = self._create_products(4)
+        self._link(first, upsell, "upsell")
+        self._link(first, accessory, "accessory")
+        self._link(second, upsell, "upsell")
+
+        resp = self.app.post(
+            f"{BASE_URL}/batch",
+            json={"product_ids": [second.id, first.id, upsell.id], "limit": 1},
+            content_type=CONTENT_TYPE_JSON,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(
+            [result["product_id"] for result in data], [second.id, first.id, upsell.id]
+        )
+        self.assertEqual(len(data[1]["recommendations"]), 1)
+        self.assertEqual(data[2]["recommendations"], [])
+
+        resp = self.app.get(
+            f"{BASE_URL}/batch?product_id={first.id}&product_id={second.id}&type=accessory"
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(
+            [rec["product_id"] for rec in data[0]["recommendations"]], [accessory.id]
+        )
+        self.assertEqual(data[1]["recommendations"], [])
+
+    def test_conditional_lookups(self):
+        """Lookups carry an ETag and answer a matching If-None-Match with 304"""
+        source, target, other = self._create_products(3)
+        self._link(source, target, "upsell")
+        url = f"{BASE_URL}/{source.id}"
+        resp = self.app.get(url)
+        etag = resp.headers["ETag"]
+        self.assertEqual(resp.headers["Cache-Control"], app.config["HTTP_CACHE_CONTROL"]["get_products"])
+        self.assertNotEqual(self.app.get(url + "?type=upsell").headers["ETag"], etag)
+
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["ETag"], etag)
+        # answered from the product row alone once the cache is empty
+        recommendation_cache.init_app(app)
+        resp = self.app.get(url, headers={"If-None-Match": 'W/"x", ' + etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        product = Product.find(target.id)
+        product.price += 1
+        product.update()
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["recommendations"][0]["price"], product.price)
+        etag = resp.headers["ETag"]
+        self._link(source, other, "accessory")
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()["recommendations"]), 2)
+
+        # click-through order changes without a version, so it has no ETag
+        self.assertNotIn("ETag", self.app.get(url + "?order=ctr").headers)
+        resp = self.app.get(f"{BASE_URL}/0", headers={"If-None-Match": "*"})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_conditional_batches_and_pages(self):
+        """Batches and product pages carry ETags of the versions they show"""
+        first, second = self._create_products(2)
+        url = f"{BASE_URL}/batch?product_id={first.id}&product_id={second.id}"
+        etag = self.app.get(url).headers["ETag"]
+        self.assertNotEqual(self.app.get(url + "&limit=1").headers["ETag"], etag)
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self._link(second, first, "upsell")
+        resp = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.post(
+            f"{BASE_URL}/batch", json={"product_ids": [first.id]}, content_type=CONTENT_TYPE_JSON
+        )
+        self.assertNotIn("ETag", resp.headers)
+        self.assertNotIn("Cache-Control", resp.headers)
+
+        etag = self.app.get(BASE_URL).headers["ETag"]
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        product = Product.find(first.id)
+        product.name = "Renamed"
+        product.update()
+        resp = self.app.get(BASE_URL, headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()[0]["version"], 2)
+
+    def test_get_recommendations_batch_bad_requests(self):
+        """Reject batch lookups with bad parameters"""
+        for body in (
+            {},
+            {"product_ids": []},
+            {"product_ids": ["1"]},
+            {"product_ids": [1], "limit": 0},
+            {"product_ids": [1], "types": "upsell"},
+            {"product_ids": [1], "types": ["bogus"]},
+            {"product_ids": list(range(1000))},
+            [1, 2],
+        ):
+            resp = self.app.post(
+                f"{BASE_URL}/batch", json=body, content_type=CONTENT_TYPE_JSON
+            )
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, body)
+        resp = self.app.get(f"{BASE_URL}/batch?product_id=abc")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_reads_go_to_replica(self):
+        """GET requests read from the replica and writes go to the primary"""
+        replica_dir = tempfile.mkdtemp()
+        app.config["SQLALCHEMY_BINDS"] = {
+            "replica": "sqlite:///" + os.path.join(replica_dir, "replica.db")
+        }
+        db.session.remove()
+        replica = db.get_engine(app, bind="replica")
+        db.Model.metadata.create_all(replica)
+        try:
+            resp = self.app.post(BASE_URL, json=ProductFactory().serialize())
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+            product_id = resp.get_json()["id"]
+            self.assertIsNotNone(Product.find(product_id))
+
+            # the replica has not caught up yet
+            resp = self.app.get(f"{BASE_URL}/{product_id}")
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+            with replica.begin() as conn:
+                conn.execute(
+                    Product.__table__.insert(),
+                    {"id": product_id, "name": "replicated", "category": "x", "price": 1},
+                )
+            resp = self.app.get(f"{BASE_URL}/{product_id}")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["name"], "replicated")
+        finally:
+            app.config["SQLALCHEMY_BINDS"] = {}
+            db.session.remove()
+            replica.dispose()
+
+    def test_health(self):
+        """The liveness and readiness checks answer"""
+        resp = self.app.get("/health")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["status"], "ready")
+        self.assertEqual(data["checks"], {"database": "ok", "cache": "ok"})
+
+    def test_not_ready_without_schema(self):
+        """A worker is not ready until the db-create command has run"""
+        db.session.remove()
+        db.drop_all()
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["status"], "unavailable")
+
+        result = app.test_cli_runner().invoke(args=["db-create"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        resp = self.app.get("/health/ready")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)